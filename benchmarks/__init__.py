@@ -0,0 +1,3 @@
+"""
+Benchmarks of the hcp-func gear on synthetic inputs, see benchmarks/harness.py.
+"""
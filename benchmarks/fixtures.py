@@ -0,0 +1,311 @@
+"""
+Synthetic inputs of the hcp-func gear: NIfTI images, an hcp-struct zip
+(StructZip) and the gear directory (config.json, input/, work/, output/)
+of a run, at configurable sizes. Only the standard library is used.
+"""
+import gzip
+import json
+import os
+import os.path as op
+import shutil
+import struct
+import zipfile
+from collections import OrderedDict
+
+# Low byte of the int16 voxels: noise in [0, 15]
+NOISE = bytes(range(16)) * 16
+# High byte of the int16 voxels inside the "brain" ellipsoid
+SIGNAL = 4
+PAYLOAD_CHUNK = 1024 * 1024
+
+# Directories of the structural tree holding the filler members, relative to
+# <Subject>/. "{subject}" directories hold the FreeSurfer subject.
+STRUCT_DIRS = [
+    "T1w/{subject}/mri",
+    "T1w/{subject}/surf",
+    "T1w/{subject}/label",
+    "T1w/{subject}/stats",
+    "T1w/{subject}/scripts",
+    "T1w/{subject}/touch",
+    "T1w/xfms",
+    "MNINonLinear/fsaverage_LR32k",
+    "MNINonLinear/Native",
+    "MNINonLinear/ROIs",
+    "T1w/Native",
+    "T1w/fsaverage_LR32k",
+]
+
+
+def parse_shape(text):
+    """
+    "90x104x72" -> (90, 104, 72)
+    """
+    return tuple(int(value) for value in text.lower().split("x"))
+
+
+def payload(nbytes):
+    """
+    Yield `nbytes` of noise compressing about 2:1, like image data.
+    """
+    while nbytes > 0:
+        size = min(nbytes, PAYLOAD_CHUNK)
+        yield os.urandom(size).translate(NOISE)
+        nbytes -= size
+
+
+def _signal_plane(shape):
+    """
+    High bytes of a 3D volume: SIGNAL inside the central ellipsoid, 0 outside.
+    """
+    nx, ny, nz = shape[:3]
+    rows = []
+    for z in range(nz):
+        for y in range(ny):
+            r = (((2.0 * y + 1) / ny - 1) ** 2 + ((2.0 * z + 1) / nz - 1) ** 2) ** 0.5
+            half = int(0.4 * nx * max(0.0, 1 - r * r) ** 0.5)
+            side = nx // 2 - half
+            rows.append(
+                bytes(side) + bytes([SIGNAL]) * (nx - 2 * side) + bytes(side)
+                if half
+                else bytes(nx)
+            )
+    return b"".join(rows)
+
+
+def nifti_header(shape, zooms, tr=None):
+    """
+    NIfTI-1 header of an int16 image with an LAS sform centered on the
+    origin.
+    """
+    dims = [len(shape)] + list(shape) + [1] * (7 - len(shape))
+    pixdims = [1.0] + list(zooms[:3]) + [tr or 0.0] + [0.0] * 3
+    header = bytearray(352)
+    struct.pack_into("<i", header, 0, 348)
+    struct.pack_into("<8h", header, 40, *dims)
+    # datatype int16, bitpix
+    struct.pack_into("<2h", header, 70, 4, 16)
+    struct.pack_into("<8f", header, 76, *pixdims)
+    # vox_offset, scl_slope, scl_inter
+    struct.pack_into("<3f", header, 108, 352.0, 1.0, 0.0)
+    # mm and seconds
+    header[123] = 2 | 8
+    # qform_code, sform_code (scanner)
+    struct.pack_into("<2h", header, 252, 0, 1)
+    signs = [-1.0, 1.0, 1.0]
+    for row in range(3):
+        srow = [0.0] * 4
+        srow[row] = signs[row] * zooms[row]
+        srow[3] = -signs[row] * zooms[row] * (shape[row] - 1) / 2.0
+        struct.pack_into("<4f", header, 280 + 16 * row, *srow)
+    header[344:348] = b"n+1\0"
+    return bytes(header)
+
+
+def dense_header(volumes, grayordinates, tr=None):
+    """
+    NIfTI-2 header of a float32 CIFTI dense time series (dimensions 1, 1,
+    1, 1, volumes, grayordinates), without the CIFTI XML extension.
+    """
+    header = bytearray(544)
+    struct.pack_into("<i", header, 0, 540)
+    header[4:12] = b"n+2\0\r\n\032\n"
+    # datatype float32, bitpix
+    struct.pack_into("<2h", header, 12, 16, 32)
+    struct.pack_into("<8q", header, 16, 6, 1, 1, 1, 1, volumes, grayordinates, 1)
+    struct.pack_into("<8d", header, 104, 1.0, 1.0, 1.0, 1.0, 1.0, tr or 0.0, 1.0, 1.0)
+    # vox_offset, scl_slope, scl_inter
+    struct.pack_into("<q2d", header, 168, 544, 1.0, 0.0)
+    # xyzt_units, intent_code (ConnDenseSeries)
+    struct.pack_into("<2i", header, 500, 0, 3002)
+    return bytes(header)
+
+
+def write_dense(filename, volumes, grayordinates, tr=None):
+    """
+    Write a CIFTI-like dense time series of noise.
+    """
+    os.makedirs(op.dirname(op.abspath(filename)), exist_ok=True)
+    with open(filename, "wb") as fp:
+        fp.write(dense_header(volumes, grayordinates, tr))
+        for chunk in payload(4 * volumes * grayordinates):
+            fp.write(chunk)
+    return filename
+
+
+def write_nifti(filename, shape, zooms, tr=None, compresslevel=1):
+    """
+    Write an int16 NIfTI-1 image (".nii.gz" or ".nii") of `shape` (3D or 4D):
+    an ellipsoid with noise, new noise in each volume.
+    """
+    plane = _signal_plane(shape)
+    volumes = shape[3] if len(shape) > 3 else 1
+    voxels = len(plane)
+    opener = gzip.open if filename.endswith(".gz") else open
+    kwargs = {"compresslevel": compresslevel} if filename.endswith(".gz") else {}
+    os.makedirs(op.dirname(op.abspath(filename)), exist_ok=True)
+    with opener(filename, "wb", **kwargs) as fp:
+        fp.write(nifti_header(shape, zooms, tr))
+        volume = bytearray(2 * voxels)
+        volume[1::2] = plane
+        for _ in range(volumes):
+            volume[0::2] = os.urandom(voxels).translate(NOISE)
+            fp.write(volume)
+    return filename
+
+
+def write_blob(filename, nbytes):
+    """
+    Write a non-image output (surfaces, CIFTI, text) of `nbytes`.
+    """
+    os.makedirs(op.dirname(op.abspath(filename)), exist_ok=True)
+    with open(filename, "wb") as fp:
+        for chunk in payload(nbytes):
+            fp.write(chunk)
+    return filename
+
+
+def make_struct_zip(
+    filename,
+    subject,
+    members=2000,
+    member_bytes=64 * 1024,
+    t1_shape=(182, 218, 182),
+    t1_zooms=(1.0, 1.0, 1.0),
+    regname="MSMSulc",
+):
+    """
+    Write an hcp-struct zip: the hcp-struct configuration, the images read by
+    hcp-func and its QC, and `members` filler members of `member_bytes`
+    spread over the structural tree.
+    Returns:
+        str: `filename`.
+    """
+    tmp_dir = filename + ".images"
+    os.makedirs(tmp_dir, exist_ok=True)
+    t1 = write_nifti(op.join(tmp_dir, "t1.nii.gz"), t1_shape, t1_zooms)
+    mni_shape = (91, 109, 91)
+    mni = write_nifti(op.join(tmp_dir, "mni.nii.gz"), mni_shape, (2.0, 2.0, 2.0))
+    warp = write_nifti(
+        op.join(tmp_dir, "warp.nii.gz"), mni_shape + (3,), (2.0, 2.0, 2.0)
+    )
+    images = OrderedDict(
+        [
+            ("T1w/T1w_acpc_dc_restore.nii.gz", t1),
+            ("T1w/T1w_acpc_dc_restore_brain.nii.gz", t1),
+            ("T1w/T1w_acpc_dc.nii.gz", t1),
+            ("T1w/brainmask_fs.nii.gz", t1),
+            ("T1w/wmparc.nii.gz", t1),
+            ("T1w/xfms/acpc2MNILinear.mat", None),
+            ("MNINonLinear/T1w_restore.nii.gz", mni),
+            ("MNINonLinear/T1w_restore_brain.nii.gz", mni),
+            ("MNINonLinear/brainmask_fs.nii.gz", mni),
+            ("MNINonLinear/wmparc.nii.gz", mni),
+            ("MNINonLinear/xfms/acpc_dc2standard.nii.gz", warp),
+            ("MNINonLinear/xfms/standard2acpc_dc.nii.gz", warp),
+        ]
+    )
+    config = {"config": {"Subject": subject, "RegName": regname}}
+    try:
+        with zipfile.ZipFile(filename, "w", zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr(
+                "{0}/{0}_hcpstruct_config.json".format(subject), json.dumps(config)
+            )
+            for name, source in images.items():
+                arcname = op.join(subject, name)
+                if source is None:
+                    archive.writestr(arcname, "1 0 0 0\n0 1 0 0\n0 0 1 0\n0 0 0 1\n")
+                else:
+                    archive.write(source, arcname, zipfile.ZIP_STORED)
+            dirs = [path.format(subject=subject) for path in STRUCT_DIRS]
+            for index in range(members):
+                arcname = op.join(
+                    subject,
+                    dirs[index % len(dirs)],
+                    "member_{:05d}.dat".format(index),
+                )
+                archive.writestr(arcname, b"".join(payload(member_bytes)))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return filename
+
+
+def make_inputs(
+    input_dir,
+    matrix=(90, 104, 72),
+    zooms=(2.0, 2.0, 2.0),
+    volumes=100,
+    tr=0.72,
+    spin_echo_volumes=3,
+):
+    """
+    Write the NIfTI inputs of a TOPUP-corrected run and their Flywheel
+    metadata.
+    Returns:
+        OrderedDict: input name -> (path, info).
+    """
+    inputs = OrderedDict()
+    for name, shape, info in [
+        (
+            "fMRITimeSeries",
+            tuple(matrix) + (volumes,),
+            {
+                "RepetitionTime": tr,
+                "EffectiveEchoSpacing": 0.00058,
+                "PhaseEncodingDirection": "i",
+            },
+        ),
+        ("fMRIScout", tuple(matrix), {}),
+        (
+            "SpinEchoPositive",
+            tuple(matrix) + (spin_echo_volumes,),
+            {"PhaseEncodingDirection": "i"},
+        ),
+        (
+            "SpinEchoNegative",
+            tuple(matrix) + (spin_echo_volumes,),
+            {"PhaseEncodingDirection": "i-"},
+        ),
+    ]:
+        path = op.join(input_dir, name, name + ".nii.gz")
+        write_nifti(path, shape, zooms, tr if len(shape) > 3 else None)
+        inputs[name] = (path, info)
+    return inputs
+
+
+def make_gear_dir(gear_dir, config, inputs):
+    """
+    Write the config.json of a gear run in `gear_dir`, with its work and
+    output directories.
+    Args:
+        config (dict): gear configuration.
+        inputs (dict): input name -> (path, info).
+    """
+    for name in ["work", "output"]:
+        os.makedirs(op.join(gear_dir, name), exist_ok=True)
+    invocation = OrderedDict(
+        [
+            ("config", config),
+            (
+                "inputs",
+                OrderedDict(
+                    (
+                        name,
+                        {
+                            "base": "file",
+                            "hierarchy": {"type": "acquisition", "id": "benchmark"},
+                            "location": {"path": path, "name": op.basename(path)},
+                            "object": {
+                                "info": info,
+                                "type": "archive" if name == "StructZip" else "nifti",
+                                "size": op.getsize(path),
+                            },
+                        },
+                    )
+                    for name, (path, info) in inputs.items()
+                ),
+            ),
+            ("destination", {"type": "analysis", "id": "benchmark"}),
+        ]
+    )
+    with open(op.join(gear_dir, "config.json"), "w") as fp:
+        json.dump(invocation, fp, indent=4)
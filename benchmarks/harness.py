@@ -0,0 +1,400 @@
+"""
+Benchmark of the hcp-func gear on synthetic inputs, offline and without
+FSL, Workbench, FreeSurfer or the HCP Pipelines (see benchmarks/stubs.py).
+The gear directory is assembled as in the Dockerfile: the `utils` package of
+hcp-base overlaid with this repository's, run.py and manifest.json. Each
+repeat runs `run.py` in a fresh gear directory, and the wall time of each
+stage is taken from its resource report (utils/instrumentation.py). The
+results are appended, one JSON line per invocation, to the results file and
+compared with the last invocation of the same parameters there.
+
+Requires flywheel-sdk, tr, numpy and nibabel, and a checkout of hcp-base:
+    python3 -m benchmarks.harness --hcp-base ../hcp-base --volumes 200 \\
+        --matrix 90x104x72 --struct-members 3000 --repeat 3
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import os.path as op
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+
+from benchmarks import fixtures, stubs
+
+log = logging.getLogger(__name__)
+
+REPO_DIR = stubs.REPO_DIR
+# Environment of the gear, saved at image build time (see the Dockerfile) and
+# read by hcp-base. Each gear directory has its own, named by
+# GEAR_ENVIRON_VARIABLE (see utils/func_utils.py:load_gear_environ).
+GEAR_ENVIRON = "/tmp/gear_environ.json"
+GEAR_ENVIRON_VARIABLE = "HCPFUNC_GEAR_ENVIRON"
+SUBJECT = "bench01"
+FREESURFER_LICENSE = "benchmark@example.org 00000 *Abcdefghijklm FSabcdefghijk"
+
+
+def _median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+def _copy_tree(src, dst):
+    """
+    Copy `src` into `dst`, overwriting files present in both.
+    """
+    for root, dirs, files in os.walk(src):
+        dirs[:] = [name for name in dirs if name != "__pycache__"]
+        target = op.join(dst, op.relpath(root, src))
+        os.makedirs(target, exist_ok=True)
+        for name in files:
+            shutil.copy2(op.join(root, name), op.join(target, name))
+
+
+def assemble_gear(gear_dir, hcp_base):
+    """
+    Lay out the gear code in `gear_dir` as the Docker image does.
+    """
+    _copy_tree(op.join(hcp_base, "utils"), op.join(gear_dir, "utils"))
+    _copy_tree(op.join(REPO_DIR, "utils"), op.join(gear_dir, "utils"))
+    for name in ["run.py", "manifest.json"]:
+        shutil.copy2(op.join(REPO_DIR, name), op.join(gear_dir, name))
+
+
+def gear_config(overrides):
+    """
+    Gear configuration: the manifest defaults and `overrides`.
+    """
+    with open(op.join(REPO_DIR, "manifest.json")) as fp:
+        manifest_config = json.load(fp)["config"]
+    config = OrderedDict(
+        (key, spec["default"])
+        for key, spec in sorted(manifest_config.items())
+        if "default" in spec
+    )
+    config["FREESURFER_LICENSE"] = FREESURFER_LICENSE
+    # The stub fsl_sub is the gear's local scheduler
+    config["job-scheduler"] = "fsl_sub"
+    # No FSL: the QC images are rendered in-process
+    config["qc-renderer"] = "python"
+    config.update(overrides)
+    return config
+
+
+def make_fixtures(fixture_dir, args):
+    """
+    Write the StructZip and the NIfTI inputs.
+    Returns:
+        OrderedDict: input name -> (path, info).
+    """
+    start = time.time()
+    inputs = OrderedDict()
+    inputs["StructZip"] = (
+        fixtures.make_struct_zip(
+            op.join(fixture_dir, "StructZip", SUBJECT + "_hcpstruct.zip"),
+            SUBJECT,
+            members=args.struct_members,
+            member_bytes=args.member_kb * 1024,
+            t1_shape=fixtures.parse_shape(args.t1_matrix),
+        ),
+        {},
+    )
+    inputs.update(
+        fixtures.make_inputs(
+            fixture_dir,
+            matrix=fixtures.parse_shape(args.matrix),
+            volumes=args.volumes,
+            tr=args.tr,
+        )
+    )
+    log.info("Fixtures written in %.1fs", time.time() - start)
+    return inputs
+
+
+def stage_times(report):
+    """
+    Wall time (summed over runs and repeated stages), peak memory and peak
+    scratch disk of each stage of a resource report.
+    """
+    stages = OrderedDict()
+    for record in report["stages"]:
+        stage = stages.setdefault(
+            record["stage"],
+            OrderedDict(
+                [
+                    ("wall_seconds", 0.0),
+                    ("peak_rss_bytes", 0),
+                    ("scratch_peak_bytes", 0),
+                ]
+            ),
+        )
+        stage["wall_seconds"] = round(
+            stage["wall_seconds"] + record["wall_seconds"], 3
+        )
+        for metric in ["peak_rss_bytes", "scratch_peak_bytes"]:
+            stage[metric] = max(stage[metric], record[metric])
+    return stages
+
+
+def _ensure_gear_environ():
+    """
+    hcp-base reads GEAR_ENVIRON before the gear reads its own environment:
+    outside of the Docker image, create an empty one if there is none. An
+    existing file, possibly in use by another gear, is left untouched.
+    """
+    try:
+        fd = os.open(GEAR_ENVIRON, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+    except FileExistsError:
+        return
+    with os.fdopen(fd, "w") as fp:
+        json.dump({}, fp)
+
+
+def run_gear(gear_dir, environ, timeout=None):
+    """
+    Run the gear in `gear_dir`.
+    Returns:
+        tuple: (exit status, wall seconds, stage times or None).
+    """
+    start = time.time()
+    with open(op.join(gear_dir, "gear.log"), "w") as gear_log:
+        status = subprocess.call(
+            [sys.executable, "run.py"],
+            cwd=gear_dir,
+            env=environ,
+            stdout=gear_log,
+            stderr=subprocess.STDOUT,
+            timeout=timeout,
+        )
+    elapsed = round(time.time() - start, 3)
+    with open(op.join(gear_dir, "config.json")) as fp:
+        fmriname = json.load(fp)["config"]["fMRIName"]
+    report_filename = op.join(
+        gear_dir,
+        "output",
+        "{}_{}_hcpfunc_resources.json".format(SUBJECT, fmriname),
+    )
+    if not op.exists(report_filename):
+        return status, elapsed, None
+    with open(report_filename) as fp:
+        return status, elapsed, stage_times(json.load(fp))
+
+
+def _commit():
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"],
+                cwd=REPO_DIR,
+                stderr=subprocess.DEVNULL,
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(args):
+    """
+    Run the benchmark described by the command line `args`.
+    Returns:
+        OrderedDict: the result record.
+    """
+    parameters = OrderedDict(
+        [
+            ("volumes", args.volumes),
+            ("matrix", args.matrix),
+            ("tr", args.tr),
+            ("t1_matrix", args.t1_matrix),
+            ("struct_members", args.struct_members),
+            ("member_kb", args.member_kb),
+            ("config", OrderedDict(sorted(args.config.items()))),
+        ]
+    )
+    workspace = tempfile.mkdtemp(prefix="hcpfunc_benchmark_", dir=args.scratch)
+    _ensure_gear_environ()
+    inputs = make_fixtures(op.join(workspace, "fixtures"), args)
+    environ = dict(os.environ)
+    environ.update(stubs.install(op.join(workspace, "stubs")))
+
+    totals, statuses, repeats = [], [], []
+    for repeat in range(args.repeat):
+        gear_dir = op.join(workspace, "gear_{}".format(repeat))
+        assemble_gear(gear_dir, args.hcp_base)
+        fixtures.make_gear_dir(gear_dir, gear_config(args.config), inputs)
+        environ_filename = op.join(gear_dir, "gear_environ.json")
+        with open(environ_filename, "w") as fp:
+            json.dump(environ, fp)
+        gear_environ = dict(environ)
+        gear_environ[GEAR_ENVIRON_VARIABLE] = environ_filename
+        status, elapsed, stages = run_gear(gear_dir, gear_environ, args.timeout)
+        log.info("Repeat %d: exit status %d in %.1fs", repeat, status, elapsed)
+        if status:
+            log.error("The gear failed, see %s", op.join(gear_dir, "gear.log"))
+        statuses.append(status)
+        totals.append(elapsed)
+        repeats.append(stages or OrderedDict())
+        if not args.keep and not status:
+            shutil.rmtree(gear_dir, ignore_errors=True)
+    # Failed runs are kept for inspection
+    if not args.keep and not any(statuses):
+        shutil.rmtree(workspace, ignore_errors=True)
+
+    stages = OrderedDict()
+    for run_stages in repeats:
+        for name, values in run_stages.items():
+            stage = stages.setdefault(
+                name,
+                OrderedDict(
+                    [
+                        ("wall_seconds", []),
+                        ("peak_rss_bytes", 0),
+                        ("scratch_peak_bytes", 0),
+                    ]
+                ),
+            )
+            stage["wall_seconds"].append(values["wall_seconds"])
+            for metric in ["peak_rss_bytes", "scratch_peak_bytes"]:
+                stage[metric] = max(stage[metric], values[metric])
+    return OrderedDict(
+        [
+            ("timestamp", datetime.datetime.now().isoformat()),
+            ("commit", _commit()),
+            ("host", platform.node()),
+            ("python", platform.python_version()),
+            ("cpus", os.cpu_count()),
+            ("parameters", parameters),
+            ("exit_status", statuses),
+            ("total_seconds", totals),
+            ("stages", stages),
+        ]
+    )
+
+
+def previous_result(filename, parameters):
+    """
+    The last successful result of the same parameters in the results file.
+    """
+    if not op.exists(filename):
+        return None
+    previous = None
+    with open(filename) as fp:
+        for line in fp:
+            if not line.strip():
+                continue
+            result = json.loads(line, object_pairs_hook=OrderedDict)
+            if result["parameters"] == parameters and not any(result["exit_status"]):
+                previous = result
+    return previous
+
+
+def compare(result, previous, tolerance):
+    """
+    Print the median wall time of each stage, against `previous` if any.
+    Returns:
+        list: stages slower than `previous` by more than `tolerance`.
+    """
+    regressions = []
+    print("{:<32} {:>10} {:>10} {:>8}".format("stage", "seconds", "previous", "change"))
+    rows = [("total", result["total_seconds"])] + [
+        (name, stage["wall_seconds"]) for name, stage in result["stages"].items()
+    ]
+    for name, walls in rows:
+        median = _median(walls)
+        before = None
+        if previous is not None:
+            if name == "total":
+                before = _median(previous["total_seconds"])
+            elif name in previous["stages"]:
+                before = _median(previous["stages"][name]["wall_seconds"])
+        if before:
+            change = (median - before) / before
+            print(
+                "{:<32} {:>10.2f} {:>10.2f} {:>+7.0%}".format(
+                    name, median, before, change
+                )
+            )
+            # Stages under a second are dominated by noise
+            if change > tolerance and median - before > 1.0:
+                regressions.append(name)
+        else:
+            print("{:<32} {:>10.2f} {:>10} {:>8}".format(name, median, "-", "-"))
+    return regressions
+
+
+def _config_option(text):
+    key, _, value = text.partition("=")
+    try:
+        return key, json.loads(value)
+    except ValueError:
+        return key, value
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the hcp-func gear on synthetic inputs."
+    )
+    parser.add_argument(
+        "--hcp-base", required=True, help="checkout of hcp-base (with utils/)"
+    )
+    parser.add_argument("--volumes", type=int, default=100)
+    parser.add_argument("--matrix", default="90x104x72", help="fMRI matrix")
+    parser.add_argument("--tr", type=float, default=0.72)
+    parser.add_argument("--t1-matrix", default="182x218x182")
+    parser.add_argument("--struct-members", type=int, default=2000)
+    parser.add_argument("--member-kb", type=int, default=64)
+    parser.add_argument(
+        "--config",
+        action="append",
+        type=_config_option,
+        default=[],
+        metavar="KEY=VALUE",
+        help="gear configuration override (JSON value), repeatable",
+    )
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--timeout", type=float, help="seconds per gear run")
+    parser.add_argument("--scratch", help="directory of the temporary workspace")
+    parser.add_argument(
+        "-o",
+        "--output",
+        default="hcpfunc_benchmarks.jsonl",
+        help="results file, one JSON line per invocation",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="relative slowdown of a stage reported as a regression",
+    )
+    parser.add_argument(
+        "--keep", action="store_true", help="keep the workspace for inspection"
+    )
+    args = parser.parse_args()
+    args.config = dict(args.config)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+
+    result = benchmark(args)
+    previous = previous_result(args.output, result["parameters"])
+    with open(args.output, "a") as fp:
+        fp.write(json.dumps(result) + "\n")
+    regressions = compare(result, previous, args.tolerance)
+    if any(result["exit_status"]):
+        return 2
+    if regressions:
+        log.warning("Slower than %s: %s", previous["commit"], ", ".join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
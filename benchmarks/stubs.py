@@ -0,0 +1,276 @@
+"""
+Stub binaries standing in for FSL, Connectome Workbench, FreeSurfer and the
+HCP Pipelines, so that the gear runs end to end on a machine without them.
+`install` lays out FSLDIR, HCPPIPEDIR, CARET7DIR and FREESURFER_HOME trees:
+ - $FSLDIR/bin/fsl_sub is the gear's local scheduler
+   (scripts/local_scheduler/fsl_sub), which runs the job in the foreground,
+ - the fMRIVolume and fMRISurface pipeline scripts write the outputs of the
+   real pipelines (intermediates included, sized from the input headers)
+   with synthetic contents.
+
+    python3 -m benchmarks.stubs volume|surface --path=... --subject=... ...
+"""
+import gzip
+import os
+import os.path as op
+import shutil
+import stat
+import sys
+
+from benchmarks import fixtures
+from utils import nifti_header
+
+REPO_DIR = op.dirname(op.dirname(op.abspath(__file__)))
+
+# MNI152 grid at 2 mm
+MNI_2MM_SHAPE = (91, 109, 91)
+# Grayordinates of the 91k CIFTI space and vertices of a native hemisphere
+GRAYORDINATES = 91282
+NATIVE_VERTICES = 140000
+
+IDENTITY_MAT = "1 0 0 0\n0 1 0 0\n0 0 1 0\n0 0 0 1\n"
+
+PIPELINE_SCRIPT = """#!/bin/sh
+# Stub of the HCP Pipelines {stage} script for the hcp-func benchmarks
+PYTHONPATH="{repo}" exec "{python}" -m benchmarks.stubs {stage} "$@"
+"""
+
+
+def _executable(filename, text):
+    os.makedirs(op.dirname(filename), exist_ok=True)
+    with open(filename, "w") as fp:
+        fp.write(text)
+    mode = os.stat(filename).st_mode
+    os.chmod(filename, mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+
+def install(stub_dir):
+    """
+    Install the stub trees in `stub_dir`.
+    Returns:
+        dict: the environment variables of the gear pointing to them.
+    """
+    fsl_dir = op.join(stub_dir, "fsl")
+    hcp_dir = op.join(stub_dir, "HCP-Pipelines")
+    os.makedirs(op.join(fsl_dir, "bin"), exist_ok=True)
+    shutil.copy(
+        op.join(REPO_DIR, "scripts", "local_scheduler", "fsl_sub"),
+        op.join(fsl_dir, "bin", "fsl_sub"),
+    )
+    for stage, script in [
+        ("volume", "fMRIVolume/GenericfMRIVolumeProcessingPipeline.sh"),
+        ("surface", "fMRISurface/GenericfMRISurfaceProcessingPipeline.sh"),
+    ]:
+        _executable(
+            op.join(hcp_dir, script),
+            PIPELINE_SCRIPT.format(stage=stage, repo=REPO_DIR, python=sys.executable),
+        )
+    config_dir = op.join(hcp_dir, "global", "config")
+    os.makedirs(config_dir, exist_ok=True)
+    with open(op.join(config_dir, "b02b0.cnf"), "w") as fp:
+        fp.write("# topup configuration stub\n")
+    for name in ["workbench/bin_linux64", "freesurfer"]:
+        os.makedirs(op.join(stub_dir, name), exist_ok=True)
+
+    return {
+        "FSLDIR": fsl_dir,
+        "FSL_DIR": fsl_dir,
+        "FSLOUTPUTTYPE": "NIFTI_GZ",
+        "HCPPIPEDIR": hcp_dir,
+        "HCPPIPEDIR_Config": config_dir,
+        "HCPPIPEDIR_Global": op.join(hcp_dir, "global", "scripts"),
+        "HCPPIPEDIR_Templates": op.join(hcp_dir, "global", "templates"),
+        "HCPPIPEDIR_fMRIVol": op.join(hcp_dir, "fMRIVolume", "scripts"),
+        "HCPPIPEDIR_fMRISurf": op.join(hcp_dir, "fMRISurface", "scripts"),
+        "CARET7DIR": op.join(stub_dir, "workbench", "bin_linux64"),
+        "FREESURFER_HOME": op.join(stub_dir, "freesurfer"),
+        "PATH": op.join(fsl_dir, "bin") + os.pathsep + os.environ.get("PATH", ""),
+    }
+
+
+def parse_params(argv):
+    """
+    HCP Pipelines "--key=value" arguments to a dict.
+    """
+    params = {}
+    for arg in argv:
+        if arg.startswith("--"):
+            key, _, value = arg[2:].partition("=")
+            params[key] = value
+    return params
+
+
+def _mni_shape(fmrires):
+    return tuple(int(round(n * 2.0 / float(fmrires))) for n in MNI_2MM_SHAPE)
+
+
+def _extension():
+    """
+    Extension of the images written by FSL (FSLOUTPUTTYPE of the gear).
+    """
+    return ".nii" if os.environ.get("FSLOUTPUTTYPE") == "NIFTI" else ".nii.gz"
+
+
+def _copies(source, filenames):
+    for filename in filenames:
+        os.makedirs(op.dirname(filename), exist_ok=True)
+        if source.endswith(".gz") == filename.endswith(".gz"):
+            shutil.copyfile(source, filename)
+            continue
+        opener = gzip.open if filename.endswith(".gz") else open
+        with nifti_header.open_nifti(source) as src, opener(filename, "wb") as dst:
+            shutil.copyfileobj(src, dst)
+
+
+def _movement(filename, volumes, columns):
+    os.makedirs(op.dirname(filename), exist_ok=True)
+    with open(filename, "w") as fp:
+        for _ in range(volumes):
+            fp.write(" ".join(["0.000000"] * columns) + "\n")
+
+
+def fake_volume(params):
+    """
+    Outputs of GenericfMRIVolumeProcessingPipeline.sh.
+    """
+    subject_dir = op.join(params["path"], params["subject"])
+    fmriname = params["fmriname"]
+    fmri_dir = op.join(subject_dir, fmriname)
+    results_dir = op.join(subject_dir, "MNINonLinear", "Results", fmriname)
+    dc_dir = op.join(
+        fmri_dir, "DistortionCorrectionAndEPIToT1wReg_FLIRTBBRAndFreeSurferBBRbased"
+    )
+    ext = _extension()
+    series = nifti_header.read_header(params["fmritcs"])
+    t1 = nifti_header.read_header(
+        op.join(subject_dir, "T1w", "T1w_acpc_dc_restore.nii.gz")
+    )
+    epi_shape, epi_zooms = series.shape[:3], series.zooms[:3]
+    volumes = series.volumes
+    fmrires = params["fmrires"]
+    mni_shape = _mni_shape(fmrires)
+    mni_zooms = (float(fmrires),) * 3
+
+    # Working copies of the time series
+    _copies(
+        params["fmritcs"],
+        [
+            op.join(fmri_dir, "{}_{}{}".format(fmriname, suffix, ext))
+            for suffix in ["orig", "gdc", "mc"]
+        ],
+    )
+    nonlin = fixtures.write_nifti(
+        op.join(fmri_dir, fmriname + "_nonlin" + ext),
+        mni_shape + (volumes,),
+        mni_zooms,
+        series.tr,
+    )
+    _copies(
+        nonlin,
+        [
+            op.join(fmri_dir, fmriname + "_nonlin_norm" + ext),
+            op.join(results_dir, fmriname + ext),
+        ],
+    )
+
+    # One step resampling and motion correction, per volume
+    epi_volume = fixtures.write_nifti(
+        op.join(dc_dir, "FieldMap", "SBRef" + ext), epi_shape, epi_zooms
+    )
+    mni_volume = fixtures.write_nifti(
+        op.join(fmri_dir, fmriname + "_SBRef_nonlin" + ext), mni_shape, mni_zooms
+    )
+    resampling_dir = op.join(fmri_dir, "OneStepResampling")
+    _copies(
+        epi_volume,
+        [
+            op.join(resampling_dir, "prevols", "vol{}{}".format(index, ext))
+            for index in range(volumes)
+        ]
+        + [
+            op.join(fmri_dir, "MotionMatrices", "MAT_{:04d}_all_warp{}".format(i, ext))
+            for i in range(volumes)
+        ],
+    )
+    _copies(
+        mni_volume,
+        [
+            op.join(resampling_dir, "postvols", "vol{}{}".format(index, ext))
+            for index in range(volumes)
+        ],
+    )
+    for index in range(volumes):
+        with open(
+            op.join(fmri_dir, "MotionMatrices", "MAT_{:04d}".format(index)), "w"
+        ) as fp:
+            fp.write(IDENTITY_MAT)
+
+    # Registrations and their QC inputs
+    _copies(epi_volume, [op.join(dc_dir, "FieldMap", "SBRef_dc" + ext)])
+    with open(op.join(dc_dir, "fMRI2str.mat"), "w") as fp:
+        fp.write(IDENTITY_MAT)
+    fixtures.write_nifti(op.join(fmri_dir, "Scout2T1w" + ext), t1.shape, t1.zooms)
+    _copies(
+        mni_volume,
+        [
+            op.join(fmri_dir, "T1w_restore.{}{}".format(fmrires, ext)),
+            op.join(results_dir, fmriname + "_SBRef" + ext),
+            op.join(results_dir, "brainmask_fs.{}{}".format(fmrires, ext)),
+            op.join(results_dir, fmriname + "_Jacobian" + ext),
+        ],
+    )
+    for directory in [fmri_dir, results_dir]:
+        _movement(op.join(directory, "Movement_Regressors.txt"), volumes, 12)
+        _movement(op.join(directory, "Movement_RelativeRMS.txt"), volumes, 1)
+
+
+def fake_surface(params):
+    """
+    Outputs of GenericfMRISurfaceProcessingPipeline.sh.
+    """
+    subject_dir = op.join(params["path"], params["subject"])
+    fmriname = params["fmriname"]
+    results_dir = op.join(subject_dir, "MNINonLinear", "Results", fmriname)
+    ext = _extension()
+    series = nifti_header.read_header(op.join(results_dir, fmriname + ext))
+    volumes = series.volumes
+    mesh = params.get("lowresmesh", "32")
+    mesh_vertices = int(mesh) * 1000
+
+    fixtures.write_dense(
+        op.join(results_dir, fmriname + "_Atlas.dtseries.nii"),
+        volumes,
+        GRAYORDINATES,
+        series.tr,
+    )
+    fixtures.write_dense(
+        op.join(results_dir, fmriname + "_Atlas_mean.dscalar.nii"), 1, GRAYORDINATES
+    )
+    for hemisphere in "LR":
+        fixtures.write_blob(
+            op.join(results_dir, "{}.{}.native.func.gii".format(fmriname, hemisphere)),
+            4 * NATIVE_VERTICES * volumes,
+        )
+        fixtures.write_blob(
+            op.join(
+                results_dir,
+                "{}.{}.atlasroi.{}k_fs_LR.func.gii".format(fmriname, hemisphere, mesh),
+            ),
+            4 * mesh_vertices * volumes,
+        )
+    mapping_dir = op.join(results_dir, "RibbonVolumeToSurfaceMapping")
+    goodvoxels = fixtures.write_nifti(
+        op.join(mapping_dir, "goodvoxels" + ext), series.shape[:3], series.zooms[:3]
+    )
+    _copies(goodvoxels, [op.join(mapping_dir, "mean" + ext)])
+
+
+def main(argv):
+    stage, params = argv[0], parse_params(argv[1:])
+    print("Stub {} pipeline: {}".format(stage, " ".join(argv[1:])))
+    {"volume": fake_volume, "surface": fake_surface}[stage](params)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
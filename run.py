@@ -5,7 +5,25 @@ import os.path as op
 import flywheel
 
 # Note utils are from hcp-base Docker image.
-from utils import func_utils, gear_preliminaries, results
+from utils import (
+    checkpoints,
+    chunked_export,
+    derived_cache,
+    func_utils,
+    gear_preliminaries,
+    instrumentation,
+    local_scheduler,
+    multi_run,
+    packaging,
+    prediction,
+    preview,
+    qc_metrics,
+    resampling,
+    scratch,
+    stages,
+    struct_cache,
+    struct_zip,
+)
 from utils.args import (
     GenericfMRISurfaceProcessingPipeline,
     GenericfMRIVolumeProcessingPipeline,
@@ -35,7 +53,11 @@ def main():
     context.gear_dict = {}
     # Initialize all hcp-gear variables.
     gear_preliminaries.initialize_gear(context)
+    func_utils.load_gear_environ(context)
     context.log_config()
+    # Account the resources and scratch usage of every stage
+    instrumentation.start(context)
+    scratch.start(context)
 
     # Utilize FreeSurfer license from config or project metadata
     try:
@@ -51,7 +73,8 @@ def main():
     # Before continuing from here, we need to validate the config.json
     # Validate gear configuration against gear manifest
     try:
-        gear_preliminaries.validate_config_against_manifest(context)
+        with instrumentation.stage(context, "config validation"):
+            gear_preliminaries.validate_config_against_manifest(context)
     except Exception as e:
         context.log.error("Invalid Configuration:")
         context.log.exception(e)
@@ -61,9 +84,11 @@ def main():
     # Get file list and configuration from hcp-struct zipfile
     try:
         hcp_struct_zip_filename = context.get_input_path("StructZip")
-        hcp_struct_list, hcp_struct_config = gear_preliminaries.preprocess_hcp_zip(
-            hcp_struct_zip_filename
-        )
+        with instrumentation.stage(context, "StructZip preprocessing"):
+            (
+                hcp_struct_list,
+                hcp_struct_config,
+            ) = gear_preliminaries.preprocess_hcp_zip(hcp_struct_zip_filename)
         context.gear_dict["exclude_from_output"] = hcp_struct_list
         context.gear_dict["hcp_struct_config"] = hcp_struct_config
     except Exception as e:
@@ -85,48 +110,84 @@ def main():
     # Doing as much parameter checking before ANY computation.
     # Fail as fast as possible.
 
+    # Collect the fMRI runs of this invocation
     try:
-        # Build and validate from Volume Processing Pipeline
-        GenericfMRIVolumeProcessingPipeline.build(context)
-        GenericfMRIVolumeProcessingPipeline.validate(context)
+        runs = multi_run.collect_runs(context)
     except Exception as e:
         context.log.exception(e)
-        context.log.fatal("Validating Parameters for the fMRI Volume Pipeline Failed!")
+        context.log.fatal("Invalid multi-run inputs or configuration.")
         os.sys.exit(1)
 
+    if len(runs) > 1:
+        try:
+            # Build and validate every run before any computation
+            with instrumentation.stage(context, "parameter building"):
+                multi_run.build_runs(runs)
+        except Exception as e:
+            context.log.exception(e)
+            context.log.fatal("Validating Parameters for multi-run mode Failed!")
+            os.sys.exit(1)
+    else:
+        try:
+            # Build and validate from Volume Processing Pipeline
+            with instrumentation.stage(context, "parameter building"):
+                GenericfMRIVolumeProcessingPipeline.build(context)
+                GenericfMRIVolumeProcessingPipeline.validate(context)
+        except Exception as e:
+            context.log.exception(e)
+            context.log.fatal(
+                "Validating Parameters for the fMRI Volume Pipeline Failed!"
+            )
+            os.sys.exit(1)
+
+        try:
+            # Build and validate from Surface Processing Pipeline
+            with instrumentation.stage(context, "parameter building"):
+                GenericfMRISurfaceProcessingPipeline.build(context)
+                qc_metrics.build(context)
+                chunked_export.build(context)
+        except Exception as e:
+            context.log.exception(e)
+            context.log.fatal(
+                "Validating Parameters for the fMRI Surface Pipeline Failed!"
+            )
+            os.sys.exit(1)
+
+    # Predict the wall time, memory and scratch disk of the job (also in
+    # dry-run), from the input headers and the calibration table
     try:
-        # Build and validate from Surface Processing Pipeline
-        GenericfMRISurfaceProcessingPipeline.build(context)
+        job_prediction = prediction.predict(
+            runs if len(runs) > 1 else [context], multi_run.concurrency(runs)
+        )
+        prediction.write_prediction(context, job_prediction)
     except Exception as e:
         context.log.exception(e)
-        context.log.fatal("Validating Parameters for the fMRI Surface Pipeline Failed!")
-        os.sys.exit(1)
+        context.log.warning("Could not predict the resources of the job.")
 
     ###########################################################################
     # Unzip hcp-struct results
     try:
-        gear_preliminaries.unzip_hcp(context, hcp_struct_zip_filename)
+        with instrumentation.stage(context, "unzip"):
+            if context.config.get("struct-cache-dir"):
+                struct_cache.unzip_cached(context, hcp_struct_zip_filename)
+            else:
+                struct_zip.unzip_struct(context, hcp_struct_zip_filename)
     except Exception as e:
         context.log.exception(e)
         context.log.fatal("Unzipping hcp-struct zipfile failed!")
         os.sys.exit(1)
 
+    # Resume from the completed stages of a partial output zip
+    try:
+        with instrumentation.stage(context, "resume"):
+            checkpoints.resume(runs if len(runs) > 1 else [context])
+    except Exception as e:
+        context.log.exception(e)
+        context.log.fatal("Resuming from the partial output zip failed!")
+        os.sys.exit(1)
+
     # ##########################################################################
     # ##################Execute HCP Pipelines ##################################
-    # Some hcp-func specific output parameters:
-    (
-        context.gear_dict["output_config"],
-        context.gear_dict["output_config_filename"],
-    ) = func_utils.configs_to_export(context)
-
-    context.gear_dict["output_zip_name"] = op.join(
-        context.output_dir,
-        "{}_{}_hcpfunc.zip".format(
-            context.config["Subject"], context.config["fMRIName"]
-        ),
-    )
-
-    context.gear_dict["remove_files"] = func_utils.remove_intermediate_files
     ###########################################################################
     # Pipelines common commands
     QUEUE = ""
@@ -140,41 +201,93 @@ def main():
     ]
 
     context.gear_dict["command_common"] = command_common
+    if context.config["job-scheduler"] == "local":
+        # Replace fsl_sub with the cgroup-aware local scheduler
+        local_scheduler.configure(context)
+    if context.config.get("uncompressed-intermediates"):
+        # No gzip between stages: only the packaged NIfTI files are gzipped
+        packaging.defer_compression(context)
+    if context.config.get("resampling-engine", "hcp") == "gear":
+        # Batched one step resampling in place of the HCP per-volume loop
+        resampling.configure(context)
+    # Per-volume resampling intermediates deleted within fMRIVolume
+    scratch.configure(context)
+    if context.config.get("derived-cache"):
+        # Structural assets derived by the first run are reused by the next
+        derived_cache.configure(context, runs if len(runs) > 1 else [context])
+    context.gear_dict["remove_files"] = func_utils.remove_intermediate_files
+
+    # Execute and package all runs of a multi-run invocation
+    if len(runs) > 1:
+        os.sys.exit(multi_run.execute(context, runs))
+
+    # Some hcp-func specific output parameters:
+    (
+        context.gear_dict["output_config"],
+        context.gear_dict["output_config_filename"],
+    ) = func_utils.configs_to_export(context)
+
+    context.gear_dict["output_zip_name"] = op.join(
+        context.output_dir, preview.zip_name(context.config)
+    )
 
     # Execute fMRI Volume Pipeline
     try:
-        GenericfMRIVolumeProcessingPipeline.execute(context)
+        stages.run_stage(
+            context, "fMRIVolume", GenericfMRIVolumeProcessingPipeline.execute
+        )
     except Exception as e:
         context.log.exception(e)
         context.log.fatal("The fMRI Volume Pipeline Failed!")
         if context.config["save-on-error"]:
-            results.cleanup(context)
+            packaging.cleanup(context)
         os.sys.exit(1)
 
     # Execute fMRI Surface Pipeline
     try:
-        GenericfMRISurfaceProcessingPipeline.execute(context)
+        stages.run_stage(
+            context, "fMRISurface", GenericfMRISurfaceProcessingPipeline.execute
+        )
     except Exception as e:
         context.log.exception(e)
         context.log.fatal("The fMRI Surface Pipeline Failed!")
         if context.config["save-on-error"]:
-            results.cleanup(context)
+            packaging.cleanup(context)
         os.sys.exit(1)
 
     # Generate HCP-Functional QC Images
     try:
         hcpfunc_qc_mosaic.build(context)
-        hcpfunc_qc_mosaic.execute(context)
+        stages.run_stage(context, "QC", hcpfunc_qc_mosaic.execute)
     except Exception as e:
         context.log.exception(e)
         context.log.fatal("HCP Functional QC Images has failed!")
         if context.config["save-on-error"]:
-            results.cleanup(context)
+            packaging.cleanup(context)
         exit(1)
 
+    # Quantitative QC metrics, for automated screening: not fatal
+    if qc_metrics.enabled(context.config):
+        try:
+            stages.run_stage(context, "metrics", qc_metrics.execute)
+        except Exception as e:
+            context.log.exception(e)
+            context.log.warning("The QC metrics have failed. Continuing without.")
+
+    # Export the final time series in chunks, for random access
+    if chunked_export.enabled(context.config):
+        try:
+            stages.run_stage(context, "export", chunked_export.execute)
+        except Exception as e:
+            context.log.exception(e)
+            context.log.fatal("The chunked export of the time series failed!")
+            if context.config["save-on-error"]:
+                packaging.cleanup(context)
+            os.sys.exit(1)
+
     ###########################################################################
     # Clean-up and output prep
-    results.cleanup(context)
+    packaging.cleanup(context)
 
     os.sys.exit(0)
 
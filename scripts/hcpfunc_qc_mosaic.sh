@@ -23,45 +23,68 @@ qcmosaic2_2mm() {
 SubjectDIR=$1
 fMRIName=$2
 imgroot=$3
+# Optional: a single QC image to produce (default: all), and a directory for
+# its temporary files (default: the current directory)
+task=${4:-all}
+tmpdir=${5:-.}
+
+run_task() {
+  [ "$task" = "all" ] || [ "$task" = "$1" ]
+}
 
 #set -x
 
 # anat-res, EPI-to-T1acpc volume with high-res T1 edges
-qcmosaic2 ${SubjectDIR}/T1w/T1w_acpc_dc_restore ${SubjectDIR}/${fMRIName}/Scout2T1w ${imgroot}acpc_T1
+if run_task acpc_T1; then
+  qcmosaic2 ${SubjectDIR}/T1w/T1w_acpc_dc_restore ${SubjectDIR}/${fMRIName}/Scout2T1w ${imgroot}acpc_T1
+fi
 
 #qcmosaic2 ${SubjectDIR}/T1w/ribbon ${SubjectDIR}/${fMRIName}/Scout2T1w ${imgroot}acpc_T1ribbon
 
 # EPI-res, final MNI registration with low-res T1 edges (match either 2mm or 1.6mm)
-qcmosaic2_2mm ${SubjectDIR}/${fMRIName}/T1w_restore.*.nii.gz ${SubjectDIR}/${fMRIName}/${fMRIName}_SBRef_nonlin ${imgroot}mni2mm_T1
-
-# EPI-res, final MNI space, temporal mean
-qctmp="qctmp"
-${FSLDIR}/bin/fslmaths ${SubjectDIR}/MNINonLinear/Results/${fMRIName}/${fMRIName} -Tmean ${qctmp} \
-  && qcmosaic1_2mm ${qctmp} ${imgroot}mni2mm_mean \
-  && ${FSLDIR}/bin/imrm $qctmp
+if run_task mni2mm_T1; then
+  qcmosaic2_2mm ${SubjectDIR}/${fMRIName}/T1w_restore.*.nii* ${SubjectDIR}/${fMRIName}/${fMRIName}_SBRef_nonlin ${imgroot}mni2mm_T1
+fi
 
-# EPI-res, final MNI space, temporal std dev
-${FSLDIR}/bin/fslmaths ${SubjectDIR}/MNINonLinear/Results/${fMRIName}/${fMRIName} -Tstd ${qctmp} \
-  && qcmosaic1_2mm ${qctmp} ${imgroot}mni2mm_stdev \
-  && ${FSLDIR}/bin/imrm $qctmp
+# EPI-res, final MNI space, temporal mean, std dev and tSNR from a single
+# streaming pass (utils/temporal_stats.py), the tSNR map kept with the results.
+# fslmaths -Tmean and -Tstd (no tSNR) if the gear's Python modules cannot run.
+qctmp="${tmpdir}/${fMRIName}_qctmp_${task}"
+results=${SubjectDIR}/MNINonLinear/Results/${fMRIName}/${fMRIName}
+if run_task mni2mm_stats; then
+  if PYTHONPATH="${SCRIPT_DIR}/.." python3 -m utils.temporal_stats ${results} \
+    ${qctmp}_mean.nii.gz ${qctmp}_stdev.nii.gz ${results}_tSNR.nii.gz; then
+    qcmosaic1_2mm ${results}_tSNR ${imgroot}mni2mm_tsnr
+  else
+    ${FSLDIR}/bin/fslmaths ${results} -Tmean ${qctmp}_mean
+    ${FSLDIR}/bin/fslmaths ${results} -Tstd ${qctmp}_stdev
+  fi
+  qcmosaic1_2mm ${qctmp}_mean ${imgroot}mni2mm_mean
+  qcmosaic1_2mm ${qctmp}_stdev ${imgroot}mni2mm_stdev
+  ${FSLDIR}/bin/imrm ${qctmp}_mean ${qctmp}_stdev
+fi
 
 # Show EPI before and after distortion correction (to confirm correction was applied properly)
 dcdirname=${SubjectDIR}/${fMRIName}/DistortionCorrectionAndEPIToT1wReg_FLIRTBBRAndFreeSurferBBRbased
-qcfile_epiToT1_linear=${dcdirname}/epiToT1_linear.nii.gz
-qcfile_epiToT1_corrected=${dcdirname}/epiToT1_corrected.nii.gz
+qcfile_epiToT1_linear=${tmpdir}/${fMRIName}_epiToT1_linear.nii.gz
+qcfile_epiToT1_corrected=${tmpdir}/${fMRIName}_epiToT1_corrected.nii.gz
 
-${FSLDIR}/bin/applywarp --interp=spline \
-  -i ${dcdirname}/FieldMap/SBRef.nii.gz \
-  --premat=${dcdirname}/fMRI2str.mat \
-  -r ${SubjectDIR}/T1w/T1w_acpc_dc_restore_brain.nii.gz \
-  -o ${qcfile_epiToT1_linear} \
- && qcmosaic2 ${SubjectDIR}/T1w/T1w_acpc_dc_restore ${qcfile_epiToT1_linear} ${imgroot}epi2T1_uncorrected \
- && rm -f ${qcfile_epiToT1_linear}
+if run_task epi2T1_uncorrected; then
+  ${FSLDIR}/bin/applywarp --interp=spline \
+    -i ${dcdirname}/FieldMap/SBRef \
+    --premat=${dcdirname}/fMRI2str.mat \
+    -r ${SubjectDIR}/T1w/T1w_acpc_dc_restore_brain.nii.gz \
+    -o ${qcfile_epiToT1_linear} \
+   && qcmosaic2 ${SubjectDIR}/T1w/T1w_acpc_dc_restore ${qcfile_epiToT1_linear} ${imgroot}epi2T1_uncorrected \
+   && rm -f ${qcfile_epiToT1_linear}
+fi
 
-${FSLDIR}/bin/applywarp --interp=spline \
-  -i ${dcdirname}/FieldMap/SBRef_dc.nii.gz \
-  --premat=${dcdirname}/fMRI2str.mat \
-  -r ${SubjectDIR}/T1w/T1w_acpc_dc_restore_brain.nii.gz \
-  -o ${qcfile_epiToT1_corrected} \
- && qcmosaic2 ${SubjectDIR}/T1w/T1w_acpc_dc_restore ${qcfile_epiToT1_corrected} ${imgroot}epi2T1_corrected \
- && rm -f ${qcfile_epiToT1_corrected}
+if run_task epi2T1_corrected; then
+  ${FSLDIR}/bin/applywarp --interp=spline \
+    -i ${dcdirname}/FieldMap/SBRef_dc \
+    --premat=${dcdirname}/fMRI2str.mat \
+    -r ${SubjectDIR}/T1w/T1w_acpc_dc_restore_brain.nii.gz \
+    -o ${qcfile_epiToT1_corrected} \
+   && qcmosaic2 ${SubjectDIR}/T1w/T1w_acpc_dc_restore ${qcfile_epiToT1_corrected} ${imgroot}epi2T1_corrected \
+   && rm -f ${qcfile_epiToT1_corrected}
+fi
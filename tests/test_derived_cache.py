@@ -0,0 +1,131 @@
+"""
+Patching of the HCP Pipelines scripts by the derived structural asset cache
+(utils/derived_cache.py), on excerpts of OneStepResampling.sh and
+SubcorticalProcessing.sh of HCP Pipelines 4.3.0, the version of the image.
+"""
+import re
+import shutil
+import subprocess
+
+import pytest
+
+# utils.derived_cache imports the hcp-base utils through the StructZip cache
+derived_cache = pytest.importorskip("utils.derived_cache", exc_type=ImportError)
+
+ONE_STEP_RESAMPLING = r"""#!/bin/bash
+TR_vol=`${FSLDIR}/bin/fslval ${InputfMRI} pixdim4 | cut -d " " -f 1`
+NumFrames=`${FSLDIR}/bin/fslval ${InputfMRI} dim4`
+
+# Create fMRI resolution standard space files for T1w image, wmparc, and brain mask
+if [[ $(echo "${FinalfMRIResolution} == 2" | bc) == "1" ]] ; then
+    ResampRefIm=$FSLDIR/data/standard/MNI152_T1_2mm
+elif [[ $(echo "${FinalfMRIResolution} == 1" | bc) == "1" ]] ; then
+    ResampRefIm=$FSLDIR/data/standard/MNI152_T1_1mm
+else
+  ${FSLDIR}/bin/flirt -interp spline -in ${T1wImage} -ref ${T1wImage} -applyisoxfm $FinalfMRIResolution -out ${WD}/${T1wImageFile}.${FinalfMRIResolution}
+  ResampRefIm=${WD}/${T1wImageFile}.${FinalfMRIResolution}
+fi
+${FSLDIR}/bin/applywarp --rel --interp=spline -i ${T1wImage} -r ${ResampRefIm} --premat=$FSLDIR/etc/flirtsch/ident.mat -o ${WD}/${T1wImageFile}.${FinalfMRIResolution}
+
+# Create brain masks in this space from the FreeSurfer output (changing resolution)
+${FSLDIR}/bin/applywarp --rel --interp=nn -i ${FreeSurferBrainMask}.nii.gz -r ${WD}/${T1wImageFile}.${FinalfMRIResolution} --premat=$FSLDIR/etc/flirtsch/ident.mat -o ${WD}/${FreeSurferBrainMaskFile}.${FinalfMRIResolution}.nii.gz
+
+# Create versions of the biasfield (changing resolution)
+${FSLDIR}/bin/applywarp --rel --interp=spline -i ${BiasField} -r ${WD}/${FreeSurferBrainMaskFile}.${FinalfMRIResolution}.nii.gz --premat=$FSLDIR/etc/flirtsch/ident.mat -o ${WD}/${BiasFieldFile}.${FinalfMRIResolution}
+${FSLDIR}/bin/fslmaths ${WD}/${BiasFieldFile}.${FinalfMRIResolution} -thr 0.1 ${WD}/${BiasFieldFile}.${FinalfMRIResolution}
+
+# Downsample warpfield (fMRI to standard) to increase speed
+${FSLDIR}/bin/convertwarp --relout --rel --warp1=${fMRIToStructuralInput} --warp2=${StructuralToStandard} --ref=${WD}/${T1wImageFile}.${FinalfMRIResolution} --out=${OutputTransform}
+
+# Add stuff for RMS
+${FSLDIR}/bin/invwarp -w ${OutputTransform} -o ${OutputInvTransform} -r ${ScoutInputgdc}
+${FSLDIR}/bin/applywarp --rel --interp=nn -i ${FreeSurferBrainMask}.nii.gz -r ${ScoutInputgdc} -w ${OutputInvTransform} -o ${ScoutInputgdc}_mask.nii.gz
+"""
+
+SUBCORTICAL_PROCESSING = r"""#!/bin/bash
+if [ 1 -eq `echo "$GrayordinatesResolution == $FinalfMRIResolution" | bc -l` ] ; then
+    log_Msg "Creating subcortical ROI volume in original fMRI resolution"
+    ${CARET7DIR}/wb_command -volume-label-import "$AtlasSpaceFolder"/ROIs/Atlas_ROIs."$GrayordinatesResolution".nii.gz "$HCPPIPEDIR_Config"/FreeSurferSubcorticalLabelTableLut.txt "$ResultsFolder"/ROIs."$GrayordinatesResolution".nii.gz -discard-others
+else
+    log_Msg "Creating subcortical ROI volume in original fMRI resolution"
+    applywarp --interp=nn -i "$AtlasSpaceFolder"/wmparc.nii.gz -r "$VolumefMRI" -o "$ResultsFolder"/wmparc."$FinalfMRIResolution"
+    ${CARET7DIR}/wb_command -volume-label-import "$ResultsFolder"/wmparc."$FinalfMRIResolution".nii.gz "$HCPPIPEDIR_Config"/FreeSurferSubcorticalLabelTableLut.txt "$ResultsFolder"/ROIs."$FinalfMRIResolution".nii.gz -discard-others
+    rm "$ResultsFolder"/wmparc."$FinalfMRIResolution".nii.gz
+    applywarp --interp=nn -i "$AtlasSpaceFolder"/ROIs/Atlas_ROIs."$GrayordinatesResolution".nii.gz -r "$VolumefMRI" -o "$ResultsFolder"/Atlas_ROIs."$FinalfMRIResolution"
+fi
+"""
+
+SCRIPTS = {
+    "OneStepResampling.sh": ONE_STEP_RESAMPLING,
+    "SubcorticalProcessing.sh": SUBCORTICAL_PROCESSING,
+}
+
+# Outputs of the commands cached, as written in the scripts
+EXPECTED = {
+    "OneStepResampling.sh": [
+        "${WD}/${T1wImageFile}.${FinalfMRIResolution}",
+        "${WD}/${T1wImageFile}.${FinalfMRIResolution}",
+        "${WD}/${FreeSurferBrainMaskFile}.${FinalfMRIResolution}.nii.gz",
+        "${WD}/${BiasFieldFile}.${FinalfMRIResolution}",
+    ],
+    "SubcorticalProcessing.sh": [
+        '"$ResultsFolder"/wmparc."$FinalfMRIResolution"',
+        '"$ResultsFolder"/Atlas_ROIs."$FinalfMRIResolution"',
+    ],
+}
+
+WRAPPED = re.compile(r"^\s*hcpfunc_derived ([0-9a-f]{16}) (\S+) -- (.*)$")
+
+
+def _patched(script):
+    for _, name, outputs in derived_cache.DERIVED_COMMANDS:
+        if name == script:
+            return derived_cache.patch_script(SCRIPTS[script], script, outputs)
+    raise KeyError(script)
+
+
+@pytest.mark.parametrize("script", sorted(SCRIPTS))
+def test_patch_script(script):
+    text = SCRIPTS[script]
+    patched = _patched(script)
+    lines = patched.splitlines()
+    assert lines[0] == "#!/bin/bash"
+    assert lines[1].startswith("hcpfunc_derived() {")
+
+    wrapped = [WRAPPED.match(line) for line in lines[2:]]
+    wrapped = [match for match in wrapped if match is not None]
+    assert [match.group(2) for match in wrapped] == EXPECTED[script]
+    for match in wrapped:
+        # The command is run unchanged, from its original line
+        assert match.group(3) + "\n" in text
+        assert match.group(2) in match.group(3)
+    command_ids = [match.group(1) for match in wrapped]
+    assert len(set(command_ids)) == len(command_ids)
+    # Every other line is unchanged
+    unchanged = [line for line in lines[2:] if WRAPPED.match(line) is None]
+    assert len(unchanged) + len(wrapped) == len(text.splitlines()) - 1
+    assert all(line in text.splitlines() for line in unchanged)
+
+
+def test_five_structural_outputs_cached():
+    outputs = set()
+    for script in SCRIPTS:
+        for line in _patched(script).splitlines():
+            match = WRAPPED.match(line)
+            if match is not None:
+                outputs.add(re.sub(r'["{}$]', "", match.group(2)))
+    assert outputs == {
+        "WD/T1wImageFile.FinalfMRIResolution",
+        "WD/FreeSurferBrainMaskFile.FinalfMRIResolution.nii.gz",
+        "WD/BiasFieldFile.FinalfMRIResolution",
+        "ResultsFolder/wmparc.FinalfMRIResolution",
+        "ResultsFolder/Atlas_ROIs.FinalfMRIResolution",
+    }
+
+
+@pytest.mark.skipif(shutil.which("bash") is None, reason="bash is not installed")
+@pytest.mark.parametrize("script", sorted(SCRIPTS))
+def test_patched_script_syntax(tmp_path, script):
+    filename = tmp_path / script
+    filename.write_text(_patched(script))
+    subprocess.check_call(["bash", "-n", str(filename)])
@@ -0,0 +1,128 @@
+"""
+Round trips of the streaming zip writer (utils/packaging.py) through the
+standard library zipfile module, and of the exclusion index.
+"""
+import gzip
+import os
+import zipfile
+
+import pytest
+
+# utils.packaging imports the hcp-base utils through its checkpoints
+packaging = pytest.importorskip("utils.packaging", exc_type=ImportError)
+
+TEXT = b"hcp-func packaging round trip\n" * 2000
+
+
+def _members(directory, files):
+    """
+    Write `files` ({arcname: bytes}) under `directory`.
+    Returns:
+        list: (path, arcname) tuples.
+    """
+    members = []
+    for arcname, data in files.items():
+        path = os.path.join(str(directory), arcname)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as fp:
+            fp.write(data)
+        members.append((path, arcname))
+    return members
+
+
+def _round_trip(tmp_path, files, **kwargs):
+    members = _members(tmp_path / "src", files)
+    zip_filename = str(tmp_path / "out.zip")
+    manifest = packaging.write_zip(zip_filename, members, workers=2, **kwargs)
+    archive = zipfile.ZipFile(zip_filename)
+    assert archive.testzip() is None
+    assert manifest["size"] == os.path.getsize(zip_filename)
+    infos = archive.infolist()
+    assert [member["name"] for member in manifest["members"]] == [
+        info.filename for info in infos
+    ]
+    for member, info in zip(manifest["members"], infos):
+        assert member["offset"] == info.header_offset
+        assert member["size"] == info.file_size
+        assert member["compress_size"] == info.compress_size
+    return archive
+
+
+def test_stored_and_deflated(tmp_path):
+    random_bytes = os.urandom(64 * 1024)
+    files = {
+        "sub/text.txt": TEXT,
+        "sub/image.png": TEXT,
+        "sub/random.bin": random_bytes,
+        "sub/empty.txt": b"",
+    }
+    archive = _round_trip(tmp_path, files)
+    methods = {info.filename: info.compress_type for info in archive.infolist()}
+    assert methods["sub/text.txt"] == zipfile.ZIP_DEFLATED
+    # Already compressed by extension, and incompressible
+    assert methods["sub/image.png"] == zipfile.ZIP_STORED
+    assert methods["sub/random.bin"] == zipfile.ZIP_STORED
+    for arcname, data in files.items():
+        assert archive.read(arcname) == data
+
+
+def test_gzip_nifti(tmp_path):
+    files = {
+        "sub/bold.nii": TEXT,
+        "sub/bold.dtseries.nii": TEXT,
+        "sub/mask.nii.gz": gzip.compress(TEXT),
+    }
+    archive = _round_trip(tmp_path, files, gzip_nifti=True)
+    assert sorted(archive.namelist()) == [
+        "sub/bold.dtseries.nii",
+        "sub/bold.nii.gz",
+        "sub/mask.nii.gz",
+    ]
+    assert gzip.decompress(archive.read("sub/bold.nii.gz")) == TEXT
+    # CIFTI files are never gzipped
+    assert archive.read("sub/bold.dtseries.nii") == TEXT
+    assert archive.read("sub/mask.nii.gz") == files["sub/mask.nii.gz"]
+
+
+def test_utf8_names(tmp_path):
+    files = {"sub/café/résumé.txt": TEXT, "sub/plain.txt": TEXT}
+    archive = _round_trip(tmp_path, files)
+    for info in archive.infolist():
+        assert bool(info.flag_bits & 0x800) == (info.filename != "sub/plain.txt")
+        assert archive.read(info) == TEXT
+
+
+def test_forced_zip64(tmp_path, monkeypatch):
+    # Every size and offset past the lowered limit takes a zip64 record
+    monkeypatch.setattr(packaging, "ZIP64_LIMIT", 1000)
+    files = {
+        "sub/a.txt": TEXT,
+        "sub/b.png": TEXT,
+        "sub/small.txt": b"small",
+        "sub/c.txt": TEXT,
+    }
+    archive = _round_trip(tmp_path, files)
+    infos = archive.infolist()
+    assert infos[-1].header_offset > 1000
+    assert infos[0].file_size > 1000
+    assert all(info.extra for info in infos if info.header_offset > 1000)
+    with open(archive.filename, "rb") as fp:
+        # Zip64 end of central directory record and locator
+        assert b"PK\x06\x06" in fp.read()
+    for arcname, data in files.items():
+        assert archive.read(arcname) == data
+
+
+def test_exclusion_index():
+    index = packaging.ExclusionIndex(
+        ["sub/T1w/T1w.nii.gz"], ["sub/T1w/xfms/", "/sub/MNINonLinear/ROIs"]
+    )
+    assert "sub/T1w/T1w.nii.gz" in index
+    assert "sub/T1w/xfms/acpc.mat" in index
+    assert "sub/T1w/xfms/deeper/warp.nii.gz" in index
+    assert "sub/MNINonLinear/ROIs/Atlas_ROIs.2.nii.gz" in index
+    # Prefixes match whole path components only
+    assert "sub/T1w/xfms2/acpc.mat" not in index
+    assert "sub/T1w/T1w_restore.nii.gz" not in index
+    assert "sub/T1w" not in index
+    assert "sub/MNINonLinear/Results/rfMRI/bold.nii.gz" not in index
@@ -0,0 +1,241 @@
+"""
+Tests of the batched one step resampling engine (utils/resampling.py) on a
+small synthetic series. The regression test against the per-volume loop of
+OneStepResampling.sh runs its FSL commands on the same inputs, and is skipped
+where FSL is not installed.
+"""
+import functools
+import multiprocessing
+import shutil
+import subprocess
+from concurrent.futures import ProcessPoolExecutor
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from utils import imaging, resampling
+
+SHAPE = (12, 10, 8)
+FRAMES = 5
+ZOOM = 2.0
+PREFIX = "MAT_"
+FSL_COMMANDS = ["convertwarp", "applywarp"]
+
+
+def _affine(neurological):
+    affine = np.diag([ZOOM, ZOOM, ZOOM, 1.0])
+    if not neurological:
+        affine[0, 0] = -ZOOM
+        affine[0, 3] = ZOOM * (SHAPE[0] - 1)
+    return affine
+
+
+def _save(data, affine, filename):
+    img = nib.Nifti1Image(np.asarray(data, dtype=np.float32), affine)
+    img.set_sform(affine, 1)
+    img.set_qform(affine, 1)
+    if data.ndim == 4:
+        img.header.set_zooms((ZOOM, ZOOM, ZOOM, 1.0))
+    nib.save(img, filename)
+    return filename
+
+
+def _series():
+    """
+    A smooth series, away from 0 inside the field of view.
+    """
+    i, j, k = np.meshgrid(*[np.arange(n) for n in SHAPE], indexing="ij")
+    base = 1000 + 200 * np.sin(i / 3.0) * np.cos(j / 4.0) + 20 * k
+    return np.stack([base * (1 + 0.01 * frame) for frame in range(FRAMES)], axis=-1)
+
+
+def _translation(x, y=0.0, z=0.0):
+    matrix = np.eye(4)
+    matrix[:3, 3] = [x, y, z]
+    return matrix
+
+
+def _inputs(directory, matrices, warp=None, neurological=False):
+    """
+    Files and OneStepResampling.sh arguments of the synthetic series, on the
+    grid of the reference.
+    Returns:
+        tuple: (arguments, series data)
+    """
+    affine = _affine(neurological)
+    series = _series()
+    _save(series, affine, str(directory / "fmri.nii.gz"))
+    _save(np.ones(SHAPE), affine, str(directory / "T1w_restore.2.nii.gz"))
+    if warp is None:
+        warp = np.zeros(SHAPE + (3,))
+    _save(warp, affine, str(directory / "owarp.nii.gz"))
+    matrix_dir = directory / "mats"
+    matrix_dir.mkdir()
+    for frame, matrix in enumerate(matrices):
+        np.savetxt(str(matrix_dir / "{}{:04d}".format(PREFIX, frame)), matrix)
+    params = {
+        "workingdir": str(directory),
+        "t1": str(directory / "T1w_restore.nii.gz"),
+        "fmriresout": "2",
+        "infmri": str(directory / "fmri.nii.gz"),
+        "owarp": str(directory / "owarp.nii.gz"),
+        "gdfield": "NONE",
+        "motionmatdir": str(matrix_dir),
+        "motionmatprefix": PREFIX,
+        "ofmri": str(directory / "engine"),
+    }
+    return params, series
+
+
+def _resampled(params):
+    return np.asanyarray(nib.load(params["ofmri"] + ".nii.gz").dataobj)
+
+
+def test_vox2mm_flips_x_of_neurological_images():
+    neurological = nib.Nifti1Image(np.zeros(SHAPE), _affine(True))
+    radiological = nib.Nifti1Image(np.zeros(SHAPE), _affine(False))
+    voxel = np.array([1, 2, 3, 1])
+    x_last = ZOOM * (SHAPE[0] - 1)
+    flipped = imaging.fsl_vox2mm(neurological).dot(voxel)
+    assert np.allclose(flipped, [x_last - 2, 4, 6, 1])
+    assert np.allclose(imaging.fsl_vox2mm(radiological).dot(voxel), [2, 4, 6, 1])
+
+
+def test_identity(tmp_path):
+    params, series = _inputs(tmp_path, [np.eye(4)] * FRAMES)
+    resampling.resample(params, workers=2)
+    assert np.allclose(_resampled(params), series, rtol=1e-4)
+    mask = np.asanyarray(nib.load(params["ofmri"] + "_mask.nii.gz").dataobj)
+    assert mask.all()
+
+
+@pytest.mark.parametrize("neurological", [False, True])
+def test_motion_translation(tmp_path, neurological):
+    # MAT_k maps volume k to the reference: the content moves by +1 voxel
+    # along FSL x, which is -i for neurological storage
+    params, series = _inputs(
+        tmp_path, [_translation(ZOOM)] * FRAMES, neurological=neurological
+    )
+    resampling.resample(params, workers=1)
+    resampled = _resampled(params)
+    if neurological:
+        assert np.allclose(resampled[:-1], series[1:], rtol=1e-4)
+        assert not resampled[-1].any()
+    else:
+        assert np.allclose(resampled[1:], series[:-1], rtol=1e-4)
+        assert not resampled[0].any()
+
+
+def test_relative_warp(tmp_path):
+    # A relative warp of +1 voxel along FSL x samples the next voxel
+    warp = np.zeros(SHAPE + (3,))
+    warp[..., 0] = ZOOM
+    params, series = _inputs(tmp_path, [np.eye(4)] * FRAMES, warp=warp)
+    resampling.resample(params, workers=1)
+    resampled = _resampled(params)
+    assert np.allclose(resampled[:-1], series[1:], rtol=1e-4)
+
+
+def test_spawned_workers(tmp_path, monkeypatch):
+    # Workers get the transforms from the pool initializer, not by forking
+    params, series = _inputs(tmp_path, [np.eye(4)] * FRAMES)
+    spawn = multiprocessing.get_context("spawn")
+    monkeypatch.setattr(
+        resampling,
+        "ProcessPoolExecutor",
+        functools.partial(ProcessPoolExecutor, mp_context=spawn),
+    )
+    resampling.resample(params, workers=2)
+    assert np.allclose(_resampled(params), series, rtol=1e-4)
+
+
+def test_compare(tmp_path):
+    affine = _affine(False)
+    series = _series()
+    reference = _save(series, affine, str(tmp_path / "reference.nii.gz"))
+    same = _save(series, affine, str(tmp_path / "same.nii.gz"))
+    scaled = _save(series * 1.05, affine, str(tmp_path / "scaled.nii.gz"))
+    result = resampling.compare(reference, same)
+    assert result["relative_rms"] < 1e-6 and result["within_tolerance"]
+    result = resampling.compare(reference, scaled)
+    assert result["relative_rms"] == pytest.approx(0.05, rel=1e-3)
+    assert not result["within_tolerance"]
+
+
+def _fsl_loop(params, frames):
+    """
+    The per-volume loop of OneStepResampling.sh (without gradient distortion
+    correction) on the inputs of `params`, written as "<workingdir>/hcp".
+    """
+    directory = params["workingdir"]
+    reference = "{}/T1w_restore.2.nii.gz".format(directory)
+    series = nib.load(params["infmri"])
+    volumes = []
+    for frame in range(frames):
+        volume = "{}/vol{:04d}.nii.gz".format(directory, frame)
+        nib.save(series.slicer[..., frame], volume)
+        matrix = "{}/{}{:04d}".format(params["motionmatdir"], PREFIX, frame)
+        gdc_warp = "{}/vol{:04d}_gdc_warp.nii.gz".format(directory, frame)
+        all_warp = "{}/vol{:04d}_all_warp.nii.gz".format(directory, frame)
+        output = "{}/post{:04d}.nii.gz".format(directory, frame)
+        for command in [
+            [
+                "convertwarp",
+                "--relout",
+                "--rel",
+                "--ref=" + volume,
+                "--postmat=" + matrix,
+                "--out=" + gdc_warp,
+            ],
+            [
+                "convertwarp",
+                "--relout",
+                "--rel",
+                "--ref=" + reference,
+                "--warp1=" + gdc_warp,
+                "--warp2=" + params["owarp"],
+                "--out=" + all_warp,
+            ],
+            [
+                "applywarp",
+                "--rel",
+                "--interp=spline",
+                "--in=" + volume,
+                "--warp=" + all_warp,
+                "--ref=" + reference,
+                "--out=" + output,
+            ],
+        ]:
+            subprocess.check_call(command)
+        volumes.append(np.asanyarray(nib.load(output).dataobj))
+    hcp = "{}/hcp.nii.gz".format(directory)
+    _save(np.stack(volumes, axis=-1), nib.load(reference).affine, hcp)
+    return hcp
+
+
+@pytest.mark.skipif(
+    not all(shutil.which(command) for command in FSL_COMMANDS),
+    reason="FSL is not installed",
+)
+@pytest.mark.parametrize("neurological", [False, True])
+def test_matches_fsl(tmp_path, neurological):
+    angle = np.deg2rad(2.0)
+    matrices = []
+    for frame in range(FRAMES):
+        matrix = _translation(0.4 * frame, -0.3, 0.2)
+        rotation = angle * frame / FRAMES
+        matrix[:2, :2] = [
+            [np.cos(rotation), -np.sin(rotation)],
+            [np.sin(rotation), np.cos(rotation)],
+        ]
+        matrices.append(matrix)
+    i, j, _ = np.meshgrid(*[np.arange(n) for n in SHAPE], indexing="ij")
+    warp = np.zeros(SHAPE + (3,))
+    warp[..., 0] = 0.6 * np.sin(j / 3.0)
+    warp[..., 1] = -0.4 * np.cos(i / 4.0)
+    params, _ = _inputs(tmp_path, matrices, warp=warp, neurological=neurological)
+    reference = _fsl_loop(params, FRAMES)
+    resampling.resample(params, workers=2)
+    result = resampling.compare(reference, params["ofmri"] + ".nii.gz")
+    assert result["within_tolerance"], result
@@ -0,0 +1,70 @@
+"""
+Deletion of the per-volume intermediates of OneStepResampling.sh within
+fMRIVolume (utils/scratch.py), on an excerpt of its loop (HCP Pipelines 4.3.0).
+"""
+import shutil
+import subprocess
+
+import pytest
+
+from utils import resampling, scratch
+
+ONE_STEP_RESAMPLING = r"""#!/bin/bash
+mkdir -p ${WD}/prevols
+mkdir -p ${WD}/postvols
+${FSLDIR}/bin/fslsplit ${InputfMRI} ${WD}/prevols/vol -t
+FrameMergeSTRING=""
+FrameMergeSTRINGII=""
+k=0
+while [ $k -lt $NumFrames ] ; do
+  vnum=`${FSLDIR}/bin/zeropad $k 4`
+  ${FSLDIR}/bin/convertwarp --relout --rel --ref=${WD}/prevols/vol${vnum}.nii.gz --warp1=${GradientDistortionField} --postmat=${MotionMatrixFolder}/${MotionMatrixPrefix}${vnum} --out=${MotionMatrixFolder}/${MotionMatrixPrefix}${vnum}_gdc_warp.nii.gz
+  ${FSLDIR}/bin/convertwarp --relout --rel --ref=${WD}/${T1wImageFile}.${FinalfMRIResolution} --warp1=${MotionMatrixFolder}/${MotionMatrixPrefix}${vnum}_gdc_warp.nii.gz --warp2=${OutputTransform} --out=${MotionMatrixFolder}/${MotionMatrixPrefix}${vnum}_all_warp.nii.gz
+  ${FSLDIR}/bin/applywarp --rel --interp=spline --in=${WD}/prevols/vol${vnum}.nii.gz --warp=${MotionMatrixFolder}/${MotionMatrixPrefix}${vnum}_all_warp.nii.gz --ref=${WD}/${T1wImageFile}.${FinalfMRIResolution} --out=${WD}/postvols/vol${vnum}.nii.gz
+  ${FSLDIR}/bin/fslmaths ${WD}/prevols/vol${vnum}.nii.gz -mul 0 -add 1 ${WD}/prevols/vol${vnum}_mask.nii.gz
+  ${FSLDIR}/bin/applywarp --rel --interp=nn --in=${WD}/prevols/vol${vnum}_mask.nii.gz --warp=${MotionMatrixFolder}/${MotionMatrixPrefix}${vnum}_all_warp.nii.gz --ref=${WD}/${T1wImageFile}.${FinalfMRIResolution} --out=${WD}/postvols/vol${vnum}_mask.nii.gz
+  FrameMergeSTRING="${FrameMergeSTRING}${WD}/postvols/vol${vnum}.nii.gz "
+  FrameMergeSTRINGII="${FrameMergeSTRINGII}${WD}/postvols/vol${vnum}_mask.nii.gz "
+  k=`echo "$k + 1" | bc`
+done
+# Merge together results and restore the TR (saved beforehand)
+${FSLDIR}/bin/fslmerge -tr ${OutputfMRI} $FrameMergeSTRING $TR_vol
+${FSLDIR}/bin/fslmerge -tr ${OutputfMRI}_mask $FrameMergeSTRINGII $TR_vol
+fslmaths ${OutputfMRI}_mask -Tmin ${OutputfMRI}_mask
+"""
+
+CLEANUP = [
+    "rm -rf ${WD}/prevols ${WD}/postvols",
+    "rm -f ${MotionMatrixFolder}/${MotionMatrixPrefix}*_gdc_warp.nii* "
+    "${MotionMatrixFolder}/${MotionMatrixPrefix}*_all_warp.nii*",
+]
+
+
+def test_patch_script():
+    lines = scratch.patch_script(ONE_STEP_RESAMPLING).splitlines()
+    merge = lines.index(
+        "${FSLDIR}/bin/fslmerge -tr ${OutputfMRI}_mask $FrameMergeSTRINGII $TR_vol"
+    )
+    assert lines[merge + 2 : merge + 4] == CLEANUP
+    # Deleted after the merges, before the rest of the script
+    assert lines[merge + 4] == "fslmaths ${OutputfMRI}_mask -Tmin ${OutputfMRI}_mask"
+    original = ONE_STEP_RESAMPLING.splitlines()
+    assert lines[: merge + 1] == original[: merge + 1]
+    assert len(lines) == len(original) + 3
+
+
+def test_composes_with_resampling_engine():
+    # Nothing to delete once the loop is replaced by the engine
+    engine = resampling.patch_script(ONE_STEP_RESAMPLING)
+    assert scratch.patch_script(engine) is None
+    # The engine replaces the loop of a script patched first
+    patched = resampling.patch_script(scratch.patch_script(ONE_STEP_RESAMPLING))
+    assert "utils.resampling" in patched
+    assert "fslsplit" not in patched
+
+
+@pytest.mark.skipif(shutil.which("bash") is None, reason="bash is not installed")
+def test_patched_script_syntax(tmp_path):
+    filename = tmp_path / "OneStepResampling.sh"
+    filename.write_text(scratch.patch_script(ONE_STEP_RESAMPLING))
+    subprocess.check_call(["bash", "-n", str(filename)])
@@ -0,0 +1,22 @@
+"""
+Tests of the single-pass temporal statistics (utils/temporal_stats.py), as
+run by the QC script.
+"""
+import nibabel as nib
+import numpy as np
+
+from utils import temporal_stats
+
+
+def test_main_writes_mean_std_and_tsnr(tmp_path):
+    rng = np.random.default_rng(0)
+    data = 100 + rng.standard_normal((6, 5, 4, 12)).astype(np.float32)
+    data[0, 0, 0] = 0
+    nib.save(nib.Nifti1Image(data, np.eye(4)), str(tmp_path / "series.nii.gz"))
+    maps = [str(tmp_path / name) for name in ["mean.nii", "std.nii", "tsnr.nii"]]
+    assert temporal_stats.main([str(tmp_path / "series")] + maps) == 0
+    mean, std, tsnr = [np.asanyarray(nib.load(name).dataobj) for name in maps]
+    assert np.allclose(mean, data.mean(axis=-1), rtol=1e-5)
+    assert np.allclose(std, data.std(axis=-1, ddof=1), rtol=1e-4)
+    assert np.allclose(tsnr[1:], mean[1:] / std[1:], rtol=1e-4)
+    assert tsnr[0, 0, 0] == 0
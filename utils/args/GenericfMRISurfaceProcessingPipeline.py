@@ -6,11 +6,17 @@ part of the hcp-func gear
 import logging
 import os.path as op
 
+from utils import preview
+
 # Note common is available from hcp-base, once the Docker image is pulled.
-from .common import build_command_list, exec_command
+from .common import build_command_list
+from .streaming import exec_command
 
 log = logging.getLogger(__name__)
 
+# LowResMesh of the CIFTI grayordinates of each GrayordinatesResolution
+GRAYORDINATES_MESH = {"2": "32", "1.60": "59"}
+
 
 def build(context):
     """
@@ -26,13 +32,21 @@ def build(context):
     params["subject"] = config["Subject"]
     params["fmriname"] = config["fMRIName"]
     # LowResMesh usually 32k vertices ("59" = 1.60mm)
-    params["lowresmesh"] = "32"
-    # ****config option?****** #generally "2", "1.60" possible
-    params["fmrires"] = "2"
+    params["lowresmesh"] = config["LowResMesh"]
+    # Generally "2", "1.60" possible; coarser for a preview
+    params["fmrires"] = preview.final_resolution(config)
     # Smoothing during CIFTI surface and subcortical resampling
-    params["smoothingFWHM"] = params["fmrires"]
+    params["smoothingFWHM"] = "{:g}".format(config["SmoothingFWHM"])
     # GrayordinatesResolution usually 2mm ("1.60" also available)
-    params["grayordinatesres"] = "2"
+    params["grayordinatesres"] = config["GrayordinatesResolution"]
+    # The grayordinates of each resolution are defined on one mesh
+    if GRAYORDINATES_MESH[params["grayordinatesres"]] != params["lowresmesh"]:
+        raise Exception(
+            'GrayordinatesResolution "{}" requires LowResMesh "{}".'.format(
+                params["grayordinatesres"],
+                GRAYORDINATES_MESH[params["grayordinatesres"]],
+            )
+        )
     # The func gear configuration overides the struct configuration
     # else use the struct configuration.
     if config["RegName"] != "Empty":
@@ -2,7 +2,7 @@
 Builds, validates, and excecutes parameters for the HCP script 
 /opt/HCP-Pipelines/fMRIVolume/GenericfMRIVolumeProcessingPipeline.sh
 part of the hcp-func gear
-NOTE: the `utils.gear_preliminaries` module is in the `hcp-base` code
+NOTE: the `utils.args.common` module is in the `hcp-base` code
 """
 import logging
 import os
@@ -11,9 +11,11 @@ import re
 from collections import OrderedDict
 
 from tr import tr
-from utils.gear_preliminaries import create_sanitized_filepath
+from utils import preflight, preview
+from utils.staging import stage_input
 
-from .common import build_command_list, exec_command
+from .common import build_command_list
+from .streaming import exec_command
 
 log = logging.getLogger(__name__)
 
@@ -62,13 +64,15 @@ def build(context):
     # this is set in utils/gear_preliminaries.py:set_subject.
     params["subject"] = config["Subject"]
     params["fmriname"] = config["fMRIName"]
-    params["fmritcs"] = context.get_input_path("fMRITimeSeries")
+    if preview.enabled(config):
+        # A subset of the volumes, written before execution
+        params["fmritcs"] = preview.series_filename(context)
+    else:
+        params["fmritcs"] = stage_input(context, "fMRITimeSeries")
 
     # TODO: confirm parameters match fMRITimeSeries?
     if "fMRIScout" in inputs.keys():
-        params["fmriscout"] = create_sanitized_filepath(
-            context.get_input_path("fMRIScout")
-        )
+        params["fmriscout"] = stage_input(context, "fMRIScout")
 
     # Read necessary acquisition params from fMRI
     obj = inputs["fMRITimeSeries"]["object"]
@@ -78,8 +82,8 @@ def build(context):
     if "PhaseEncodingDirection" in obj["info"].keys():
         params["unwarpdir"] = tr("ijk", "xyz", obj["info"]["PhaseEncodingDirection"])
 
-    # TODO: **??config option??** #generally "2", but "1.60" an option
-    params["fmrires"] = "2"
+    # Generally "2", "1.60" possible; coarser for a preview
+    params["fmrires"] = preview.final_resolution(config)
 
     params["biascorrection"] = config["BiasCorrection"]
 
@@ -92,12 +96,8 @@ def build(context):
     if ("SiemensGREMagnitude" in inputs.keys()) and (
         "SiemensGREPhase" in inputs.keys()
     ):
-        params["fmapmag"] = create_sanitized_filepath(
-            context.get_input_path("SiemensGREMagnitude")
-        )
-        params["fmapphase"] = create_sanitized_filepath(
-            context.get_input_path("SiemensGREPhase")
-        )
+        params["fmapmag"] = stage_input(context, "SiemensGREMagnitude")
+        params["fmapphase"] = stage_input(context, "SiemensGREPhase")
         params["dcmethod"] = "SiemensFieldMap"
         params["topupconfig"] = "NONE"
 
@@ -113,12 +113,8 @@ def build(context):
         "SpinEchoPositive" in inputs.keys()
     ):
         params["dcmethod"] = "TOPUP"
-        SpinEchoPhase1 = create_sanitized_filepath(
-            context.get_input_path("SpinEchoPositive")
-        )
-        SpinEchoPhase2 = create_sanitized_filepath(
-            context.get_input_path("SpinEchoNegative")
-        )
+        SpinEchoPhase1 = stage_input(context, "SpinEchoPositive")
+        SpinEchoPhase2 = stage_input(context, "SpinEchoNegative")
         # Topup config if using TOPUP, set to NONE if using regular FIELDMAP
         params["topupconfig"] = environ["HCPPIPEDIR_Config"] + "/b02b0.cnf"
         if (
@@ -169,9 +165,7 @@ def build(context):
         raise Exception("Cannot currently handle GeneralElectricFieldmap!")
 
     if "GradientCoeff" in inputs.keys():
-        params["gdcoeffs"] = create_sanitized_filepath(
-            context.get_input_path("GradientCoeff")
-        )
+        params["gdcoeffs"] = stage_input(context, "GradientCoeff")
 
     params["printcom"] = " "
 
@@ -280,6 +274,9 @@ def validate(context):
     elif "GeneralElectricFieldMap" in inputs.keys():
         raise Exception("Cannot currently handle GeneralElectricFieldmap!")
 
+    # Check the geometry of the NIfTI inputs from their headers only
+    preflight.validate_inputs(context)
+
 
 def execute(context):
     # We want to take care of delivering the directory structure right away
@@ -287,6 +284,8 @@ def execute(context):
     environ = context.gear_dict["environ"]
     config = context.config
     os.makedirs(context.work_dir + "/" + config["Subject"], exist_ok=True)
+    if preview.enabled(config) and not config["dry-run"]:
+        preview.write_series(context)
 
     # Start by building command to execute
     command = []
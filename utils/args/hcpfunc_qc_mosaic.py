@@ -4,14 +4,40 @@ Builds, validates, and excecutes parameters for the HCP helper script
 part of the hcp-func gear
 """
 import logging
-import os
+import multiprocessing
 import os.path as op
+import shutil
+import tempfile
+import time
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-from .common import build_command_list, exec_command
+from utils import func_utils, instrumentation
+
+from .common import build_command_list
+from .streaming import exec_command
 
 log = logging.getLogger(__name__)
 
+try:
+    # numpy and nibabel are only needed by the in-process renderer
+    from utils import qc_render
+except ImportError as e:
+    log.warning("In-process QC renderer unavailable: %s", e)
+    qc_render = None
+
+# Independent QC tasks and the hcpfunc_qc_mosaic.sh tasks producing the same
+# images. "mni2mm_stats" is a single streaming pass with either renderer.
+QC_TASKS = OrderedDict(
+    [
+        ("acpc_T1", ["acpc_T1"]),
+        ("mni2mm_T1", ["mni2mm_T1"]),
+        ("mni2mm_stats", ["mni2mm_stats"]),
+        ("epi2T1_uncorrected", ["epi2T1_uncorrected"]),
+        ("epi2T1_corrected", ["epi2T1_corrected"]),
+    ]
+)
+
 
 def build(context):
     config = context.config
@@ -26,21 +52,124 @@ def build(context):
     context.gear_dict["QC-Params"] = params
 
 
-def execute(context):
+def _execute_script(context, task):
+    """
+    Produce one image with hcpfunc_qc_mosaic.sh, in a private temporary
+    directory.
+    """
+    config = context.config
+    tmp_dir = tempfile.mkdtemp(
+        prefix="qc_{}_{}_".format(config["fMRIName"], task), dir=context.work_dir
+    )
     SCRIPT_DIR = context.gear_dict["SCRIPT_DIR"]
-    command = [op.join(SCRIPT_DIR, "hcpfunc_qc_mosaic.sh")]
+    command = ["cd", tmp_dir, "&&", op.join(SCRIPT_DIR, "hcpfunc_qc_mosaic.sh")]
 
     command = build_command_list(
         command, context.gear_dict["QC-Params"], include_keys=False
     )
-
-    command.append(">")
-    command.append(op.join(context.work_dir, "logs", "functionalqc.log"))
+    command.extend([task, tmp_dir])
 
     stdout_msg = (
         "Pipeline logs (stdout, stderr) will be available "
         + 'in the file "pipeline_logs.zip" upon completion.'
     )
 
-    log.info("Functional QC Image Generation command: \n")
-    exec_command(context, command, shell=True, stdout_msg=stdout_msg)
+    log.info("Functional QC Image Generation command (%s): \n", task)
+    try:
+        exec_command(
+            context,
+            command,
+            shell=True,
+            stdout_msg=stdout_msg,
+            log_name="functionalqc_{}_{}".format(config["fMRIName"], task),
+        )
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _execute_task(context, name, process_pool):
+    """
+    Run one QC task, in-process (in `process_pool`) if available, otherwise or
+    on failure with the script.
+    Returns:
+        dict: task record with renderer, status, and elapsed seconds.
+    """
+    record = OrderedDict([("task", name), ("renderer", "python")])
+    start = time.time()
+    try:
+        if process_pool is not None:
+            try:
+                if not context.config["dry-run"]:
+                    params = dict(context.gear_dict["QC-Params"])
+                    process_pool.submit(qc_render.render_task, name, params).result()
+                record["status"] = "success"
+                return record
+            except Exception as e:
+                log.exception(e)
+                log.warning(
+                    "In-process QC task %s failed. Falling back to script.", name
+                )
+
+        record["renderer"] = "script"
+        for task in QC_TASKS[name]:
+            _execute_script(context, task)
+        record["status"] = "success"
+    except Exception as e:
+        log.exception(e)
+        record["status"] = "failed"
+        record["error"] = str(e)
+    finally:
+        record["seconds"] = round(time.time() - start, 2)
+    return record
+
+
+def _execute_task_measured(context, name, process_pool):
+    with instrumentation.stage(context, "QC " + name):
+        return _execute_task(context, name, process_pool)
+
+
+def execute(context):
+    """
+    Generate the independent QC images concurrently. Images are rendered
+    in-process when "qc-renderer" is "python", falling back to the
+    hcpfunc_qc_mosaic.sh script per image. Every image is attempted; failures
+    are reported together at the end.
+    """
+    workers = min(len(QC_TASKS), func_utils.available_cpus())
+    process_pool = None
+    if context.config["qc-renderer"] == "python" and qc_render is not None:
+        # Workers start on the first submit, from a task thread while other
+        # threads (resource monitor, tasks) may hold locks: never fork them
+        process_pool = ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("forkserver")
+        )
+
+    log.info("Functional QC Image Generation (%d tasks)", len(QC_TASKS))
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(_execute_task_measured, context, name, process_pool)
+                for name in QC_TASKS
+            ]
+            records = [future.result() for future in futures]
+    finally:
+        if process_pool is not None:
+            process_pool.shutdown()
+
+    context.gear_dict["QC-Tasks"] = records
+    for record in records:
+        log.info(
+            "QC task %-20s %-7s %-6s %8.2fs",
+            record["task"],
+            record["status"],
+            record["renderer"],
+            record["seconds"],
+        )
+
+    failed = [record["task"] for record in records if record["status"] != "success"]
+    if failed:
+        raise Exception(
+            "{} of {} QC tasks failed: {}".format(
+                len(failed), len(records), ", ".join(failed)
+            )
+        )
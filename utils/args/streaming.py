@@ -0,0 +1,433 @@
+"""
+Execution of the pipeline commands with live, bounded-memory logging.
+A drop-in replacement of `exec_command` of hcp-base (utils/args/common.py),
+which buffers the whole output of a command in memory and only logs it at
+the end. Here, the output (stdout and stderr) is read line by line into a
+bounded ring buffer and written to "<work_dir>/logs/<fMRIName>_<script>.log",
+rotated every SEGMENT_BYTES into compressed segments (".0001.gz", ...) of
+which the last SEGMENTS are kept. The step markers the HCP Pipelines log are
+turned into progress events: logged as they happen, appended to
+"<work_dir>/logs/<fMRIName>_progress.jsonl" and kept in
+gear_dict["progress-events"] for the resource report. A command silent for
+HEARTBEAT_SECONDS is reported with its current step and last output line.
+Commands submitted with FSL's fsl_sub (the default job-scheduler) write their
+output to "<work_dir>/logs/<job name>.o<job id>" and ".e<job id>" instead of
+stdout, the job id being the pid of fsl_sub: those files are followed while
+the command runs, into the same log, progress events and tail.
+A failed command raises CommandFailed, with the cause of the failure (see
+`classify_failure`) for the stages to decide whether to retry.
+"""
+import collections
+import datetime
+import glob
+import gzip
+import json
+import logging
+import os
+import os.path as op
+import queue
+import re
+import shutil
+import signal
+import subprocess
+import threading
+import time
+from collections import OrderedDict
+
+from utils import func_utils, instrumentation
+
+log = logging.getLogger(__name__)
+
+# Lines buffered between the reader of the pipe and the log writer
+RING_LINES = 4096
+# Longest line read at once; longer lines are split
+MAX_LINE_BYTES = 64 * 1024
+SEGMENT_BYTES = 32 * 1024 * 1024
+SEGMENTS = 8
+# Last lines of output reported when a command fails
+TAIL_LINES = 40
+HEARTBEAT_SECONDS = 600
+# Seconds between two reads of the fsl_sub job output files
+FOLLOW_SECONDS = 1.0
+# fsl_sub job output files: <job name>.o<job id>, .e<job id>, and
+# .o<job id>.<task> for the tasks of a task file
+JOB_LOG = re.compile(r"\.[oe](\d+)(\.\d+)?$")
+
+# Steps of the HCP Pipelines (GenericfMRIVolumeProcessingPipeline.sh,
+# GenericfMRISurfaceProcessingPipeline.sh), from their log messages
+PROGRESS_MARKERS = [
+    (r"gradient distortion correction", "Gradient distortion correction"),
+    (r"motion correction", "Motion correction"),
+    (
+        r"epi distortion correction and epi to t1w registration",
+        "Distortion correction and EPI to T1w registration",
+    ),
+    (r"one step resampling", "One step resampling"),
+    (r"intensity normali[sz]ation", "Intensity normalization and bias removal"),
+    (r"make fmri ribbon", "fMRI ribbon"),
+    (r"goodvoxels|ribbon.*surface mapping", "Volume to surface mapping"),
+    (r"surface smoothing", "Surface smoothing"),
+    (r"subcortical processing", "Subcortical processing"),
+    (r"dense time ?series", "Dense time series"),
+]
+PROGRESS_PATTERNS = [
+    (re.compile(pattern, re.IGNORECASE), step) for pattern, step in PROGRESS_MARKERS
+]
+
+# Output of commands that ran out of memory
+MEMORY_ERRORS = re.compile(
+    r"std::bad_alloc|Cannot allocate memory|MemoryError|out of memory|"
+    # bash reporting a child killed by SIGKILL: "line <n>: <pid> Killed ..."
+    r"\d+ Killed\b",
+    re.IGNORECASE,
+)
+# Output of failures of the file system or the network, worth a retry
+TRANSIENT_ERRORS = re.compile(
+    r"Input/output error|Stale file handle|Resource temporarily unavailable|"
+    r"Connection (reset|refused|timed out)|Temporary failure|"
+    r"Device or resource busy",
+    re.IGNORECASE,
+)
+
+
+class CommandFailed(Exception):
+    """
+    A command exited with a non-zero `status`.
+    Attributes:
+        status (int): exit status (negative: killed by a signal).
+        failure (str): its cause, see `classify_failure`.
+        tail (list): last lines of output.
+    """
+
+    def __init__(self, message, status, failure, tail):
+        super().__init__(message)
+        self.status = status
+        self.failure = failure
+        self.tail = tail
+
+
+def classify_failure(status, tail, oom_kills=0):
+    """
+    Cause of the failure of a command.
+    Args:
+        status (int): non-zero exit status of the command, or of the shell
+            running it (128 + signal).
+        tail (list): last lines of output.
+        oom_kills (int): processes of the cgroup killed by the OOM killer
+            while the command ran.
+    Returns:
+        str: "memory" (killed by the OOM killer, or out of memory),
+            "transient" (file system or network error), "signal" (killed
+            otherwise) or "error".
+    """
+    text = "\n".join(tail)
+    killed = status in (-signal.SIGKILL, 128 + signal.SIGKILL)
+    if MEMORY_ERRORS.search(text):
+        return "memory"
+    # The OOM kills are counted for the whole cgroup, shared by the concurrent
+    # runs of a multi-run job: they are the cause only of a command killed by
+    # SIGKILL itself
+    if killed and oom_kills:
+        return "memory"
+    # SIGKILL within a memory limit, the OOM killer counts being unknown
+    if killed and oom_kills is None and func_utils.cgroup_memory_limit():
+        return "memory"
+    if TRANSIENT_ERRORS.search(text):
+        return "transient"
+    if status < 0 or status > 128:
+        return "signal"
+    return "error"
+
+
+class RotatingLog(object):
+    """
+    Log file rotated every `segment_bytes` into gzipped segments
+    "<filename>.NNNN.gz", keeping the last `segments` of them.
+    """
+
+    def __init__(self, filename, segment_bytes=SEGMENT_BYTES, segments=SEGMENTS):
+        self.filename = filename
+        self.segment_bytes = segment_bytes
+        self.segments = segments
+        existing = self._segment_files()
+        self.index = int(existing[-1].split(".")[-2]) if existing else 0
+        os.makedirs(op.dirname(filename), exist_ok=True)
+        self.fp = open(filename, "ab")
+
+    def _segment_files(self):
+        pattern = glob.escape(self.filename) + ".[0-9][0-9][0-9][0-9].gz"
+        return sorted(glob.glob(pattern))
+
+    def write(self, data):
+        self.fp.write(data)
+        if self.fp.tell() >= self.segment_bytes:
+            self.rotate()
+
+    def rotate(self):
+        self.fp.close()
+        self.index += 1
+        segment = "{}.{:04d}.gz".format(self.filename, self.index)
+        with open(self.filename, "rb") as src, gzip.open(segment + ".tmp", "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.rename(segment + ".tmp", segment)
+        for old in self._segment_files()[: -self.segments]:
+            os.remove(old)
+        self.fp = open(self.filename, "wb")
+
+    def flush(self):
+        self.fp.flush()
+
+    def close(self):
+        self.fp.close()
+
+
+class Progress(object):
+    """
+    Progress events of a command, from the step markers of its output.
+    """
+
+    def __init__(self, context, command_name):
+        self.command_name = command_name
+        self.context = context
+        self.events = context.gear_dict.get("progress-events")
+        self.filename = op.join(
+            context.work_dir,
+            "logs",
+            "{}_progress.jsonl".format(context.config["fMRIName"]),
+        )
+        self.current = None
+        self.start("Started")
+
+    def _now(self):
+        return datetime.datetime.now().isoformat()
+
+    def _write(self, event, step, status=None):
+        record = OrderedDict(
+            [
+                ("time", self._now()),
+                ("event", event),
+                ("run", getattr(self.context, "run_number", None)),
+                ("fMRIName", self.context.config["fMRIName"]),
+                ("command", self.command_name),
+                ("step", step),
+            ]
+        )
+        if status is not None:
+            record["status"] = status
+        with open(self.filename, "a") as fp:
+            fp.write(json.dumps(record) + "\n")
+
+    def start(self, step):
+        self.end()
+        self.current = OrderedDict(
+            [
+                ("run", getattr(self.context, "run_number", None)),
+                ("fMRIName", self.context.config["fMRIName"]),
+                ("command", self.command_name),
+                ("step", step),
+                ("started", self._now()),
+                ("ended", None),
+            ]
+        )
+        if self.events is not None:
+            self.events.append(self.current)
+        self._write("start", step)
+        log.info("%s: %s", self.command_name, step)
+
+    def end(self, status=None):
+        if self.current is None:
+            return
+        self.current["ended"] = self._now()
+        self._write("end", self.current["step"], status)
+        self.current = None
+
+    def line(self, text):
+        for pattern, step in PROGRESS_PATTERNS:
+            if pattern.search(text):
+                if self.current is None or self.current["step"] != step:
+                    self.start(step)
+                return
+
+
+def _read_lines(pipe, ring, closed):
+    """
+    Read the lines of `pipe` into the `ring` buffer, blocking (and so
+    pausing the command) while it is full. None marks the end of output, and
+    the `closed` event is set.
+    """
+    try:
+        for line in iter(lambda: pipe.readline(MAX_LINE_BYTES), b""):
+            ring.put(line)
+    finally:
+        ring.put(None)
+        closed.set()
+
+
+def _follow_job_logs(log_dir, existing, process, ring, closed):
+    """
+    Read the lines of the fsl_sub job output files of `process` and its
+    descendants, the job ids, into the `ring` buffer as they are written,
+    until `process` exits. Files in `existing` are older. The `closed` event
+    (end of the output of `process`) ends the wait between two reads. None
+    marks the end of output.
+    """
+    pids = {process.pid}
+    files = {}
+    try:
+        while True:
+            running = process.poll() is None
+            if running:
+                pids.update(instrumentation._process_tree(process.pid))
+            for name in sorted(os.listdir(log_dir)):
+                match = JOB_LOG.search(name)
+                if (
+                    name in files
+                    or name in existing
+                    or match is None
+                    or int(match.group(1)) not in pids
+                ):
+                    continue
+                try:
+                    files[name] = open(op.join(log_dir, name), "rb")
+                except OSError:
+                    continue
+            for fp in files.values():
+                while True:
+                    position = fp.tell()
+                    line = fp.readline(MAX_LINE_BYTES)
+                    # Partial lines are read again once complete
+                    partial = not line.endswith(b"\n") and len(line) < MAX_LINE_BYTES
+                    if not line or running and partial:
+                        fp.seek(position)
+                        break
+                    ring.put(line)
+            if not running:
+                break
+            if closed.wait(FOLLOW_SECONDS):
+                process.wait()
+    finally:
+        for fp in files.values():
+            fp.close()
+        ring.put(None)
+
+
+def command_log_name(context, command):
+    """
+    Log name of a command: the fMRI run and the script or program run.
+    """
+    scripts = [op.basename(part) for part in command if part.endswith(".sh")]
+    program = scripts[0] if scripts else op.basename(command[0])
+    return "{}_{}".format(context.config["fMRIName"], re.sub(r"\.sh$", "", program))
+
+
+def stream_command(context, run_command, name, environ, shell=False):
+    """
+    Run `run_command`, streaming its output, and that of its fsl_sub jobs, to
+    the rotated log `name` and its progress events.
+    Returns:
+        tuple: (exit status, last lines of output)
+    """
+    log_dir = op.join(context.work_dir, "logs")
+    logfile = RotatingLog(op.join(log_dir, name + ".log"))
+    progress = Progress(context, name)
+    tail = collections.deque(maxlen=TAIL_LINES)
+    ring = queue.Queue(maxsize=RING_LINES)
+    existing = set(os.listdir(log_dir))
+    process = subprocess.Popen(
+        run_command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        env=environ,
+        shell=shell,
+    )
+    closed = threading.Event()
+    readers = [
+        threading.Thread(
+            target=_read_lines,
+            args=(process.stdout, ring, closed),
+            name="log-" + name,
+        ),
+        threading.Thread(
+            target=_follow_job_logs,
+            args=(log_dir, existing, process, ring, closed),
+            name="jobs-" + name,
+        ),
+    ]
+    for reader in readers:
+        reader.daemon = True
+        reader.start()
+
+    last_output = time.time()
+    running_readers = len(readers)
+    try:
+        while running_readers:
+            try:
+                line = ring.get(timeout=HEARTBEAT_SECONDS)
+            except queue.Empty:
+                logfile.flush()
+                log.info(
+                    "%s: still in step %r, no output for %d min. Last output: %s",
+                    name,
+                    progress.current and progress.current["step"],
+                    (time.time() - last_output) // 60,
+                    tail[-1] if tail else "",
+                )
+                continue
+            if line is None:
+                running_readers -= 1
+                continue
+            last_output = time.time()
+            logfile.write(line)
+            text = line.decode("utf-8", "replace").rstrip()
+            tail.append(text)
+            progress.line(text)
+            if ring.empty():
+                logfile.flush()
+        status = process.wait()
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        logfile.close()
+        progress.end("success" if process.returncode == 0 else "failed")
+    return status, list(tail)
+
+
+def exec_command(context, command, shell=False, stdout_msg=None, log_name=None):
+    """
+    Execute a command as hcp-base's `exec_command`: logged, skipped in a
+    dry-run, and raising a CommandFailed Exception if it fails. Its output is
+    streamed to a rotated log in the logs directory, named after the run and
+    the script (or `log_name`), instead of being buffered.
+    Args:
+        context: Gear information (or the RunContext of a run).
+        command (list): the command and its arguments.
+        shell (bool): run `command` joined as a shell command line.
+        stdout_msg (str): message logged once the command completes.
+        log_name (str): name of the log, instead of the run and script.
+    """
+    environ = context.gear_dict["environ"]
+    log.info("Executing command: \n" + " ".join(command) + "\n\n")
+    if context.config["dry-run"]:
+        return
+    name = log_name or command_log_name(context, command)
+    run_command = " ".join(command) if shell else command
+    oom_kills = func_utils.cgroup_oom_kills()
+    status, tail = stream_command(context, run_command, name, environ, shell)
+    log.info("Output logged in %s", op.join(context.work_dir, "logs", name + ".log"))
+    if stdout_msg is not None:
+        log.info(stdout_msg)
+    log.info("Command return code: %d", status)
+    if status != 0:
+        log.error("The command:\n %s\nfailed.", " ".join(command))
+        if oom_kills is not None:
+            oom_kills = (func_utils.cgroup_oom_kills() or 0) - oom_kills
+        failure = classify_failure(status, tail, oom_kills)
+        raise CommandFailed(
+            "{} failed with exit status {} ({}). Last output:\n{}".format(
+                name, status, failure, "\n".join(tail)
+            ),
+            status,
+            failure,
+            tail,
+        )
@@ -0,0 +1,211 @@
+"""
+Stage checkpoints of the hcp-func gear.
+A stage (fMRIVolume, fMRISurface, QC, metrics, export) that completes is
+recorded in "<subject>/<subject>_<fMRIName>_hcpfunc_checkpoints.json" with a
+fingerprint of its parameters ("Vol-params", "Surf-params", "QC-Params",
+"Metrics-params", "Export-params") and inputs. The record is packaged with
+the output, so a partial output zip (save-on-error) given back as the
+"PartialZip" input lets a re-run skip the stages whose fingerprints still
+match and start at the first incomplete one. Optional stages (metrics,
+export) that are disabled are left out of the chain.
+"""
+import datetime
+import hashlib
+import json
+import logging
+import os
+import os.path as op
+import zipfile
+from collections import OrderedDict
+
+from utils import chunked_export, qc_metrics
+from utils.args import hcpfunc_qc_mosaic
+
+log = logging.getLogger(__name__)
+
+# Stages in execution order, with the gear_dict key of their parameters
+STAGES = OrderedDict(
+    [
+        ("fMRIVolume", "Vol-params"),
+        ("fMRISurface", "Surf-params"),
+        ("QC", "QC-Params"),
+        ("metrics", "Metrics-params"),
+        ("export", "Export-params"),
+    ]
+)
+
+
+def checkpoint_filename(context):
+    """
+    Path of the checkpoint record of the run in the work directory.
+    """
+    config = context.config
+    return op.join(
+        context.work_dir,
+        config["Subject"],
+        "{}_{}_hcpfunc_checkpoints.json".format(config["Subject"], config["fMRIName"]),
+    )
+
+
+def _describe(context, value):
+    """
+    Location-independent description of a parameter value: input files are
+    described by name and size, the work directory by a placeholder. Files
+    the gear writes in the work directory (e.g. the preview series) are
+    described by path, as they do not exist yet when resuming.
+    """
+    value = str(value)
+    if op.isfile(value) and not value.startswith(context.work_dir + os.sep):
+        return {"file": op.basename(value), "size": op.getsize(value)}
+    return value.replace(context.work_dir, "{work_dir}")
+
+
+def enabled_stages(context):
+    """
+    The STAGES run with the configuration of `context`, in order.
+    """
+    optional = {
+        "metrics": qc_metrics.enabled(context.config),
+        "export": chunked_export.enabled(context.config),
+    }
+    return [stage for stage in STAGES if optional.get(stage, True)]
+
+
+def fingerprints(context):
+    """
+    Fingerprint of every enabled stage. Each stage's fingerprint includes
+    those of the stages before it, so a change upstream invalidates
+    everything downstream.
+    Returns:
+        OrderedDict: stage -> sha256 hex digest.
+    """
+    if "QC-Params" not in context.gear_dict:
+        hcpfunc_qc_mosaic.build(context)
+    if "Metrics-params" not in context.gear_dict:
+        qc_metrics.build(context)
+    if "Export-params" not in context.gear_dict:
+        chunked_export.build(context)
+    result = OrderedDict()
+    previous = _describe(context, context.get_input_path("StructZip"))
+    for stage in enabled_stages(context):
+        params = OrderedDict(
+            (name, _describe(context, value))
+            for name, value in context.gear_dict[STAGES[stage]].items()
+        )
+        # Not arguments of the pipeline, but change what it writes
+        engine = context.config.get("resampling-engine", "hcp")
+        if stage == "fMRIVolume" and engine != "hcp":
+            params["resampling-engine"] = engine
+        if stage == "fMRIVolume" and context.config.get("uncompressed-intermediates"):
+            params["uncompressed-intermediates"] = True
+        digest = hashlib.sha256(
+            json.dumps([previous, stage, params], sort_keys=True).encode("utf-8")
+        ).hexdigest()
+        result[stage] = digest
+        previous = digest
+    return result
+
+
+def read_record(context):
+    """
+    The checkpoint record of the run in the work directory (empty if none).
+    """
+    filename = checkpoint_filename(context)
+    if not op.exists(filename):
+        return OrderedDict()
+    with open(filename) as fp:
+        return json.load(fp, object_pairs_hook=OrderedDict)
+
+
+def _matching_stages(context, record):
+    """
+    Stages of a checkpoint record that completed with the current fingerprints,
+    up to the first incomplete or mismatching one.
+    """
+    completed = []
+    for stage, fingerprint in fingerprints(context).items():
+        if record.get(stage, {}).get("fingerprint") != fingerprint:
+            break
+        completed.append(stage)
+    return completed
+
+
+def resume(contexts):
+    """
+    Resume from the "PartialZip" input of each run, if provided (see
+    utils/multi_run.py for the "PartialZip_<n>" of multi-run jobs). A partial
+    output is unpacked into the work directory only when the checkpoint record
+    of one of its runs matches the current parameters; the matching stages are
+    stored in gear_dict["completed-stages"] of that run.
+    Args:
+        contexts (list): the gear context, or the RunContext of each run.
+    """
+    partial_zips = OrderedDict()
+    for context in contexts:
+        zip_filename = context.get_input_path("PartialZip")
+        if zip_filename:
+            partial_zips.setdefault(zip_filename, []).append(context)
+
+    for zip_filename, zip_contexts in partial_zips.items():
+        resumed = []
+        with zipfile.ZipFile(zip_filename) as zf:
+            members = set(zf.namelist())
+            for context in zip_contexts:
+                arcname = op.relpath(checkpoint_filename(context), context.work_dir)
+                if arcname not in members:
+                    log.info(
+                        "No checkpoints for %s in %s.",
+                        context.config["fMRIName"],
+                        op.basename(zip_filename),
+                    )
+                    continue
+                stages = _matching_stages(context, json.loads(zf.read(arcname)))
+                if not stages:
+                    log.warning(
+                        "Checkpoints of %s do not match the current inputs and "
+                        "configuration. Running all stages.",
+                        context.config["fMRIName"],
+                    )
+                    continue
+                log.info(
+                    "Resuming %s after completed stages: %s",
+                    context.config["fMRIName"],
+                    ", ".join(stages),
+                )
+                context.gear_dict["completed-stages"] = stages
+                resumed.append(context)
+
+            if resumed:
+                log.info("Unpacking %s", zip_filename)
+                zf.extractall(resumed[0].work_dir)
+
+
+def is_complete(context, stage):
+    """
+    Whether `stage` was completed by a previous run of the gear (see resume).
+    """
+    if stage in context.gear_dict.get("completed-stages", []):
+        log.info("Skipping %s: completed in PartialZip.", stage)
+        return True
+    return False
+
+
+def mark_complete(context, stage):
+    """
+    Record the completion of `stage` with its fingerprint. Nothing is recorded
+    in dry-run mode.
+    """
+    if context.config["dry-run"]:
+        return
+    filename = checkpoint_filename(context)
+    record = read_record(context)
+    record[stage] = OrderedDict(
+        [
+            ("fingerprint", fingerprints(context)[stage]),
+            ("completed", datetime.datetime.now().isoformat()),
+        ]
+    )
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, "w") as fp:
+        json.dump(record, fp, indent=4)
+    os.replace(tmp_filename, filename)
@@ -0,0 +1,240 @@
+"""
+Chunked export of the final time series of a run, for downstream analyses
+(parcellation, connectivity, ICA) reading a few parcels or a time window
+without decompressing whole files.
+With "chunked-export", the volume series "<fMRIName>.nii.gz" and the dense
+grayordinate series "<fMRIName>_Atlas.dtseries.nii" of
+MNINonLinear/Results/<fMRIName> are also written as "<name>.chunks", with an
+index "<name>.chunks.json". A series is seen as a (time, space) matrix, space
+being the voxels in NIfTI order (i fastest) or the grayordinates in the order
+of the CIFTI brain models (whose header stays in the source file), stored as
+a grid of blocks of up to BLOCK_FRAMES frames by BLOCK_ELEMENTS elements.
+Each block is a C-order (frames, elements) array of the source data type,
+"uncompressed" (memory-mappable) or "zlib"-compressed. The index has the data
+type, shape and block shape of the series, and the offset and size of every
+block; `read_block` reads one.
+"""
+import json
+import logging
+import os
+import os.path as op
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+from utils import imaging, nifti_header
+
+log = logging.getLogger(__name__)
+
+FORMAT = "hcpfunc-chunks"
+VERSION = 1
+BLOCK_FRAMES = 64
+BLOCK_ELEMENTS = 16384
+# Upper bound on the source data read at once (a row or column of blocks)
+READ_BYTES = 256 * 1024 * 1024
+ZLIB_LEVEL = 1
+
+
+def enabled(config):
+    return config.get("chunked-export", "none") != "none"
+
+
+def build(context):
+    """
+    Collect the export parameters into gear_dict["Export-params"].
+    """
+    params = OrderedDict()
+    params["chunked-export"] = context.config.get("chunked-export", "none")
+    params["block_frames"] = BLOCK_FRAMES
+    params["block_elements"] = BLOCK_ELEMENTS
+    context.gear_dict["Export-params"] = params
+
+
+def sources(context):
+    """
+    The series exported for a run.
+    Returns:
+        list: (path, space) tuples, space being "voxel" or "grayordinate".
+    """
+    config = context.config
+    results_dir = op.join(
+        context.work_dir,
+        config["Subject"],
+        "MNINonLinear",
+        "Results",
+        config["fMRIName"],
+    )
+    return [
+        (imaging.find_image(op.join(results_dir, config["fMRIName"])), "voxel"),
+        (
+            op.join(results_dir, config["fMRIName"] + "_Atlas.dtseries.nii"),
+            "grayordinate",
+        ),
+    ]
+
+
+def chunks_filename(source):
+    for extension in [".nii.gz", ".nii"]:
+        if source.endswith(extension):
+            return source[: -len(extension)] + ".chunks"
+    return source + ".chunks"
+
+
+def _matrix(header, space):
+    """
+    Frames and elements of a series, and whether its frames are contiguous
+    on disk (NIfTI volumes) rather than the series of each element (CIFTI).
+    """
+    shape = header.shape
+    if space == "voxel":
+        return header.volumes, shape[0] * shape[1] * shape[2], True
+    if len(shape) != 6:
+        raise Exception(
+            "{} is not a dense time series: dimensions {}.".format(
+                header.filename, shape
+            )
+        )
+    return shape[4], shape[5], False
+
+
+def _read_array(fp, dtype, count, filename):
+    data = fp.read(count * dtype.itemsize)
+    if len(data) < count * dtype.itemsize:
+        raise Exception("{} is truncated.".format(filename))
+    return np.frombuffer(data, dtype)
+
+
+def export_series(source, space, compression):
+    """
+    Write the chunked copy of `source` and its index.
+    Args:
+        source (str): NIfTI volume series or CIFTI dense time series.
+        space (str): "voxel" or "grayordinate".
+        compression (str): "uncompressed" or "zlib".
+    Returns:
+        str: path of the index.
+    """
+    header = nifti_header.read_header(source)
+    dtype = np.dtype(header.dtype)
+    frames, elements, frame_major = _matrix(header, space)
+    block_frames, block_elements = BLOCK_FRAMES, BLOCK_ELEMENTS
+    # Bound the row (or column) of blocks read at once
+    if frame_major:
+        row_frames = READ_BYTES // (elements * dtype.itemsize)
+        block_frames = max(1, min(block_frames, row_frames))
+    else:
+        column_elements = READ_BYTES // (frames * dtype.itemsize)
+        block_elements = max(1, min(block_elements, column_elements))
+
+    filename = chunks_filename(source)
+    blocks = []
+
+    def write_block(fp, frame, element, block):
+        data = np.ascontiguousarray(block).tobytes()
+        if compression == "zlib":
+            data = zlib.compress(data, ZLIB_LEVEL)
+        blocks.append([frame, element, fp.tell(), len(data)])
+        fp.write(data)
+
+    with nifti_header.open_nifti(source) as src, open(filename + ".tmp", "wb") as dst:
+        src.seek(header.vox_offset)
+        if frame_major:
+            for frame in range(0, frames, block_frames):
+                count = min(block_frames, frames - frame)
+                row = _read_array(src, dtype, count * elements, source)
+                row = row.reshape(count, elements)
+                for element in range(0, elements, block_elements):
+                    write_block(
+                        dst, frame, element, row[:, element : element + block_elements]
+                    )
+        else:
+            for element in range(0, elements, block_elements):
+                count = min(block_elements, elements - element)
+                column = _read_array(src, dtype, count * frames, source)
+                column = column.reshape(count, frames).T
+                for frame in range(0, frames, block_frames):
+                    write_block(
+                        dst, frame, element, column[frame : frame + block_frames]
+                    )
+    os.replace(filename + ".tmp", filename)
+
+    index = OrderedDict(
+        [
+            ("format", FORMAT),
+            ("version", VERSION),
+            ("source", op.basename(source)),
+            ("data", op.basename(filename)),
+            ("space", space),
+            ("dtype", dtype.str),
+            ("shape", [frames, elements]),
+            ("block_shape", [block_frames, block_elements]),
+            ("compression", compression),
+            # Values are as stored: scaled by scl_slope, scl_inter if slope != 0
+            ("scl_slope", header.scl_slope),
+            ("scl_inter", header.scl_inter),
+        ]
+    )
+    if space == "voxel":
+        index["spatial_shape"] = list(header.shape[:3])
+        index["affine"] = header.affine
+        index["tr"] = header.tr
+    index["blocks"] = blocks
+    with open(filename + ".json", "w") as fp:
+        json.dump(index, fp)
+    log.info(
+        "Exported %s: %d x %d in %d blocks of %d x %d (%s, %.2f GB).",
+        op.basename(source),
+        frames,
+        elements,
+        len(blocks),
+        block_frames,
+        block_elements,
+        compression,
+        op.getsize(filename) / 1e9,
+    )
+    return filename + ".json"
+
+
+def read_block(index_filename, frame, element):
+    """
+    Read the block of a chunked series holding (`frame`, `element`).
+    Uncompressed blocks are memory-mapped.
+    Returns:
+        np.ndarray: the (frames, elements) block.
+    """
+    with open(index_filename) as fp:
+        index = json.load(fp)
+    frames, elements = index["shape"]
+    block_frames, block_elements = index["block_shape"]
+    start = (frame - frame % block_frames, element - element % block_elements)
+    for block_frame, block_element, offset, size in index["blocks"]:
+        if (block_frame, block_element) == start:
+            break
+    else:
+        raise Exception(
+            "({}, {}) is outside of {} x {}.".format(frame, element, frames, elements)
+        )
+    shape = (
+        min(block_frames, frames - block_frame),
+        min(block_elements, elements - block_element),
+    )
+    filename = op.join(op.dirname(index_filename), index["data"])
+    if index["compression"] == "uncompressed":
+        return np.memmap(filename, index["dtype"], "r", offset, shape)
+    with open(filename, "rb") as fp:
+        fp.seek(offset)
+        data = zlib.decompress(fp.read(size))
+    return np.frombuffer(data, index["dtype"]).reshape(shape)
+
+
+def execute(context):
+    """
+    Export the final time series of the run in chunks.
+    """
+    if context.config["dry-run"]:
+        log.info("Dry run: the final time series are not exported.")
+        return
+    compression = context.gear_dict["Export-params"]["chunked-export"]
+    for source, space in sources(context):
+        export_series(source, space, compression)
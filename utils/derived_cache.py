@@ -0,0 +1,253 @@
+"""
+Per-subject cache of the structural assets the HCP Pipelines derive for each
+fMRI run without using its data. Every run of a subject resamples the same
+structural volumes to the fMRI resolution:
+    * OneStepResampling.sh: T1w_restore, brainmask_fs and BiasField at
+      fmrires (the T1w_restore.<fmrires> of the mni2mm_T1 QC image);
+    * SubcorticalProcessing.sh: wmparc and Atlas_ROIs at fmrires, when it
+      differs from grayordinatesres.
+Their commands are run through `python3 -m utils.derived_cache` in patched
+copies of the scripts (see utils/script_overrides.py): the first run stores
+their outputs in the cache entry of the subject, keyed by the StructZip
+content hash and the fmrires and grayordinatesres of "Surf-params", and the
+next runs copy them (reflink if possible) instead of running the commands.
+The surface resamplings (lowresmesh, regname) are not cached. Entries are in
+"<struct-cache-dir>/derived", shared by the jobs of a node, or without a
+cache directory in "<work_dir>/derived-cache", shared by the runs of a
+multi-run job. The least recently used entries are removed above
+DERIVED_MAX_BYTES.
+"""
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import os.path as op
+import re
+import shutil
+import subprocess
+import sys
+import time
+
+from utils import func_utils, script_overrides, struct_cache
+
+log = logging.getLogger(__name__)
+
+VERSION = 2
+DERIVED_MAX_BYTES = 5 * 1024 ** 3
+# Environment variable giving a run's cache entry to the patched scripts
+ENTRY_VARIABLE = "HCPFUNC_DERIVED_ENTRY"
+# Cached files are copied, never linked: the pipelines may modify them in place
+RESTORE_METHODS = ("reflink", "copy")
+
+OUTPUT_OPTION = re.compile(r"\s(?:-o|-out|--out)(?:=|\s+)(\S+)")
+# Scripts (in the directory of their HCPPIPEDIR_* variable), and the outputs
+# of the commands cached, with quotes and braces of the variables removed
+DERIVED_COMMANDS = [
+    (
+        "HCPPIPEDIR_fMRIVol",
+        "OneStepResampling.sh",
+        re.compile(
+            r"^\$WD/\$(T1wImageFile|FreeSurferBrainMaskFile|BiasFieldFile)"
+            r"\.\$FinalfMRIResolution(\.nii\.gz)?$"
+        ),
+    ),
+    (
+        "HCPPIPEDIR_fMRISurf",
+        "SubcorticalProcessing.sh",
+        re.compile(
+            r"^\$ResultsFolder/(wmparc|Atlas_ROIs)"
+            r"\.\$FinalfMRIResolution(\.nii\.gz)?$"
+        ),
+    ),
+]
+
+
+def entry_key(context):
+    """
+    Cache key of the derived assets of a run.
+    """
+    params = context.gear_dict["Surf-params"]
+    key = [VERSION, struct_cache.struct_zip_hash(context)]
+    # Atlas_ROIs is resampled from its grayordinatesres version
+    for name in ["fmrires", "grayordinatesres"]:
+        key.append(params[name])
+    return hashlib.sha256(json.dumps(key).encode("utf-8")).hexdigest()
+
+
+def patch_script(text, script, outputs):
+    """
+    `text` of `script` with the commands writing `outputs` run through the
+    cache, or None if there are none.
+    """
+    lines = text.splitlines(True)
+    patched = 0
+    for number, line in enumerate(lines):
+        match = OUTPUT_OPTION.search(line)
+        continued = number > 0 and lines[number - 1].rstrip().endswith("\\")
+        if (
+            match is None
+            or continued
+            or line.lstrip().startswith("#")
+            or re.search(r"[;|&]", line)
+            or not outputs.match(re.sub(r'["{}]', "", match.group(1)))
+        ):
+            continue
+        # Commands are identified by their line, the same for every run
+        command_id = hashlib.sha1(
+            "{}:{}".format(script, line.strip()).encode("utf-8")
+        ).hexdigest()[:16]
+        indent = line[: len(line) - len(line.lstrip())]
+        lines[number] = "{}hcpfunc_derived {} {} -- {}".format(
+            indent, command_id, match.group(1), line.lstrip()
+        )
+        patched += 1
+    if not patched:
+        return None
+    function = "hcpfunc_derived() {{ {} \"$@\"; }}\n".format(
+        script_overrides.python_command("utils.derived_cache")
+    )
+    return "".join(lines[:1] + [function] + lines[1:])
+
+
+def _evict(root, keep):
+    """
+    Remove least-recently-used entries of `root`, except those in `keep`,
+    until they fit in DERIVED_MAX_BYTES.
+    """
+    entries = []
+    for key in os.listdir(root):
+        entry = op.join(root, key)
+        if key not in keep and op.isdir(entry) and not key.endswith(".tmp"):
+            entries.append((op.getmtime(entry), entry, struct_cache._tree_size(entry)))
+    total = sum(size for _, _, size in entries)
+    for _, entry, size in sorted(entries):
+        if total <= DERIVED_MAX_BYTES:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        total -= size
+        log.info("Evicted derived structural assets %s.", op.basename(entry))
+
+
+def configure(context, runs):
+    """
+    Use the derived asset cache for `runs`: patch the scripts and give each
+    run its entry in (a copy of) its gear_dict["environ"]. The runs are
+    unchanged if the cache cannot be used.
+    """
+    config = context.config
+    if config.get("struct-cache-dir"):
+        root = op.join(config["struct-cache-dir"], "derived")
+    else:
+        root = op.join(context.work_dir, "derived-cache")
+    try:
+        os.makedirs(root, exist_ok=True)
+        struct_cache.struct_zip_hash(context)
+        patched = [
+            script
+            for variable, script, outputs in DERIVED_COMMANDS
+            if script_overrides.override_script(
+                context,
+                variable,
+                script,
+                lambda text, script=script, outputs=outputs: patch_script(
+                    text, script, outputs
+                ),
+            )
+        ]
+    except Exception as e:
+        log.warning("The derived structural asset cache cannot be used: %s", e)
+        return
+    if not patched:
+        log.warning("No cacheable structural derivation found in the HCP scripts.")
+        return
+
+    keys = []
+    for run in runs:
+        key = entry_key(run)
+        entry = op.join(root, key)
+        os.makedirs(entry, exist_ok=True)
+        os.utime(entry)
+        environ = dict(run.gear_dict["environ"])
+        environ[ENTRY_VARIABLE] = entry
+        run.gear_dict["environ"] = environ
+        keys.append(key)
+    with struct_cache._flock(op.join(root, "evict.lock"), fcntl.LOCK_EX):
+        _evict(root, set(keys))
+    log.info(
+        "Derived structural assets cached in %s (%s) for %s.",
+        root,
+        ", ".join(sorted(set(keys))),
+        ", ".join(patched),
+    )
+
+
+def _output_files(output):
+    """
+    Files written for the FSL-style `output` name.
+    """
+    if output.endswith((".nii", ".nii.gz")):
+        return [output]
+    return [output + extension for extension in ["", ".nii", ".nii.gz"]]
+
+
+def run_command(entry, command_id, output, command):
+    """
+    Restore the outputs of `command` from the cache entry, or run it and
+    store them.
+    Returns:
+        int: the exit status of the command (0 if restored).
+    """
+    cached = op.join(entry, command_id)
+    if op.isdir(cached):
+        for name in os.listdir(cached):
+            restored = op.join(op.dirname(output), name)
+            func_utils.link_or_copy(
+                op.join(cached, name), restored, methods=RESTORE_METHODS
+            )
+            os.chmod(restored, 0o644)
+        log.info("Restored %s from the derived asset cache.", output)
+        return 0
+
+    start = time.time()
+    status = subprocess.call(command)
+    if status != 0:
+        return status
+    files = [
+        filename
+        for filename in _output_files(output)
+        if op.isfile(filename) and op.getmtime(filename) >= start - 1
+    ]
+    if not files:
+        return status
+    tmp = "{}.{}.tmp".format(cached, os.getpid())
+    try:
+        os.makedirs(tmp)
+        for filename in files:
+            shutil.copy2(filename, op.join(tmp, op.basename(filename)))
+            os.chmod(op.join(tmp, op.basename(filename)), 0o444)
+        # Another job may have stored it meanwhile: keep theirs
+        os.rename(tmp, cached)
+        log.info("Stored %s in the derived asset cache.", output)
+    except OSError as e:
+        log.warning("Could not cache %s: %s", output, e)
+        shutil.rmtree(tmp, ignore_errors=True)
+    return status
+
+
+def main(argv):
+    """
+    hcpfunc_derived <command id> <output> -- <command>...
+    """
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    command_id, output, separator = argv[:3]
+    if separator != "--":
+        raise Exception("Usage: derived_cache <command id> <output> -- <command>")
+    entry = os.environ.get(ENTRY_VARIABLE)
+    if not entry:
+        return subprocess.call(argv[3:])
+    return run_command(entry, command_id, output, argv[3:])
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
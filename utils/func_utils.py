@@ -1,14 +1,45 @@
 """
 This is a module with specific functions for the HCP Functional Pipeline
 """
+import errno
+import fcntl
 import glob
+import json
+import logging
+import math
 import os
 import os.path as op
+import shutil
+
+from utils import preview
+
+# ioctl request to clone (reflink) a file on btrfs/xfs/overlayfs
+FICLONE = 0x40049409
+CGROUP_ROOT = "/sys/fs/cgroup"
+# JSON file of the gear environment replacing hcp-base's /tmp/gear_environ.json
+GEAR_ENVIRON_VARIABLE = "HCPFUNC_GEAR_ENVIRON"
+
+log = logging.getLogger(__name__)
+
+
+def load_gear_environ(context):
+    """
+    Use the environment saved in the file named by HCPFUNC_GEAR_ENVIRON, if
+    set, instead of the host-wide /tmp/gear_environ.json read by hcp-base:
+    a private environment per gear directory (see benchmarks/harness.py).
+    """
+    filename = os.environ.get(GEAR_ENVIRON_VARIABLE)
+    if filename:
+        with open(filename) as fp:
+            context.gear_dict["environ"] = json.load(fp)
+        log.info("Gear environment read from %s.", filename)
 
 
 def remove_intermediate_files(context):
     """
-    Delete extraneous files used for the diffusion processing
+    Delete extraneous files used for the functional processing.
+    Most are already reclaimed by the scratch manager when fMRIVolume
+    completes (see utils/scratch.py).
     """
     # Delete extraneous processing files
     config = context.config
@@ -23,8 +54,10 @@ def remove_intermediate_files(context):
                     dir,
                 )
             )
-        except:
+        except FileNotFoundError:
             pass
+        except OSError as e:
+            log.warning("Could not remove %s: %s", dir, e)
 
     del_niftis = glob.glob(
         op.join(
@@ -32,15 +65,138 @@ def remove_intermediate_files(context):
             config["Subject"],
             config["fMRIName"],
             "MotionMatrices",
-            "*.nii.gz",
+            "*.nii*",
         )
     )
 
-    try:
-        for nifti in del_niftis:
+    for nifti in del_niftis:
+        try:
             os.remove(nifti)
-    except:
-        pass
+        except OSError as e:
+            log.warning("Could not remove %s: %s", nifti, e)
+
+
+def _read_cgroup_file(*paths):
+    """
+    Contents of the first readable cgroup control file, or None
+    """
+    for path in paths:
+        try:
+            with open(op.join(CGROUP_ROOT, path)) as fp:
+                return fp.read().strip()
+        except OSError:
+            continue
+    return None
+
+
+def cgroup_cpu_limit():
+    """
+    CPU quota of the container's cgroup (v2 or v1), in CPUs, or None if
+    unlimited
+    """
+    cpu_max = _read_cgroup_file("cpu.max")
+    if cpu_max is not None:
+        quota, period = cpu_max.split()
+        if quota == "max":
+            return None
+        return int(quota) / int(period)
+    quota = _read_cgroup_file("cpu/cpu.cfs_quota_us", "cpu,cpuacct/cpu.cfs_quota_us")
+    period = _read_cgroup_file(
+        "cpu/cpu.cfs_period_us", "cpu,cpuacct/cpu.cfs_period_us"
+    )
+    if quota is None or period is None or int(quota) <= 0:
+        return None
+    return int(quota) / int(period)
+
+
+def cgroup_memory_limit():
+    """
+    Memory limit of the container's cgroup (v2 or v1) in bytes, or None if
+    unlimited
+    """
+    limit = _read_cgroup_file("memory.max", "memory/memory.limit_in_bytes")
+    if limit is None or limit == "max":
+        return None
+    limit = int(limit)
+    # cgroup v1 reports "unlimited" as a page-rounded maximum value
+    if limit >= 2 ** 62:
+        return None
+    return limit
+
+
+def cgroup_oom_kills():
+    """
+    Number of processes of the container's cgroup (v2 or v1) killed by the
+    OOM killer, or None if unknown
+    """
+    events = _read_cgroup_file("memory.events", "memory/memory.oom_control")
+    if events is None:
+        return None
+    for line in events.splitlines():
+        name, _, value = line.partition(" ")
+        if name == "oom_kill":
+            return int(value)
+    return None
+
+
+def available_cpus():
+    """
+    Number of CPUs this process is allowed to run on, within the cgroup CPU
+    quota
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    quota = cgroup_cpu_limit()
+    if quota is not None:
+        cpus = min(cpus, max(1, int(math.ceil(quota))))
+    return cpus
+
+
+def available_memory():
+    """
+    Physical memory of the host in bytes, within the cgroup memory limit
+    """
+    memory = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    limit = cgroup_memory_limit()
+    if limit is not None:
+        memory = min(memory, limit)
+    return memory
+
+
+def link_or_copy(src, dst, methods=("reflink", "hardlink", "copy")):
+    """
+    Create `dst` with the contents of `src` without copying data when possible.
+    Args:
+        src (str): existing file.
+        dst (str): file to create. An existing file is replaced.
+        methods (tuple): methods to try, in order, from "reflink",
+            "hardlink", "symlink" and "copy".
+    Returns:
+        str: the method that succeeded.
+    """
+    if op.lexists(dst):
+        os.remove(dst)
+    for method in methods:
+        try:
+            if method == "reflink":
+                with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+                    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+                shutil.copystat(src, dst)
+            elif method == "hardlink":
+                os.link(src, dst)
+            elif method == "symlink":
+                os.symlink(op.abspath(src), dst)
+            else:
+                shutil.copy2(src, dst)
+            return method
+        except OSError as e:
+            if op.lexists(dst):
+                os.remove(dst)
+            if e.errno == errno.ENOENT:
+                raise
+    raise OSError("Could not create {} from {}".format(dst, src))
 
 
 def configs_to_export(context):
@@ -67,6 +223,12 @@ def configs_to_export(context):
     ]
     config["LowResMesh"] = context.gear_dict["Surf-params"]["lowresmesh"]
     config["SmoothingFWHM"] = context.gear_dict["Surf-params"]["smoothingFWHM"]
+    if preview.enabled(context.config):
+        # Not to be mistaken for the outputs of a full run
+        config["Preview"] = {
+            key: context.config[key]
+            for key in ["preview-volumes", "preview-subset", "preview-resolution"]
+        }
 
     hcpfunc_config_filename = op.join(
         context.work_dir,
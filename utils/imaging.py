@@ -0,0 +1,138 @@
+"""
+NIfTI helpers shared by the gear's in-process image processing (QC images).
+Coordinates follow the FSL conventions so that FLIRT matrices written by the
+HCP Pipelines can be applied directly.
+"""
+import glob
+import os.path as op
+
+import nibabel as nib
+import numpy as np
+
+NIFTI_EXTENSIONS = [".nii.gz", ".nii"]
+
+
+def find_image(path):
+    """
+    Resolve an FSL-style image name (extension optional, glob allowed) to an
+    existing NIfTI file.
+    """
+    candidates = [path] + [path + ext for ext in NIFTI_EXTENSIONS]
+    for candidate in candidates:
+        matches = sorted(glob.glob(candidate))
+        if matches and op.isfile(matches[0]):
+            return matches[0]
+    raise Exception("Image not found: {}".format(path))
+
+
+def load_image(path):
+    """
+    Load a NIfTI image. Data is not read until accessed, and uncompressed
+    images are memory-mapped.
+    """
+    return nib.load(find_image(path))
+
+
+def fsl_vox2mm(img):
+    """
+    Voxel to FSL "scaled mm" coordinates (the space of FLIRT matrices): voxel
+    indices scaled by voxel size, with x flipped for neurological storage.
+    """
+    zooms = img.header.get_zooms()[:3]
+    scaling = np.diag(list(zooms) + [1.0])
+    if np.linalg.det(img.affine[:3, :3]) > 0:
+        flip = np.eye(4)
+        flip[0, 0] = -1
+        flip[0, 3] = img.shape[0] - 1
+        scaling = scaling.dot(flip)
+    return scaling
+
+
+def ref_to_src_voxels(src_img, ref_img, flirt_mat=None):
+    """
+    Affine mapping reference voxel indices to source voxel indices.
+    Args:
+        src_img: image being resampled.
+        ref_img: image defining the output grid.
+        flirt_mat (np.ndarray): FLIRT src->ref matrix. If None, images are
+            aligned through their world (sform/qform) affines.
+    """
+    if flirt_mat is None:
+        return np.linalg.inv(src_img.affine).dot(ref_img.affine)
+    return (
+        np.linalg.inv(fsl_vox2mm(src_img))
+        .dot(np.linalg.inv(flirt_mat))
+        .dot(fsl_vox2mm(ref_img))
+    )
+
+
+def trilinear(data, coords):
+    """
+    Trilinear interpolation of a 3D array.
+    Args:
+        data (np.ndarray): 3D array.
+        coords (np.ndarray): (3, N) voxel coordinates.
+    Returns:
+        np.ndarray: (N,) interpolated values, 0 outside the field of view.
+    """
+    shape = np.array(data.shape[:3]).reshape(3, 1)
+    inside = np.all((coords > -0.5) & (coords < shape - 0.5), axis=0)
+    coords = np.clip(coords, 0, shape - 1)
+    base = np.floor(coords).astype(np.intp)
+    frac = coords - base
+    upper = np.minimum(base + 1, shape - 1)
+    values = np.zeros(coords.shape[1], dtype=np.float64)
+    for corner in range(8):
+        index = []
+        weight = np.ones(coords.shape[1])
+        for axis in range(3):
+            if corner >> axis & 1:
+                index.append(upper[axis])
+                weight *= frac[axis]
+            else:
+                index.append(base[axis])
+                weight *= 1 - frac[axis]
+        values += weight * data[tuple(index)]
+    values[~inside] = 0
+    return values
+
+
+def sample_slices(src_img, ref_img, slices, axis=0, flirt_mat=None, data=None):
+    """
+    Sample `src_img` on selected slices of the `ref_img` grid. Only the
+    displayed slices are computed.
+    Args:
+        src_img: image being resampled.
+        ref_img: image defining the output grid.
+        slices (list): slice indices along `axis` of the reference grid.
+        axis (int): slice axis.
+        flirt_mat (np.ndarray): optional FLIRT src->ref matrix.
+        data (np.ndarray): src_img data, if already loaded.
+    Returns:
+        np.ndarray: slices stacked along the first axis.
+    """
+    if data is None:
+        data = np.asanyarray(src_img.dataobj)
+    if data.ndim > 3:
+        data = data.reshape(data.shape[:3])
+
+    same_grid = (
+        flirt_mat is None
+        and src_img.shape[:3] == ref_img.shape[:3]
+        and np.allclose(src_img.affine, ref_img.affine)
+    )
+    if same_grid:
+        return np.moveaxis(np.take(data, slices, axis=axis), axis, 0).astype(
+            np.float64
+        )
+
+    plane = [dim for i, dim in enumerate(ref_img.shape[:3]) if i != axis]
+    grid = np.indices(plane).reshape(2, -1)
+    mapping = ref_to_src_voxels(src_img, ref_img, flirt_mat)
+    out = []
+    for index in slices:
+        vox = np.insert(grid, axis, index, axis=0)
+        vox = np.vstack([vox, np.ones(vox.shape[1])])
+        coords = mapping.dot(vox)[:3]
+        out.append(trilinear(data, coords).reshape(plane))
+    return np.array(out)
@@ -0,0 +1,291 @@
+"""
+Per-stage resource accounting of the hcp-func gear.
+Each stage (configuration validation, unzip, fMRIVolume, fMRISurface, QC
+tasks, packaging...) is timed and measured: wall time, user/sys CPU of the
+gear and its reaped children, peak RSS of the whole process tree, bytes read
+and written, and peak growth of the scratch (work directory) file system
+since the gear started.
+Counters are process-wide: stages running concurrently (multi-run, QC tasks)
+include each other's usage. The report is written as
+"<subject>/<subject>_<fMRIName>_hcpfunc_resources.json", next to the exported
+configuration, and copied to the output directory, with the attempts of the
+retried stages (see utils/stages.py).
+"""
+import datetime
+import json
+import logging
+import os
+import os.path as op
+import platform
+import resource
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from utils import func_utils, staging
+
+log = logging.getLogger(__name__)
+
+# Seconds between two samples of the process tree RSS and disk usage
+SAMPLE_INTERVAL = 1.0
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def _process_tree(pid):
+    """
+    The process `pid` and all its descendants.
+    """
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(op.join("/proc", entry, "stat")) as fp:
+                stat = fp.read()
+        except OSError:
+            continue
+        # The command name may contain spaces: fields follow the last ")"
+        ppid = int(stat[stat.rfind(")") + 2 :].split()[1])
+        children.setdefault(ppid, []).append(int(entry))
+    tree = [pid]
+    for process in tree:
+        tree.extend(children.get(process, []))
+    return tree
+
+
+def tree_rss(pid=None):
+    """
+    Resident memory, in bytes, of a process (default: the gear) and its
+    descendants.
+    """
+    total = 0
+    for process in _process_tree(pid or os.getpid()):
+        try:
+            with open(op.join("/proc", str(process), "statm")) as fp:
+                total += int(fp.read().split()[1]) * PAGE_SIZE
+        except (OSError, IndexError, ValueError):
+            continue
+    return total
+
+
+def _io_counters():
+    """
+    I/O counters of the gear, including its reaped children.
+    """
+    counters = {}
+    try:
+        with open("/proc/self/io") as fp:
+            for line in fp:
+                name, value = line.split(":")
+                counters[name] = int(value)
+    except OSError:
+        pass
+    return counters
+
+
+def _cpu_times():
+    times = []
+    for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]:
+        usage = resource.getrusage(who)
+        times.append((usage.ru_utime, usage.ru_stime))
+    return sum(t[0] for t in times), sum(t[1] for t in times)
+
+
+class Monitor(object):
+    """
+    Background sampler of the process tree RSS and the scratch disk usage,
+    feeding the peaks of all active stages.
+    Args:
+        scratch_dir (str): directory on the scratch file system.
+        interval (float): seconds between samples.
+    """
+
+    def __init__(self, scratch_dir, interval=SAMPLE_INTERVAL):
+        self.scratch_dir = scratch_dir
+        self.interval = interval
+        self.baseline = shutil.disk_usage(scratch_dir).used
+        self.active = []
+        self.lock = threading.Lock()
+        thread = threading.Thread(target=self._run, name="resource-monitor")
+        thread.daemon = True
+        thread.start()
+
+    def sample(self):
+        rss = tree_rss()
+        scratch = shutil.disk_usage(self.scratch_dir).used - self.baseline
+        with self.lock:
+            for peaks in self.active:
+                peaks["rss"] = max(peaks["rss"], rss)
+                peaks["scratch"] = max(peaks["scratch"], scratch)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.sample()
+            except Exception as e:
+                log.debug("Resource sampling failed: %s", e)
+
+    def track(self, peaks):
+        with self.lock:
+            self.active.append(peaks)
+        self.sample()
+
+    def untrack(self, peaks):
+        self.sample()
+        with self.lock:
+            # By identity: concurrent stages may have equal peaks
+            self.active = [active for active in self.active if active is not peaks]
+
+
+def start(context):
+    """
+    Start resource accounting. Stages are recorded in
+    gear_dict["resource-stages"], the pipeline steps of their commands in
+    gear_dict["progress-events"] (see utils/args/streaming.py).
+    """
+    context.gear_dict["resource-monitor"] = Monitor(context.work_dir)
+    context.gear_dict["resource-stages"] = []
+    context.gear_dict["progress-events"] = []
+    context.gear_dict["stage-attempts"] = []
+
+
+def record_attempt(context, stage, attempt, error=None):
+    """
+    Record an attempt of `stage` in gear_dict["stage-attempts"]: its threads,
+    and the cause of its failure if `error` (a streaming.CommandFailed).
+    """
+    record = OrderedDict(
+        [
+            ("stage", stage),
+            ("run", getattr(context, "run_number", None)),
+            ("fMRIName", context.config.get("fMRIName")),
+            ("attempt", attempt),
+            ("threads", context.gear_dict["environ"].get("OMP_NUM_THREADS")),
+            ("time", datetime.datetime.now().isoformat()),
+        ]
+    )
+    if error is None:
+        record["outcome"] = "success"
+    else:
+        record["outcome"] = error.failure
+        record["status"] = error.status
+    context.gear_dict.setdefault("stage-attempts", []).append(record)
+
+
+@contextmanager
+def stage(context, name):
+    """
+    Measure the enclosed block as the stage `name` of `context`. Does nothing
+    if accounting was not started.
+    """
+    monitor = context.gear_dict.get("resource-monitor")
+    if monitor is None:
+        yield
+        return
+
+    peaks = {"rss": 0, "scratch": 0}
+    monitor.track(peaks)
+    started = datetime.datetime.now()
+    start_wall = time.time()
+    start_user, start_sys = _cpu_times()
+    start_io = _io_counters()
+    status = "failed"
+    try:
+        yield
+        status = "success"
+    finally:
+        monitor.untrack(peaks)
+        end_user, end_sys = _cpu_times()
+        end_io = _io_counters()
+        record = OrderedDict(
+            [
+                ("stage", name),
+                ("run", getattr(context, "run_number", None)),
+                ("fMRIName", context.config.get("fMRIName")),
+                ("status", status),
+                ("started", started.isoformat()),
+                ("wall_seconds", round(time.time() - start_wall, 3)),
+                ("user_seconds", round(end_user - start_user, 3)),
+                ("sys_seconds", round(end_sys - start_sys, 3)),
+                ("peak_rss_bytes", peaks["rss"]),
+                ("scratch_peak_bytes", max(0, peaks["scratch"])),
+            ]
+        )
+        for counter in ["read_bytes", "write_bytes", "rchar", "wchar"]:
+            if counter in end_io:
+                record[counter] = end_io[counter] - start_io.get(counter, 0)
+        context.gear_dict["resource-stages"].append(record)
+        log.info(
+            "Stage %s: %s in %.1fs (user %.1fs, sys %.1fs), peak RSS %.2f GB",
+            name,
+            status,
+            record["wall_seconds"],
+            record["user_seconds"],
+            record["sys_seconds"],
+            record["peak_rss_bytes"] / 1e9,
+        )
+
+
+def report_filename(context, directory=None):
+    """
+    Path of the report, by default next to the exported configuration
+    (see func_utils.configs_to_export).
+    """
+    config = context.config
+    if directory is None:
+        directory = op.join(context.work_dir, config["Subject"])
+    return op.join(
+        directory,
+        "{}_{}_hcpfunc_resources.json".format(config["Subject"], config["fMRIName"]),
+    )
+
+
+def write_report(context, directory=None):
+    """
+    Write the stages of `context` (and the stages common to all runs) as JSON.
+    """
+    if "resource-stages" not in context.gear_dict:
+        return
+    run_number = getattr(context, "run_number", None)
+    report = OrderedDict(
+        [
+            ("Subject", context.config["Subject"]),
+            ("fMRIName", context.config["fMRIName"]),
+            ("host", platform.node()),
+            ("cpus", func_utils.available_cpus()),
+            ("memory_bytes", func_utils.available_memory()),
+            (
+                "stages",
+                [
+                    record
+                    for record in context.gear_dict["resource-stages"]
+                    if record["run"] in (None, run_number)
+                ],
+            ),
+        ]
+    )
+    report["progress"] = [
+        event
+        for event in context.gear_dict.get("progress-events", [])
+        if event["run"] in (None, run_number)
+    ]
+    report["attempts"] = [
+        record
+        for record in context.gear_dict.get("stage-attempts", [])
+        if record["run"] in (None, run_number)
+    ]
+    if "scratch-manager" in context.gear_dict:
+        report["scratch"] = context.gear_dict["scratch-manager"].summary()
+    if "input-staging" in context.gear_dict:
+        report["input-staging"] = staging.summary(context)
+    # Features and prediction of the run, to calibrate and check predictions
+    for key in ["job-features", "job-prediction"]:
+        if key in context.gear_dict:
+            report[key] = context.gear_dict[key]
+    filename = report_filename(context, directory)
+    os.makedirs(op.dirname(filename), exist_ok=True)
+    with open(filename, "w") as fp:
+        json.dump(report, fp, indent=4)
@@ -0,0 +1,89 @@
+"""
+cgroup-aware local execution of the HCP Pipelines.
+Replaces "$FSLDIR/bin/fsl_sub" in the pipelines command prefix with the local
+scheduler (/tmp/scripts/local_scheduler/fsl_sub), which is also put first on
+the PATH for jobs the pipelines submit themselves. The CPU budget (cgroup
+quota, CPU affinity) is shared between the concurrent stages, and each stage
+gets matching thread counts for OpenMP (FSL, Workbench), ITK (ANTs) and BLAS,
+instead of the library defaults.
+"""
+import logging
+import os
+import os.path as op
+
+from utils import func_utils
+
+log = logging.getLogger(__name__)
+
+THREAD_VARIABLES = [
+    "OMP_NUM_THREADS",
+    "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "MKL_NUM_THREADS",
+]
+
+
+def thread_environment(threads):
+    """
+    Thread-count environment of a stage allowed `threads` CPUs. Task arrays
+    submitted by the stage run up to `threads` tasks at a time.
+    """
+    environ = {var: str(threads) for var in THREAD_VARIABLES}
+    environ["FSLSUB_LOCAL_SLOTS"] = str(threads)
+    return environ
+
+
+def reduce_threads(context):
+    """
+    Halve the thread counts (and task array slots) of the stages of
+    `context`, in (a copy of) gear_dict["environ"], to lower their memory
+    use.
+    Returns:
+        int: the new thread count, or None if already 1.
+    """
+    environ = dict(context.gear_dict["environ"])
+    threads = int(
+        environ.get("FSLSUB_LOCAL_SLOTS")
+        or environ.get("OMP_NUM_THREADS")
+        or func_utils.available_cpus()
+    )
+    if threads <= 1:
+        return None
+    threads //= 2
+    environ.update(thread_environment(threads))
+    context.gear_dict["environ"] = environ
+    log.info("Threads per stage reduced to %d.", threads)
+    return threads
+
+
+def configure(context, concurrency=1):
+    """
+    Run the pipelines of `context` with the local scheduler, with the CPU
+    budget shared by `concurrency` concurrent stages. Updates
+    gear_dict["command_common"] and (a copy of) gear_dict["environ"].
+    """
+    threads = max(1, func_utils.available_cpus() // concurrency)
+    scheduler_dir = op.join(context.gear_dict["SCRIPT_DIR"], "local_scheduler")
+
+    environ = dict(context.gear_dict["environ"])
+    environ.update(thread_environment(threads))
+    # Job output is streamed by exec_command (utils/args/streaming.py)
+    environ["FSLSUB_LOCAL_STREAM"] = "1"
+    path = environ.get("PATH", os.defpath).split(os.pathsep)
+    if scheduler_dir not in path:
+        environ["PATH"] = os.pathsep.join([scheduler_dir] + path)
+    context.gear_dict["environ"] = environ
+
+    command_common = list(context.gear_dict["command_common"])
+    command_common[0] = op.join(scheduler_dir, "fsl_sub")
+    context.gear_dict["command_common"] = command_common
+
+    memory_limit = func_utils.cgroup_memory_limit()
+    log.info(
+        "Local scheduler: %d threads per stage (%d CPUs, %d concurrent), "
+        "memory limit %s.",
+        threads,
+        func_utils.available_cpus(),
+        concurrency,
+        "none" if memory_limit is None else "{:.1f} GB".format(memory_limit / 1e9),
+    )
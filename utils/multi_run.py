@@ -0,0 +1,291 @@
+"""
+Multi-run mode of the hcp-func gear.
+Additional fMRI runs are provided through the numbered inputs
+"fMRITimeSeries_<n>", "fMRIScout_<n>", fieldmap inputs "<FieldMap>_<n>", and the
+"fMRIName_<n>" configuration (n = 2..MAX_RUNS). A run without fieldmaps of its
+own uses the fieldmaps of the first run, and one without "PartialZip_<n>" looks
+for its partial output in "PartialZip". All runs share the StructZip,
+license, gradient coefficients and the unpacked structural tree. Their
+fMRIVolume -> fMRISurface -> QC (-> metrics -> chunked export) chains run
+concurrently; a failed run does not stop its siblings.
+"""
+import logging
+import os.path as op
+import re
+from collections import ChainMap
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import (
+    chunked_export,
+    func_utils,
+    local_scheduler,
+    packaging,
+    preview,
+    qc_metrics,
+    stages,
+)
+from utils.args import (
+    GenericfMRISurfaceProcessingPipeline,
+    GenericfMRIVolumeProcessingPipeline,
+    hcpfunc_qc_mosaic,
+)
+
+log = logging.getLogger(__name__)
+
+MAX_RUNS = 4
+
+# Inputs that belong to a single run
+SERIES_INPUTS = ["fMRITimeSeries", "fMRIScout"]
+# Inputs of a single run, falling back to those of the first run
+RESUME_INPUTS = ["PartialZip"]
+FIELDMAP_INPUTS = [
+    "SpinEchoPositive",
+    "SpinEchoNegative",
+    "SiemensGREMagnitude",
+    "SiemensGREPhase",
+]
+
+# Approximate peak memory of one fMRIVolume/fMRISurface chain
+RUN_MEMORY_GB = 8
+
+
+class RunContext(object):
+    """
+    The gear context as seen by one run of a multi-run invocation.
+    The run's numbered inputs are presented under their usual names, so the
+    existing build/validate/execute functions work unchanged. Values written
+    to gear_dict stay local to the run; reads fall back to the shared context.
+    """
+
+    def __init__(self, context, run_number):
+        self._context = context
+        self.run_number = run_number
+        self.config = dict(context.config)
+        self.gear_dict = ChainMap({}, context.gear_dict)
+
+        inputs = context._invocation["inputs"]
+        suffix = "" if run_number == 1 else "_{}".format(run_number)
+        if run_number > 1:
+            self.config["fMRIName"] = context.config["fMRIName" + suffix]
+
+        # Map of usual input name -> invocation input name
+        self._input_names = {
+            name: name
+            for name in inputs
+            if name not in SERIES_INPUTS + FIELDMAP_INPUTS
+            and not re.search(r"_\d+$", name)
+        }
+        for name in SERIES_INPUTS + RESUME_INPUTS:
+            if name + suffix in inputs:
+                self._input_names[name] = name + suffix
+        fieldmap_suffix = suffix
+        if not any(name + suffix in inputs for name in FIELDMAP_INPUTS):
+            fieldmap_suffix = ""
+        for name in FIELDMAP_INPUTS:
+            if name + fieldmap_suffix in inputs:
+                self._input_names[name] = name + fieldmap_suffix
+
+        self._invocation = dict(context._invocation)
+        self._invocation["inputs"] = {
+            name: inputs[input_name]
+            for name, input_name in self._input_names.items()
+        }
+
+    @property
+    def name(self):
+        return self.config["fMRIName"]
+
+    def get_input_path(self, name):
+        if name not in self._input_names:
+            return None
+        return self._context.get_input_path(self._input_names[name])
+
+    def __getattr__(self, name):
+        return getattr(self._context, name)
+
+
+def collect_runs(context):
+    """
+    Create a RunContext for each fMRI run of this invocation.
+    Args:
+        context: Gear information.
+    Returns:
+        list: RunContext objects, the first being the "fMRITimeSeries" run.
+    """
+    inputs = context._invocation["inputs"]
+    config = context.config
+    runs = [RunContext(context, 1)]
+    for run_number in range(2, MAX_RUNS + 1):
+        suffix = "_{}".format(run_number)
+        if "fMRITimeSeries" + suffix not in inputs:
+            if config.get("fMRIName" + suffix):
+                log.warning(
+                    '"fMRIName%s" is set without "fMRITimeSeries%s". Ignoring.',
+                    suffix,
+                    suffix,
+                )
+            continue
+        if not config.get("fMRIName" + suffix):
+            raise Exception(
+                '"fMRIName{}" must be set to process "fMRITimeSeries{}".'.format(
+                    suffix, suffix
+                )
+            )
+        runs.append(RunContext(context, run_number))
+
+    names = [run.name for run in runs]
+    if len(set(names)) != len(names):
+        raise Exception("Each run must have a unique fMRIName: " + ", ".join(names))
+
+    return runs
+
+
+def concurrency(runs):
+    """
+    Number of runs executed concurrently, within the CPUs and memory.
+    """
+    return min(
+        len(runs),
+        func_utils.available_cpus(),
+        max(1, int(func_utils.available_memory() / (RUN_MEMORY_GB * 1e9))),
+    )
+
+
+def build_runs(runs):
+    """
+    Build and validate the fMRIVolume and fMRISurface parameters of every run
+    before any computation.
+    """
+    for run in runs:
+        try:
+            GenericfMRIVolumeProcessingPipeline.build(run)
+            GenericfMRIVolumeProcessingPipeline.validate(run)
+            GenericfMRISurfaceProcessingPipeline.build(run)
+            qc_metrics.build(run)
+            chunked_export.build(run)
+        except Exception as e:
+            raise Exception("Run {} ({}): {}".format(run.run_number, run.name, e))
+
+
+def _run_outputs(subject, fmriname):
+    """
+    Directories and files of the work directory produced by the run
+    `fmriname`, as relative paths in the form used by the output zip.
+    Returns:
+        tuple: (directories, files)
+    """
+    run_dirs = [
+        op.join(subject, fmriname),
+        op.join(subject, "MNINonLinear", "Results", fmriname),
+        op.join(subject, "T1w", "Results", fmriname),
+    ]
+    run_files = [
+        op.join(subject, "{}_{}_hcpfunc_{}".format(subject, fmriname, kind))
+        for kind in [
+            "config.json",
+            "checkpoints.json",
+            "resources.json",
+            "metrics.json",
+            "metrics.tsv",
+        ]
+    ]
+    return run_dirs, run_files
+
+
+def _execute_run(run):
+    """
+    Execute the fMRIVolume -> fMRISurface -> QC (-> metrics -> chunked export)
+    chain of one run, skipping the stages completed in a partial output zip.
+    Returns:
+        str: None on success, otherwise the name of the failed stage.
+    """
+    hcpfunc_qc_mosaic.build(run)
+    run_stages = [
+        (
+            "fMRI Volume Pipeline",
+            "fMRIVolume",
+            GenericfMRIVolumeProcessingPipeline.execute,
+        ),
+        (
+            "fMRI Surface Pipeline",
+            "fMRISurface",
+            GenericfMRISurfaceProcessingPipeline.execute,
+        ),
+        ("HCP Functional QC Images", "QC", hcpfunc_qc_mosaic.execute),
+    ]
+    if qc_metrics.enabled(run.config):
+        run_stages.append(("QC metrics", "metrics", qc_metrics.execute))
+    if chunked_export.enabled(run.config):
+        run_stages.append(("Chunked export", "export", chunked_export.execute))
+    for description, stage, function in run_stages:
+        log.info("Run %s (%s): %s", run.run_number, run.name, description)
+        try:
+            stages.run_stage(run, stage, function)
+        except Exception as e:
+            log.exception(e)
+            if stage == "metrics":
+                # A screening aid: the run goes on without
+                log.warning(
+                    "Run %s (%s): %s failed. Continuing without.",
+                    run.run_number,
+                    run.name,
+                    description,
+                )
+                continue
+            log.error("Run %s (%s): %s failed!", run.run_number, run.name, description)
+            return description
+    return None
+
+
+def execute(context, runs):
+    """
+    Execute all runs concurrently and package each of them into its own
+    "<subject>_<fMRIName>_hcpfunc.zip" ("_hcpfunc_preview.zip" for a preview).
+    Args:
+        context: Gear information, with the common pipeline settings.
+        runs (list): RunContext objects with built parameters.
+    Returns:
+        int: exit status of the gear.
+    """
+    for run in runs:
+        (
+            run.gear_dict["output_config"],
+            run.gear_dict["output_config_filename"],
+        ) = func_utils.configs_to_export(run)
+        run.gear_dict["output_zip_name"] = op.join(
+            context.output_dir, preview.zip_name(run.config)
+        )
+
+    max_workers = concurrency(runs)
+    log.info("Executing %d runs with %d concurrent workers.", len(runs), max_workers)
+    if context.config["job-scheduler"] == "local":
+        # Concurrent runs share the CPU budget
+        for run in runs:
+            local_scheduler.configure(run, concurrency=max_workers)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        failures = list(executor.map(_execute_run, runs))
+
+    # Each run's zip leaves out the other runs' outputs
+    for run, failure in zip(runs, failures):
+        if failure is not None and not context.config["save-on-error"]:
+            continue
+        exclude = list(context.gear_dict["exclude_from_output"])
+        exclude_dirs = []
+        for other in runs:
+            if other is not run:
+                other_dirs, other_files = _run_outputs(
+                    run.config["Subject"], other.name
+                )
+                exclude_dirs.extend(other_dirs)
+                exclude.extend(other_files)
+        run.gear_dict["exclude_from_output"] = exclude
+        run.gear_dict["exclude_dirs_from_output"] = exclude_dirs
+        packaging.cleanup(run)
+
+    for run, failure in zip(runs, failures):
+        if failure is None:
+            log.info("Run %s (%s) completed.", run.run_number, run.name)
+        else:
+            log.error("Run %s (%s) failed in: %s", run.run_number, run.name, failure)
+
+    return 0 if all(failure is None for failure in failures) else 1
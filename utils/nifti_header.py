@@ -0,0 +1,255 @@
+"""
+Minimal NIfTI-1/NIfTI-2 header reader.
+Only the header is read: for ".nii.gz" files, just the first few hundred
+bytes are decompressed, so multi-GB time series are inspected in
+milliseconds and without numpy/nibabel.
+"""
+import gzip
+import math
+import struct
+
+NIFTI1_HEADER_SIZE = 348
+NIFTI2_HEADER_SIZE = 540
+
+# Spatial and temporal units (xyzt_units) to mm and seconds
+SPATIAL_UNITS = {0: 1.0, 1: 1000.0, 2: 1.0, 3: 0.001}
+TEMPORAL_UNITS = {0: 1.0, 8: 1.0, 16: 0.001, 24: 1e-6}
+# NIfTI datatype codes to array-interface type strings (without byte order)
+DATATYPES = {
+    2: "u1",
+    4: "i2",
+    8: "i4",
+    16: "f4",
+    64: "f8",
+    256: "i1",
+    512: "u2",
+    768: "u4",
+    1024: "i8",
+    1280: "u8",
+}
+
+
+class NiftiHeader(object):
+    """
+    The geometry fields of a NIfTI header.
+    Attributes:
+        filename (str): the file read.
+        version (int): 1 or 2.
+        shape (tuple): dim[1:dim[0]+1].
+        zooms (tuple): voxel sizes (mm) then TR (s) for 4D images.
+        affine (list): 4x4 voxel to world (sform, else qform, else scaling).
+        endian (str): struct byte order, "<" or ">".
+        bitpix (int): bits per voxel.
+        vox_offset (int): offset of the voxel data in the (uncompressed) file.
+        datatype (int): NIfTI datatype code.
+        scl_slope (float): data scaling slope (0: no scaling).
+        scl_inter (float): data scaling intercept.
+    """
+
+    def __init__(
+        self,
+        filename,
+        version,
+        dims,
+        pixdims,
+        xyzt_units,
+        affine,
+        endian="<",
+        bitpix=0,
+        vox_offset=0,
+        datatype=0,
+        scl_slope=0.0,
+        scl_inter=0.0,
+    ):
+        self.filename = filename
+        self.version = version
+        self.endian = endian
+        self.bitpix = bitpix
+        self.vox_offset = int(vox_offset)
+        self.datatype = datatype
+        self.scl_slope = scl_slope
+        self.scl_inter = scl_inter
+        ndim = max(0, min(dims[0], 7))
+        self.shape = tuple(int(d) for d in dims[1 : ndim + 1])
+        spatial = SPATIAL_UNITS.get(xyzt_units & 0x07, 1.0)
+        temporal = TEMPORAL_UNITS.get(xyzt_units & 0x38, 1.0)
+        self.zooms = tuple(
+            abs(pixdims[i + 1]) * (spatial if i < 3 else temporal)
+            for i in range(ndim)
+        )
+        self.affine = affine
+
+    @property
+    def ndim(self):
+        # Trailing singleton dimensions (e.g. a 1 volume 4D scout) do not count
+        shape = list(self.shape)
+        while len(shape) > 3 and shape[-1] == 1:
+            shape.pop()
+        return len(shape)
+
+    @property
+    def volumes(self):
+        return self.shape[3] if len(self.shape) > 3 else 1
+
+    @property
+    def volume_bytes(self):
+        """
+        Size in bytes of one volume of voxel data.
+        """
+        voxels = 1
+        for dim in self.shape[:3]:
+            voxels *= dim
+        return voxels * self.bitpix // 8
+
+    @property
+    def dtype(self):
+        """
+        Type string of the voxel data (e.g. "<f4"), for numpy.
+        """
+        if self.datatype not in DATATYPES:
+            raise Exception(
+                "{}: unsupported NIfTI datatype {}.".format(
+                    self.filename, self.datatype
+                )
+            )
+        return self.endian + DATATYPES[self.datatype]
+
+    @property
+    def tr(self):
+        """
+        Repetition time in seconds, None if unknown.
+        """
+        if len(self.zooms) > 3 and self.zooms[3] > 0:
+            return self.zooms[3]
+        return None
+
+    @property
+    def fov(self):
+        """
+        Field of view in mm along each voxel axis.
+        """
+        return tuple(self.shape[i] * self.zooms[i] for i in range(3))
+
+    @property
+    def orientation(self):
+        """
+        World axis each voxel axis points to, as in "LAS"/"RAS" codes.
+        """
+        labels = [("L", "R"), ("P", "A"), ("I", "S")]
+        codes = ""
+        for axis in range(3):
+            column = [self.affine[row][axis] for row in range(3)]
+            world = max(range(3), key=lambda i: abs(column[i]))
+            codes += labels[world][column[world] > 0]
+        return codes
+
+
+def _quaternion_affine(b, c, d, qfac, pixdims, offsets):
+    a = math.sqrt(max(0.0, 1.0 - (b * b + c * c + d * d)))
+    rotation = [
+        [a * a + b * b - c * c - d * d, 2 * (b * c - a * d), 2 * (b * d + a * c)],
+        [2 * (b * c + a * d), a * a + c * c - b * b - d * d, 2 * (c * d - a * b)],
+        [2 * (b * d - a * c), 2 * (c * d + a * b), a * a + d * d - c * c - b * b],
+    ]
+    scale = [pixdims[1], pixdims[2], pixdims[3] * (-1 if qfac < 0 else 1)]
+    affine = [
+        [rotation[row][col] * scale[col] for col in range(3)] + [offsets[row]]
+        for row in range(3)
+    ]
+    return affine + [[0.0, 0.0, 0.0, 1.0]]
+
+
+def open_nifti(filename):
+    if filename.endswith(".gz"):
+        return gzip.open(filename, "rb")
+    return open(filename, "rb")
+
+
+def read_header(filename):
+    """
+    Read the header of a NIfTI-1 or NIfTI-2 file (optionally gzipped).
+    Returns:
+        NiftiHeader: the header.
+    """
+    with open_nifti(filename) as fp:
+        data = fp.read(NIFTI2_HEADER_SIZE)
+
+    for endian in "<>":
+        if len(data) >= 4:
+            size = struct.unpack(endian + "i", data[:4])[0]
+            if size in (NIFTI1_HEADER_SIZE, NIFTI2_HEADER_SIZE):
+                break
+    else:
+        raise Exception("{} is not a NIfTI file.".format(filename))
+    if len(data) < size:
+        raise Exception("{} has a truncated NIfTI header.".format(filename))
+
+    def unpack(fmt, offset):
+        return struct.unpack_from(endian + fmt, data, offset)
+
+    if size == NIFTI1_HEADER_SIZE:
+        version = 1
+        dims = unpack("8h", 40)
+        datatype, bitpix = unpack("2h", 70)
+        pixdims = unpack("8f", 76)
+        vox_offset, scl_slope, scl_inter = unpack("3f", 108)
+        xyzt_units = data[123]
+        qform_code, sform_code = unpack("2h", 252)
+        quatern = unpack("6f", 256)
+        srows = unpack("12f", 280)
+    else:
+        version = 2
+        datatype, bitpix = unpack("2h", 12)
+        dims = unpack("8q", 16)
+        pixdims = unpack("8d", 104)
+        vox_offset = unpack("q", 168)[0]
+        scl_slope, scl_inter = unpack("2d", 176)
+        qform_code, sform_code = unpack("2i", 344)
+        quatern = unpack("6d", 352)
+        srows = unpack("12d", 400)
+        xyzt_units = unpack("i", 500)[0]
+
+    if sform_code > 0:
+        affine = [list(srows[row * 4 : row * 4 + 4]) for row in range(3)]
+        affine.append([0.0, 0.0, 0.0, 1.0])
+    elif qform_code > 0:
+        affine = _quaternion_affine(
+            quatern[0], quatern[1], quatern[2], pixdims[0], pixdims, quatern[3:]
+        )
+    else:
+        affine = [
+            [pixdims[1], 0.0, 0.0, 0.0],
+            [0.0, pixdims[2], 0.0, 0.0],
+            [0.0, 0.0, pixdims[3], 0.0],
+            [0.0, 0.0, 0.0, 1.0],
+        ]
+    return NiftiHeader(
+        filename,
+        version,
+        dims,
+        pixdims,
+        xyzt_units,
+        affine,
+        endian,
+        bitpix,
+        vox_offset,
+        datatype,
+        scl_slope,
+        scl_inter,
+    )
+
+
+def with_volumes(data, header, volumes, tr_scale=1.0):
+    """
+    Copy of the raw header bytes `data` of `header` for a time series of
+    `volumes` volumes sampled every `tr_scale` original TRs.
+    """
+    data = bytearray(data)
+    if header.version == 1:
+        dim_format, dim_offset, pixdim_format, pixdim_offset = "h", 48, "f", 92
+    else:
+        dim_format, dim_offset, pixdim_format, pixdim_offset = "q", 48, "d", 136
+    struct.pack_into(header.endian + dim_format, data, dim_offset, volumes)
+    tr = struct.unpack_from(header.endian + pixdim_format, data, pixdim_offset)[0]
+    struct.pack_into(header.endian + pixdim_format, data, pixdim_offset, tr * tr_scale)
+    return bytes(data)
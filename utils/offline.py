@@ -0,0 +1,218 @@
+"""
+Offline build and validation of hcp-func parameters, without the Flywheel
+SDK or a gear run, to screen candidate acquisitions in bulk.
+Each record is a plain dict, e.g. exported to JSON:
+    {
+        "id": "ses-01_acq-rest",
+        "config": {"Subject": "sub-01", "fMRIName": "rfMRI_REST1_RL", ...},
+        "inputs": {
+            "fMRITimeSeries": {"path": "...", "info": {...}},
+            "SpinEchoPositive": {"path": "...", "info": {...}},
+            ...
+        },
+        "hcp_struct_config": {"config": {"RegName": "MSMSulc"}}
+    }
+Missing configuration options take their manifest defaults. The same
+`build`/`validate` functions as the gear are run; inputs are not staged, and
+the NIfTI header pre-flight is only run with --headers (input files present).
+
+    python3 -m utils.offline records.json [-o results.jsonl] [--headers]
+"""
+import argparse
+import json
+import logging
+import os
+import os.path as op
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from utils.args import (
+    GenericfMRISurfaceProcessingPipeline,
+    GenericfMRIVolumeProcessingPipeline,
+)
+
+log = logging.getLogger(__name__)
+
+MANIFEST = op.join(op.dirname(op.dirname(op.abspath(__file__))), "manifest.json")
+WORK_DIR = "/flywheel/v0/work"
+DEFAULT_ENVIRON = {"HCPPIPEDIR_Config": "/opt/HCP-Pipelines/global/config"}
+# Records per worker task
+CHUNK_SIZE = 256
+
+
+class OfflineContext(object):
+    """
+    The subset of the gear context used by the build/validate functions,
+    from a plain record.
+    """
+
+    def __init__(self, record, manifest_config, environ, check_headers=False):
+        self.config = {
+            key: spec["default"]
+            for key, spec in manifest_config.items()
+            if "default" in spec
+        }
+        self.config.update(record.get("config", {}))
+        self.config.setdefault("Subject", record.get("id", "offline"))
+        self.work_dir = record.get("work_dir", WORK_DIR)
+        self.output_dir = self.work_dir
+        self.log = log
+        self._paths = {}
+        inputs = {}
+        for name, value in record.get("inputs", {}).items():
+            self._paths[name] = value.get("path", name)
+            inputs[name] = {
+                "base": "file",
+                "location": {"path": self._paths[name]},
+                "object": {"info": value.get("info", {})},
+            }
+        self._invocation = {"inputs": inputs}
+        self.gear_dict = {
+            "environ": environ,
+            "hcp_struct_config": record.get("hcp_struct_config", {"config": {}}),
+            "header-preflight": check_headers,
+            # Inputs are referenced where they are, not staged
+            "stage-inputs": False,
+        }
+
+    def get_input_path(self, name):
+        return self._paths.get(name)
+
+
+def check_config(config, manifest_config):
+    """
+    Check enumerated configuration options against the manifest.
+    """
+    for key, spec in manifest_config.items():
+        if "enum" in spec and config.get(key) is not None:
+            if config[key] not in spec["enum"]:
+                raise Exception(
+                    "Invalid {}: {!r} is not one of {}".format(
+                        key, config[key], spec["enum"]
+                    )
+                )
+
+
+def screen_record(record, manifest_config, environ, check_headers=False):
+    """
+    Build and validate the parameters of one record.
+    Returns:
+        OrderedDict: id, status ("valid" or "invalid"), and the error or the
+            built "Vol-params" and "Surf-params".
+    """
+    result = OrderedDict([("id", record.get("id"))])
+    try:
+        context = OfflineContext(record, manifest_config, environ, check_headers)
+        check_config(context.config, manifest_config)
+        GenericfMRIVolumeProcessingPipeline.build(context)
+        GenericfMRIVolumeProcessingPipeline.validate(context)
+        GenericfMRISurfaceProcessingPipeline.build(context)
+    except Exception as e:
+        result["status"] = "invalid"
+        result["error"] = str(e)
+        return result
+    result["status"] = "valid"
+    result["Vol-params"] = context.gear_dict["Vol-params"]
+    result["Surf-params"] = context.gear_dict["Surf-params"]
+    return result
+
+
+def _screen_chunk(records, manifest_config, environ, check_headers):
+    return [
+        screen_record(record, manifest_config, environ, check_headers)
+        for record in records
+    ]
+
+
+def load_manifest_config(filename=MANIFEST):
+    with open(filename) as fp:
+        return json.load(fp)["config"]
+
+
+def screen(records, workers=1, check_headers=False, manifest_config=None):
+    """
+    Screen records, in chunks of CHUNK_SIZE records over `workers` processes.
+    Yields:
+        OrderedDict: the result of each record, in order.
+    """
+    if manifest_config is None:
+        manifest_config = load_manifest_config()
+    environ = dict(DEFAULT_ENVIRON)
+    environ.update(os.environ)
+    chunks = [
+        records[start : start + CHUNK_SIZE]
+        for start in range(0, len(records), CHUNK_SIZE)
+    ]
+    if workers <= 1 or len(chunks) <= 1:
+        for chunk in chunks:
+            for result in _screen_chunk(chunk, manifest_config, environ, check_headers):
+                yield result
+        return
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(
+                _screen_chunk, chunk, manifest_config, environ, check_headers
+            )
+            for chunk in chunks
+        ]
+        for future in futures:
+            for result in future.result():
+                yield result
+
+
+def load_records(filename):
+    """
+    Records from a JSON list or a JSON-lines file.
+    """
+    with open(filename) as fp:
+        text = fp.read()
+    if text.lstrip().startswith("["):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build and validate hcp-func parameters offline."
+    )
+    parser.add_argument("records", help="JSON list or JSON-lines file of records")
+    parser.add_argument("-o", "--output", help="JSON-lines results (default: stdout)")
+    parser.add_argument(
+        "--headers",
+        action="store_true",
+        help="also run the NIfTI header pre-flight (input files must exist)",
+    )
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    # The gear's modules log every parameter; keep the screening output short
+    logging.getLogger("utils").setLevel(logging.ERROR)
+
+    records = load_records(args.records)
+    start = time.time()
+    invalid = 0
+    output = open(args.output, "w") if args.output else sys.stdout
+    try:
+        for result in screen(records, args.workers, args.headers):
+            invalid += result["status"] != "valid"
+            output.write(json.dumps(result) + "\n")
+    finally:
+        if args.output:
+            output.close()
+    elapsed = time.time() - start
+    sys.stderr.write(
+        "{} records: {} valid, {} invalid in {:.2f}s ({:.0f} records/s)\n".format(
+            len(records),
+            len(records) - invalid,
+            invalid,
+            elapsed,
+            len(records) / max(elapsed, 1e-9),
+        )
+    )
+    return 1 if invalid else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,587 @@
+"""
+Parallel, streaming packaging of the hcp-func work directory.
+Replaces the serial zipping of `results.zip_output` (hcp-base) in `cleanup`:
+    * the exclusion list (hcp-struct members) is indexed once into a set and a
+      prefix trie instead of being scanned for every file,
+    * members are deflated concurrently in worker threads (zlib releases the
+      GIL) and streamed, in order, into the output zip,
+    * already-compressed members (e.g. ".nii.gz") are stored, not recompressed,
+    * with "uncompressed-intermediates" (experimental), the HCP Pipelines
+      write the working tree as uncompressed NIfTI and the NIfTI members of
+      a completed run are gzipped, by the same workers, into ".nii.gz"
+      members; an incomplete run is packaged as written, to be resumed,
+    * with "output-archives" set to 'split', a completed run is packaged
+      into one archive per consumer (see ARCHIVES) and a JSON index of their
+      members.
+"""
+import glob
+import gzip
+import hashlib
+import json
+import logging
+import os
+import os.path as op
+import re
+import shutil
+import struct
+import tempfile
+import time
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import checkpoints, func_utils, instrumentation, qc_metrics, results
+
+log = logging.getLogger(__name__)
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_MARKER = 0xFFFFFFFF
+CHUNK_SIZE = 1024 * 1024
+# Compressed members larger than this are spooled to disk
+SPOOL_MAX_SIZE = 16 * 1024 * 1024
+# Chunked series (utils/chunked_export.py) are stored to stay memory-mappable
+STORED_EXTENSIONS = (".gz", ".zip", ".png", ".jpg", ".bz2", ".xz", ".chunks")
+# CIFTI files (".dtseries.nii", ...) are never gzipped
+CIFTI_EXTENSION = re.compile(r"\.[dp](conn|scalar|label|tseries)\.nii$")
+# Fast: each NIfTI file is gzipped once, at packaging
+GZIP_LEVEL = 1
+# Archives of a split output, by consumer:
+#   results: MNINonLinear/Results/<fMRIName> and T1w/Results/<fMRIName>, the
+#       final volume and CIFTI series (ICA-FIX, task analysis, group averages)
+#   intermediates: the <fMRIName> working tree (registration, distortion and
+#       motion correction products) and anything else
+#   qc: reports (configuration, checkpoints, resources, metrics), QC images
+#       and the logs of the run
+ARCHIVES = ("results", "intermediates", "qc")
+INDEX_FORMAT = "hcpfunc-archive-index"
+INDEX_VERSION = 1
+
+
+class ExclusionIndex(object):
+    """
+    Constant-time membership test for paths excluded from the output.
+    Args:
+        paths (list): exact paths to exclude (e.g. the hcp-struct members).
+        prefixes (list): directories whose whole subtree is excluded.
+    """
+
+    END = None
+
+    def __init__(self, paths=(), prefixes=()):
+        self.paths = set(paths)
+        self.trie = {}
+        for prefix in prefixes:
+            node = self.trie
+            for part in prefix.strip("/").split("/"):
+                node = node.setdefault(part, {})
+            node[self.END] = True
+
+    def __contains__(self, path):
+        if path in self.paths:
+            return True
+        node = self.trie
+        for part in path.split("/"):
+            node = node.get(part)
+            if node is None:
+                return False
+            if self.END in node:
+                return True
+        return False
+
+
+def _dos_datetime(mtime):
+    """
+    Zip (MS-DOS) time and date fields for a timestamp.
+    """
+    tm = time.localtime(mtime)
+    if tm.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    dostime = (tm.tm_hour << 11) | (tm.tm_min << 5) | (tm.tm_sec // 2)
+    dosdate = ((tm.tm_year - 1980) << 9) | (tm.tm_mon << 5) | tm.tm_mday
+    return dostime, dosdate
+
+
+def _field32(value):
+    """
+    Value of a 32 bit zip field, or the marker pointing to its zip64 record.
+    """
+    return value if value < ZIP64_LIMIT else ZIP64_MARKER
+
+
+class ZipStreamWriter(object):
+    """
+    Minimal sequential zip writer for members whose CRC and sizes are known
+    before their data is written. Zip64 records are used where needed.
+    """
+
+    def __init__(self, fileobj):
+        self.fp = fileobj
+        self.offset = 0
+        self.entries = []
+
+    def _write(self, data):
+        self.fp.write(data)
+        self.offset += len(data)
+
+    def add(self, arcname, chunks, crc, compress_size, file_size, method, st):
+        """
+        Write one member.
+        Args:
+            arcname (str): name of the member.
+            chunks (iterable): bytes of the (compressed) member data.
+            crc (int): CRC-32 of the uncompressed data.
+            compress_size (int): size of the data in `chunks`.
+            file_size (int): uncompressed size.
+            method (int): ZIP_STORED or ZIP_DEFLATED.
+            st (os.stat_result): stat of the source file.
+        """
+        name = arcname.encode("utf-8")
+        # Flag UTF-8 names
+        flags = 0 if len(name) == len(arcname) else 0x800
+        dostime, dosdate = _dos_datetime(st.st_mtime)
+        header_offset = self.offset
+        if file_size >= ZIP64_LIMIT or compress_size >= ZIP64_LIMIT:
+            version = 45
+            extra = struct.pack("<HHQQ", 1, 16, file_size, compress_size)
+            sizes = (ZIP64_MARKER, ZIP64_MARKER)
+        else:
+            version = 20
+            extra = b""
+            sizes = (compress_size, file_size)
+        self._write(
+            struct.pack(
+                "<IHHHHHIIIHH",
+                0x04034B50,
+                version,
+                flags,
+                method,
+                dostime,
+                dosdate,
+                crc,
+                sizes[0],
+                sizes[1],
+                len(name),
+                len(extra),
+            )
+            + name
+            + extra
+        )
+        for chunk in chunks:
+            self._write(chunk)
+        self.entries.append(
+            (
+                name,
+                flags,
+                method,
+                dostime,
+                dosdate,
+                crc,
+                compress_size,
+                file_size,
+                header_offset,
+                st.st_mode & 0xFFFF,
+            )
+        )
+
+    def close(self):
+        """
+        Write the central directory and end records.
+        """
+        cd_offset = self.offset
+        for entry in self.entries:
+            (name, flags, method, dostime, dosdate, crc) = entry[:6]
+            compress_size, file_size, header_offset, mode = entry[6:]
+            zip64_fields = [
+                value
+                for value in (file_size, compress_size, header_offset)
+                if value >= ZIP64_LIMIT
+            ]
+            extra = b""
+            version = 20
+            if zip64_fields:
+                version = 45
+                extra = struct.pack(
+                    "<HH" + "Q" * len(zip64_fields),
+                    1,
+                    8 * len(zip64_fields),
+                    *zip64_fields
+                )
+            self._write(
+                struct.pack(
+                    "<IHHHHHHIIIHHHHHII",
+                    0x02014B50,
+                    (3 << 8) | version,
+                    version,
+                    flags,
+                    method,
+                    dostime,
+                    dosdate,
+                    crc,
+                    _field32(compress_size),
+                    _field32(file_size),
+                    len(name),
+                    len(extra),
+                    0,
+                    0,
+                    0,
+                    mode << 16,
+                    _field32(header_offset),
+                )
+                + name
+                + extra
+            )
+        cd_size = self.offset - cd_offset
+        count = len(self.entries)
+        if count >= 0xFFFF or cd_size >= ZIP64_LIMIT or cd_offset >= ZIP64_LIMIT:
+            eocd64_offset = self.offset
+            self._write(
+                struct.pack(
+                    "<IQHHIIQQQQ",
+                    0x06064B50,
+                    44,
+                    45,
+                    45,
+                    0,
+                    0,
+                    count,
+                    count,
+                    cd_size,
+                    cd_offset,
+                )
+            )
+            self._write(struct.pack("<IIQI", 0x07064B50, 0, eocd64_offset, 1))
+        self._write(
+            struct.pack(
+                "<IHHHHIIH",
+                0x06054B50,
+                0,
+                0,
+                min(count, 0xFFFF),
+                min(count, 0xFFFF),
+                _field32(cd_size),
+                _field32(cd_offset),
+                0,
+            )
+        )
+        self.fp.flush()
+
+
+def _read_chunks(fileobj):
+    return iter(lambda: fileobj.read(CHUNK_SIZE), b"")
+
+
+class _ChecksummedFile(object):
+    """
+    File object writing to `fileobj` while computing the CRC and size of
+    the data written.
+    """
+
+    def __init__(self, fileobj, sha256=False):
+        self.fileobj = fileobj
+        self.crc = 0
+        self.size = 0
+        self.sha256 = hashlib.sha256() if sha256 else None
+
+    def write(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+        if self.sha256 is not None:
+            self.sha256.update(data)
+        return self.fileobj.write(data)
+
+    def flush(self):
+        self.fileobj.flush()
+
+
+def _gzip_member(path, spool_dir, st):
+    """
+    Gzip an uncompressed NIfTI member into a spool file, stored as is.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE, dir=spool_dir)
+    checksummed = _ChecksummedFile(spool)
+    with open(path, "rb") as fl, gzip.GzipFile(
+        op.basename(path), "wb", GZIP_LEVEL, checksummed, st.st_mtime
+    ) as gz:
+        for chunk in _read_chunks(fl):
+            gz.write(chunk)
+    spool.seek(0)
+    size = checksummed.size
+    return ZIP_STORED, checksummed.crc & 0xFFFFFFFF, size, size, spool, st
+
+
+def _compress_member(path, spool_dir, gzip_member=False):
+    """
+    Compute the CRC and sizes of a member, deflating it into a spool file
+    unless it is already compressed, or gzipping it (`gzip_member`). Run in
+    a worker thread.
+    Returns:
+        tuple: (method, crc, compress_size, file_size, spool or None, stat)
+    """
+    st = os.stat(path)
+    crc = 0
+    file_size = 0
+    if gzip_member:
+        return _gzip_member(path, spool_dir, st)
+    if path.endswith(STORED_EXTENSIONS):
+        with open(path, "rb") as fl:
+            for chunk in _read_chunks(fl):
+                crc = zlib.crc32(chunk, crc)
+                file_size += len(chunk)
+        return ZIP_STORED, crc & 0xFFFFFFFF, file_size, file_size, None, st
+
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE, dir=spool_dir)
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    with open(path, "rb") as fl:
+        for chunk in _read_chunks(fl):
+            crc = zlib.crc32(chunk, crc)
+            file_size += len(chunk)
+            spool.write(compressor.compress(chunk))
+    spool.write(compressor.flush())
+    compress_size = spool.tell()
+    if compress_size >= file_size:
+        # Incompressible: store instead
+        spool.close()
+        return ZIP_STORED, crc & 0xFFFFFFFF, file_size, file_size, None, st
+    spool.seek(0)
+    return ZIP_DEFLATED, crc & 0xFFFFFFFF, compress_size, file_size, spool, st
+
+
+def _write_member(writer, path, arcname, future):
+    method, crc, compress_size, file_size, spool, st = future.result()
+    with (open(path, "rb") if spool is None else spool) as data:
+        writer.add(
+            arcname, _read_chunks(data), crc, compress_size, file_size, method, st
+        )
+
+
+def write_zip(zip_filename, members, workers=None, spool_dir=None, gzip_nifti=False):
+    """
+    Write `members` into `zip_filename`, compressing them in parallel.
+    Members are written in the given order; at most 2 x workers compressed
+    members are held (in memory or spooled to `spool_dir`) at any time.
+    Args:
+        zip_filename (str): zip file to create.
+        members (list): (path, arcname) tuples.
+        workers (int): number of compression threads (default: available cpus).
+        spool_dir (str): directory for spooled compressed members.
+        gzip_nifti (bool): gzip uncompressed NIfTI members into ".nii.gz"
+            members.
+    Returns:
+        OrderedDict: size and SHA-256 of the zip, and the name, size,
+            compressed size, CRC-32 and local header offset of its members.
+    """
+    if workers is None:
+        workers = func_utils.available_cpus()
+    with open(zip_filename, "wb") as fp, ThreadPoolExecutor(workers) as executor:
+        checksummed = _ChecksummedFile(fp, sha256=True)
+        writer = ZipStreamWriter(checksummed)
+        pending = deque()
+        for path, arcname in members:
+            gzip_member = (
+                gzip_nifti
+                and arcname.endswith(".nii")
+                and not CIFTI_EXTENSION.search(arcname)
+            )
+            if gzip_member:
+                arcname += ".gz"
+            future = executor.submit(_compress_member, path, spool_dir, gzip_member)
+            pending.append((path, arcname, future))
+            while len(pending) >= 2 * workers:
+                _write_member(writer, *pending.popleft())
+        while pending:
+            _write_member(writer, *pending.popleft())
+        writer.close()
+    members = [
+        OrderedDict(
+            [
+                ("name", entry[0].decode("utf-8")),
+                ("size", entry[7]),
+                ("compress_size", entry[6]),
+                ("crc32", "{:08x}".format(entry[5])),
+                ("offset", entry[8]),
+            ]
+        )
+        for entry in writer.entries
+    ]
+    return OrderedDict(
+        [
+            ("archive", op.basename(zip_filename)),
+            ("size", checksummed.size),
+            ("sha256", checksummed.sha256.hexdigest()),
+            ("members", members),
+        ]
+    )
+
+
+def defer_compression(context):
+    """
+    Have the HCP Pipelines write uncompressed NIfTI intermediates, gzipped
+    only when packaged ("uncompressed-intermediates").
+    Experimental: the FSL default output type applies to the whole run, and
+    it was not validated against the HCP Pipelines, some of whose scripts
+    name FSL outputs ".nii.gz" explicitly.
+    """
+    context.gear_dict["environ"]["FSLOUTPUTTYPE"] = "NIFTI"
+    log.warning(
+        "Experimental: intermediates are uncompressed, gzipped when packaged."
+    )
+
+
+def archive_role(arcname, subject, fmriname):
+    """
+    The archive of a split output holding the member `arcname`.
+    """
+    results_dirs = [
+        "/".join([subject, space, "Results", fmriname]) + "/"
+        for space in ["MNINonLinear", "T1w"]
+    ]
+    if arcname.startswith(tuple(results_dirs)):
+        return "results"
+    if arcname.startswith("{0}/{0}_{1}_hcpfunc_".format(subject, fmriname)):
+        return "qc"
+    return "intermediates"
+
+
+def _is_complete(context):
+    """
+    Whether every enabled stage of the run completed: partial outputs stay in
+    one archive, the PartialZip input of a resumed run.
+    """
+    record = checkpoints.read_record(context)
+    # The QC metrics may fail without failing the run
+    return all(
+        stage in record
+        for stage in checkpoints.enabled_stages(context)
+        if stage != "metrics"
+    )
+
+
+def write_split_archives(context, members):
+    """
+    Write the members of a run into one zip per consumer (ARCHIVES), named
+    after gear_dict["output_zip_name"], and their index
+    "<subject>_<fMRIName>_hcpfunc[_preview]_index.json".
+    Args:
+        members (list): (path, arcname) tuples.
+    Returns:
+        str: path of the index.
+    """
+    config = context.config
+    root = context.gear_dict["output_zip_name"][: -len(".zip")]
+    archives = OrderedDict((role, []) for role in ARCHIVES)
+    for path, arcname in members:
+        role = archive_role(arcname, config["Subject"], config["fMRIName"])
+        archives[role].append((path, arcname))
+    # QC images and logs of the run, outside of the Subject directory
+    qc_image_root = "{}_{}.hcp_func_QC.".format(config["Subject"], config["fMRIName"])
+    patterns = [
+        op.join(context.work_dir, glob.escape(qc_image_root) + "*.png"),
+        op.join(context.work_dir, "logs", glob.escape(config["fMRIName"]) + "_*"),
+    ]
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)):
+            archives["qc"].append((path, op.relpath(path, context.work_dir)))
+
+    index = OrderedDict(
+        [
+            ("format", INDEX_FORMAT),
+            ("version", INDEX_VERSION),
+            ("Subject", config["Subject"]),
+            ("fMRIName", config["fMRIName"]),
+            ("archives", OrderedDict()),
+        ]
+    )
+    for role, role_members in archives.items():
+        zip_filename = "{}_{}.zip".format(root, role)
+        log.info(
+            "Zipping output file %s (%d members)", zip_filename, len(role_members)
+        )
+        index["archives"][role] = write_zip(
+            zip_filename,
+            role_members,
+            spool_dir=context.work_dir,
+            gzip_nifti=bool(config.get("uncompressed-intermediates")),
+        )
+    index_filename = root + "_index.json"
+    with open(index_filename, "w") as fp:
+        json.dump(index, fp, indent=1)
+    log.info("Wrote %s", index_filename)
+    return index_filename
+
+
+def zip_output(context):
+    """
+    Compress the Subject directory of the work directory into
+    context.gear_dict["output_zip_name"]. Paths in
+    context.gear_dict["exclude_from_output"] and subtrees in
+    context.gear_dict["exclude_dirs_from_output"] are left out.
+    Replaces `results.zip_output` of hcp-base in `cleanup`. The resource
+    report is packaged, and copied with the packaging stage to the output
+    directory. With "output-archives" set to 'split', a completed run is
+    packaged by `write_split_archives` instead.
+    """
+    config = context.config
+    gear_dict = context.gear_dict
+    outputzipname = gear_dict["output_zip_name"]
+
+    if "remove_files" in gear_dict.keys():
+        with instrumentation.stage(context, "intermediate removal"):
+            gear_dict["remove_files"](context)
+    instrumentation.write_report(context)
+
+    exclude = ExclusionIndex(
+        gear_dict.get("exclude_from_output", []),
+        gear_dict.get("exclude_dirs_from_output", []),
+    )
+    members = []
+    for root, dirs, files in os.walk(op.join(context.work_dir, config["Subject"])):
+        dirs.sort()
+        for fl in sorted(files):
+            path = op.join(root, fl)
+            arcname = op.relpath(path, context.work_dir)
+            if arcname not in exclude:
+                members.append((path, arcname))
+
+    complete = _is_complete(context)
+    split = config.get("output-archives", "single") == "split"
+    if split and not complete:
+        log.info("Incomplete run: packaged in a single archive.")
+        split = False
+    # An incomplete run is packaged as written: resumed from (PartialZip), its
+    # tree must not mix gzipped and uncompressed NIfTI
+    gzip_nifti = bool(config.get("uncompressed-intermediates")) and complete
+    with instrumentation.stage(context, "packaging"):
+        if split:
+            write_split_archives(context, members)
+        else:
+            log.info(
+                "Zipping output file %s (%d members)", outputzipname, len(members)
+            )
+            write_zip(
+                outputzipname,
+                members,
+                spool_dir=context.work_dir,
+                gzip_nifti=gzip_nifti,
+            )
+    instrumentation.write_report(context, context.output_dir)
+    # The QC metrics can be screened without opening the output zip
+    for filename in qc_metrics.report_filenames(context):
+        if op.isfile(filename):
+            shutil.copy(filename, context.output_dir)
+
+
+def cleanup(context):
+    """
+    `results.cleanup` of hcp-base (QC images, configuration, logs and
+    metadata), the output being packaged by `zip_output`. hcp-base calls its
+    own zip_output by name: it is bound to `zip_output` for the duration of
+    the call only, and restored afterwards.
+    """
+    serial_zip_output = results.zip_output
+    results.zip_output = zip_output
+    try:
+        results.cleanup(context)
+    finally:
+        results.zip_output = serial_zip_output
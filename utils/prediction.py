@@ -0,0 +1,308 @@
+"""
+Prediction of the wall time, peak memory and peak scratch disk of a job.
+Each stage is modelled as `a + b * work`, where the work of a stage is
+derived from the input header dimensions (matrix, volumes), "fmrires",
+"lowresmesh" and the StructZip size. Coefficients are fitted on a
+calibration table built from the resource reports of past runs (see
+utils/instrumentation.py), per distortion correction and motion correction
+method when enough runs are available, and fall back to defaults otherwise.
+
+Build a calibration table from resource reports:
+    python3 -m utils.prediction -o calibration.json *_hcpfunc_resources.json
+"""
+import argparse
+import json
+import logging
+import os.path as op
+from collections import OrderedDict
+
+from utils import preflight, preview
+
+log = logging.getLogger(__name__)
+
+METRICS = ["wall_seconds", "peak_rss_bytes", "scratch_peak_bytes"]
+# Stages predicted, in execution order
+STAGES = ["unzip", "fMRIVolume", "fMRISurface", "QC", "packaging"]
+# Stages common to all runs of a job
+SHARED_STAGES = ["unzip"]
+# Calibration runs needed to fit a model for a dcmethod/mctype combination
+MIN_RUNS = 3
+
+# MNI152 2mm grid, scaled to the final fMRI resolution
+MNI_2MM_VOXELS = 91 * 109 * 91
+
+# Default (a, b) of each metric for each stage, from typical 3T runs
+DEFAULT_MODELS = {
+    "unzip": {
+        "wall_seconds": (10.0, 2e-8),
+        "peak_rss_bytes": (2e8, 0.0),
+        "scratch_peak_bytes": (0.0, 2.5),
+    },
+    "fMRIVolume": {
+        "wall_seconds": (600.0, 1.3e-5),
+        "peak_rss_bytes": (1e9, 10.0),
+        "scratch_peak_bytes": (0.0, 30.0),
+    },
+    "fMRISurface": {
+        "wall_seconds": (300.0, 2e-6),
+        "peak_rss_bytes": (1e9, 8.0),
+        "scratch_peak_bytes": (0.0, 34.0),
+    },
+    "QC": {
+        "wall_seconds": (30.0, 2e-7),
+        "peak_rss_bytes": (5e8, 4.0),
+        "scratch_peak_bytes": (0.0, 34.0),
+    },
+    "packaging": {
+        "wall_seconds": (10.0, 1e-7),
+        "peak_rss_bytes": (2e8, 0.0),
+        "scratch_peak_bytes": (0.0, 34.0),
+    },
+}
+
+
+def features(context):
+    """
+    Features of a run used by the models, from the input headers (the
+    volumes kept by a preview) and the built "Vol-params" and "Surf-params".
+    """
+    series = preflight.read_headers(context)["fMRITimeSeries"]
+    vol_params = context.gear_dict["Vol-params"]
+    surf_params = context.gear_dict["Surf-params"]
+    shape = series.shape
+    volumes = series.volumes
+    if preview.enabled(context.config):
+        volumes = len(preview.volume_indices(context.config, volumes)[0])
+    return OrderedDict(
+        [
+            ("input_voxels", shape[0] * shape[1] * shape[2]),
+            ("volumes", volumes),
+            ("fmrires", float(vol_params["fmrires"])),
+            ("lowresmesh", int(surf_params["lowresmesh"])),
+            ("dcmethod", vol_params["dcmethod"]),
+            ("mctype", vol_params["mctype"]),
+            ("struct_bytes", op.getsize(context.get_input_path("StructZip"))),
+        ]
+    )
+
+
+def work(stage, features):
+    """
+    Work of a stage: the quantity its resource usage scales with.
+    """
+    mni_voxels = MNI_2MM_VOXELS * (2.0 / features["fmrires"]) ** 3
+    if stage == "unzip":
+        return features["struct_bytes"]
+    if stage == "fMRIVolume":
+        return features["volumes"] * (features["input_voxels"] + mni_voxels)
+    if stage == "fMRISurface":
+        # Left and right surfaces of "lowresmesh" thousand vertices
+        vertices = 2000 * features["lowresmesh"]
+        return features["volumes"] * (mni_voxels + vertices)
+    return features["volumes"] * mni_voxels
+
+
+def _fit(points):
+    """
+    Least squares (a, b) of y = a + b * x, or None if `points` do not
+    determine a line. A negative slope is replaced by the mean.
+    """
+    if len(points) < 2:
+        return None
+    n = float(len(points))
+    mean_x = sum(x for x, _ in points) / n
+    mean_y = sum(y for _, y in points) / n
+    var_x = sum((x - mean_x) ** 2 for x, _ in points)
+    if var_x == 0:
+        return None
+    b = sum((x - mean_x) * (y - mean_y) for x, y in points) / var_x
+    if b < 0:
+        return mean_y, 0.0
+    return mean_y - b * mean_x, b
+
+
+def load_calibration(filename):
+    """
+    Runs of a calibration table, [] if there is none.
+    """
+    if not filename:
+        return []
+    with open(filename) as fp:
+        return json.load(fp)["runs"]
+
+
+def models(calibration, features):
+    """
+    Models of each stage and metric for a run with `features`.
+    Returns:
+        tuple: (dict stage -> metric -> (a, b), description of the source)
+    """
+    similar = [
+        run
+        for run in calibration
+        if (run["features"]["dcmethod"], run["features"]["mctype"])
+        == (features["dcmethod"], features["mctype"])
+    ]
+    runs = similar if len(similar) >= MIN_RUNS else calibration
+    result = {}
+    fitted = 0
+    for stage in STAGES:
+        result[stage] = {}
+        for metric in METRICS:
+            points = [
+                (work(stage, run["features"]), run["stages"][stage][metric])
+                for run in runs
+                if stage in run["stages"]
+            ]
+            model = _fit(points)
+            if model is None:
+                model = DEFAULT_MODELS[stage][metric]
+            else:
+                fitted += 1
+            result[stage][metric] = model
+    if not fitted:
+        return result, "defaults (uncalibrated)"
+    return result, "calibrated on {} runs".format(len(runs))
+
+
+def predict_run(features, calibration):
+    """
+    Predicted metrics of each stage of a run.
+    Returns:
+        OrderedDict: with "source" and "stages" (stage -> metric -> value).
+    """
+    stage_models, source = models(calibration, features)
+    stages = OrderedDict()
+    for stage in STAGES:
+        x = work(stage, features)
+        stages[stage] = OrderedDict(
+            (metric, int(a + b * x)) for metric, (a, b) in stage_models[stage].items()
+        )
+    return OrderedDict([("source", source), ("stages", stages)])
+
+
+def predict(contexts, concurrency=1):
+    """
+    Predict the resources of a job and store its features and prediction in
+    gear_dict["job-features"] and gear_dict["job-prediction"] of each context.
+    Args:
+        contexts (list): the gear context, or the RunContext of each run.
+        concurrency (int): runs executed concurrently.
+    Returns:
+        OrderedDict: job totals ("wall_seconds", "peak_rss_bytes",
+            "scratch_peak_bytes") and the prediction of each run.
+    """
+    calibration = load_calibration(contexts[0].get_input_path("CalibrationTable"))
+    runs = []
+    for context in contexts:
+        run_features = features(context)
+        run_prediction = predict_run(run_features, calibration)
+        context.gear_dict["job-features"] = run_features
+        context.gear_dict["job-prediction"] = run_prediction
+        runs.append((context.config["fMRIName"], run_prediction["stages"]))
+
+    # Shared stages run once; runs execute `concurrency` at a time and their
+    # outputs accumulate on the scratch disk
+    first = runs[0][1]
+    shared_wall = sum(first[stage]["wall_seconds"] for stage in SHARED_STAGES)
+    run_walls = [
+        sum(
+            stages[stage]["wall_seconds"]
+            for stage in STAGES
+            if stage not in SHARED_STAGES
+        )
+        for _, stages in runs
+    ]
+    run_peaks = sorted(
+        (
+            max(value["peak_rss_bytes"] for value in stages.values())
+            for _, stages in runs
+        ),
+        reverse=True,
+    )
+    job = OrderedDict(
+        [
+            (
+                "wall_seconds",
+                shared_wall + int(sum(run_walls) / float(concurrency)),
+            ),
+            ("peak_rss_bytes", sum(run_peaks[:concurrency])),
+            (
+                "scratch_peak_bytes",
+                sum(
+                    max(value["scratch_peak_bytes"] for value in stages.values())
+                    for _, stages in runs
+                ),
+            ),
+            ("runs", OrderedDict(runs)),
+        ]
+    )
+    log.info(
+        "Predicted job resources (%s): %.1f h wall time, %.1f GB peak memory, "
+        "%.1f GB peak scratch disk.",
+        contexts[0].gear_dict["job-prediction"]["source"],
+        job["wall_seconds"] / 3600.0,
+        job["peak_rss_bytes"] / 1e9,
+        job["scratch_peak_bytes"] / 1e9,
+    )
+    return job
+
+
+def write_prediction(context, job):
+    """
+    Write the job prediction to the output directory.
+    """
+    filename = op.join(
+        context.output_dir,
+        "{}_{}_hcpfunc_prediction.json".format(
+            context.config["Subject"], context.config["fMRIName"]
+        ),
+    )
+    with open(filename, "w") as fp:
+        json.dump(job, fp, indent=4)
+
+
+def calibrate(report_filenames):
+    """
+    Calibration table from resource reports: the features of each run and the
+    usage of its successful stages.
+    """
+    runs = []
+    for filename in report_filenames:
+        with open(filename) as fp:
+            report = json.load(fp)
+        if "job-features" not in report:
+            log.warning("%s has no features. Skipping.", filename)
+            continue
+        stages = {}
+        for record in report["stages"]:
+            if record["status"] != "success" or record["stage"] not in STAGES:
+                continue
+            stages[record["stage"]] = {metric: record[metric] for metric in METRICS}
+        runs.append(
+            OrderedDict(
+                [
+                    ("source", op.basename(filename)),
+                    ("features", report["job-features"]),
+                    ("stages", stages),
+                ]
+            )
+        )
+    return OrderedDict([("version", 1), ("runs", runs)])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build a calibration table from hcp-func resource reports."
+    )
+    parser.add_argument("reports", nargs="+", help="*_hcpfunc_resources.json files")
+    parser.add_argument("-o", "--output", required=True, help="calibration table")
+    args = parser.parse_args()
+    table = calibrate(args.reports)
+    with open(args.output, "w") as fp:
+        json.dump(table, fp, indent=4)
+    print("{} runs written to {}".format(len(table["runs"]), args.output))
+
+
+if __name__ == "__main__":
+    main()
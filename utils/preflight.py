@@ -0,0 +1,160 @@
+"""
+Pre-flight validation of the NIfTI inputs of a run.
+Reads only the headers of fMRITimeSeries, fMRIScout and the field maps, and
+checks their dimensions, voxel sizes, TR, orientation and volume count
+against each other and the Flywheel metadata, so that geometry mismatches
+fail in seconds instead of hours into fMRIVolume.
+"""
+import logging
+
+from utils import nifti_header
+
+log = logging.getLogger(__name__)
+
+# Relative tolerance on voxel sizes and TR
+TOLERANCE = 1e-3
+# Relative tolerance between TR of the header and RepetitionTime metadata
+TR_TOLERANCE = 0.01
+
+FIELDMAP_PAIRS = [
+    ("SpinEchoPositive", "SpinEchoNegative"),
+    ("SiemensGREMagnitude", "SiemensGREPhase"),
+]
+
+
+def _close(a, b, tolerance=TOLERANCE):
+    return abs(a - b) <= tolerance * max(abs(a), abs(b), 1.0)
+
+
+def _same_grid(name, header, ref_name, ref, errors):
+    """
+    Check that `header` has the matrix, voxel sizes and orientation of `ref`.
+    """
+    if header.shape[:3] != ref.shape[:3]:
+        errors.append(
+            "{} matrix {} does not match {} matrix {}.".format(
+                name, header.shape[:3], ref_name, ref.shape[:3]
+            )
+        )
+    if not all(_close(a, b) for a, b in zip(header.zooms[:3], ref.zooms[:3])):
+        errors.append(
+            "{} voxel size {} does not match {} voxel size {}.".format(
+                name, _mm(header.zooms[:3]), ref_name, _mm(ref.zooms[:3])
+            )
+        )
+    _same_orientation(name, header, ref_name, ref, errors)
+
+
+def _same_orientation(name, header, ref_name, ref, errors):
+    if header.orientation != ref.orientation:
+        errors.append(
+            "{} orientation {} does not match {} orientation {}.".format(
+                name, header.orientation, ref_name, ref.orientation
+            )
+        )
+
+
+def _mm(values):
+    return "x".join("{:g}".format(round(value, 4)) for value in values) + " mm"
+
+
+def read_headers(context):
+    """
+    Headers of the NIfTI inputs of the run.
+    Returns:
+        dict: input name -> NiftiHeader.
+    """
+    names = ["fMRITimeSeries", "fMRIScout"]
+    for pair in FIELDMAP_PAIRS:
+        names.extend(pair)
+    headers = {}
+    for name in names:
+        if name in context._invocation["inputs"]:
+            path = context.get_input_path(name)
+            try:
+                headers[name] = nifti_header.read_header(path)
+            except Exception as e:
+                raise Exception(
+                    "Cannot read the NIfTI header of {}: {}".format(name, e)
+                )
+    return headers
+
+
+def validate_inputs(context):
+    """
+    Check the geometry of the NIfTI inputs. Raises an Exception listing every
+    problem found. Skipped if gear_dict["header-preflight"] is False (offline
+    screening without the input files).
+    """
+    if not context.gear_dict.get("header-preflight", True):
+        return
+    inputs = context._invocation["inputs"]
+    headers = read_headers(context)
+    errors = []
+
+    series = headers["fMRITimeSeries"]
+    if series.ndim != 4 or series.volumes < 2:
+        errors.append(
+            "fMRITimeSeries must be a 4D time series, found dimensions {}.".format(
+                series.shape
+            )
+        )
+
+    repetition_time = inputs["fMRITimeSeries"]["object"]["info"].get("RepetitionTime")
+    if series.tr is None:
+        log.warning("fMRITimeSeries header has no TR.")
+    elif repetition_time and not _close(
+        series.tr, float(repetition_time), TR_TOLERANCE
+    ):
+        errors.append(
+            "fMRITimeSeries TR {:g} s does not match RepetitionTime {:g} s.".format(
+                series.tr, float(repetition_time)
+            )
+        )
+
+    if "fMRIScout" in headers:
+        scout = headers["fMRIScout"]
+        if scout.ndim != 3:
+            errors.append(
+                "fMRIScout must be a single volume, found dimensions {}.".format(
+                    scout.shape
+                )
+            )
+        _same_grid("fMRIScout", scout, "fMRITimeSeries", series, errors)
+
+    for first, second in FIELDMAP_PAIRS:
+        if first in headers and second in headers:
+            _same_grid(second, headers[second], first, headers[first], errors)
+
+    # Spin echo field maps must cover the field of view of the time series
+    if "SpinEchoPositive" in headers:
+        spin_echo = headers["SpinEchoPositive"]
+        tolerance = max(series.zooms[:3])
+        if not all(
+            abs(a - b) <= tolerance for a, b in zip(spin_echo.fov, series.fov)
+        ):
+            errors.append(
+                "SpinEchoPositive/Negative field of view {} does not match "
+                "fMRITimeSeries field of view {}.".format(
+                    _mm(spin_echo.fov), _mm(series.fov)
+                )
+            )
+        _same_orientation(
+            "SpinEchoPositive/Negative", spin_echo, "fMRITimeSeries", series, errors
+        )
+
+    for name, header in sorted(headers.items()):
+        log.info(
+            "%s: %s, %s, %s%s",
+            name,
+            "x".join(str(d) for d in header.shape),
+            _mm(header.zooms[:3]),
+            header.orientation,
+            ", TR {:g} s".format(header.tr) if header.tr and header.ndim > 3 else "",
+        )
+
+    if errors:
+        raise Exception(
+            "Pre-flight validation of the NIfTI inputs failed:\n  "
+            + "\n  ".join(errors)
+        )
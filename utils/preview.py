@@ -0,0 +1,115 @@
+"""
+Low-resolution preview of the functional pipeline.
+With the "preview" configuration, fMRIVolume and fMRISurface run on a subset
+of "preview-volumes" volumes of fMRITimeSeries, strided over the whole run or
+the first ones ("preview-subset"), resampled to "preview-resolution" instead
+of "FinalfMRIResolution". The QC images are produced as usual, so distortion
+correction and registration can be checked in a fraction of the compute.
+The output zip is "<subject>_<fMRIName>_hcpfunc_preview.zip".
+"""
+import gzip
+import logging
+import os
+import os.path as op
+import shutil
+
+from utils import nifti_header
+
+log = logging.getLogger(__name__)
+
+COPY_CHUNK = 16 * 1024 * 1024
+
+
+def enabled(config):
+    return bool(config.get("preview"))
+
+
+def final_resolution(config):
+    """
+    The "fmrires" of fMRIVolume and fMRISurface, in mm, spelled as in HCP
+    ("2", "1.60"): fMRISurface compares it to GrayordinatesResolution as a
+    string.
+    """
+    if enabled(config):
+        value = float(config["preview-resolution"])
+    else:
+        value = float(config["FinalfMRIResolution"])
+    if value.is_integer():
+        return "{:g}".format(value)
+    return "{:.2f}".format(value)
+
+
+def zip_name(config):
+    """
+    File name of the output zip of a run.
+    """
+    return "{}_{}_hcpfunc{}.zip".format(
+        config["Subject"], config["fMRIName"], "_preview" if enabled(config) else ""
+    )
+
+
+def volume_indices(config, volumes):
+    """
+    Volumes of a series of `volumes` volumes kept by the preview.
+    Returns:
+        tuple: (list of volume indices, stride between them)
+    """
+    count = max(1, min(config["preview-volumes"], volumes))
+    if config["preview-subset"] == "first":
+        return list(range(count)), 1
+    stride = volumes // count
+    return list(range(0, stride * count, stride)), stride
+
+
+def series_filename(context):
+    """
+    Path of the preview subset of fMRITimeSeries, outside of the packaged
+    Subject directory.
+    """
+    return op.join(
+        context.work_dir,
+        "preview",
+        "{}_preview.nii.gz".format(context.config["fMRIName"]),
+    )
+
+
+def write_series(context):
+    """
+    Write the preview subset of fMRITimeSeries, streaming the selected
+    volumes without loading the series.
+    """
+    source = context.get_input_path("fMRITimeSeries")
+    filename = series_filename(context)
+    header = nifti_header.read_header(source)
+    indices, stride = volume_indices(context.config, header.volumes)
+    volume_bytes = header.volume_bytes
+    log.info(
+        "Preview of %s: %d of %d volumes (every %d), %s mm",
+        context.config["fMRIName"],
+        len(indices),
+        header.volumes,
+        stride,
+        final_resolution(context.config),
+    )
+
+    os.makedirs(op.dirname(filename), exist_ok=True)
+    tmp_filename = filename + ".tmp"
+    with nifti_header.open_nifti(source) as src, gzip.open(
+        tmp_filename, "wb", compresslevel=1
+    ) as dst:
+        data = src.read(header.vox_offset)
+        dst.write(nifti_header.with_volumes(data, header, len(indices), stride))
+        wanted = set(indices)
+        for index in range(indices[-1] + 1):
+            if index in wanted:
+                remaining = volume_bytes
+                while remaining:
+                    chunk = src.read(min(remaining, COPY_CHUNK))
+                    if not chunk:
+                        raise Exception("{} is truncated.".format(source))
+                    dst.write(chunk)
+                    remaining -= len(chunk)
+            else:
+                src.seek(volume_bytes, os.SEEK_CUR)
+    shutil.move(tmp_filename, filename)
+    return filename
@@ -0,0 +1,304 @@
+"""
+Quantitative QC metrics of a run, for automated screening.
+With "qc-metrics", the metrics stage (after QC) writes
+"<subject>/<subject>_<fMRIName>_hcpfunc_metrics.json", a summary, and
+"<subject>/<subject>_<fMRIName>_hcpfunc_metrics.tsv", the per-frame
+metrics, packaged and copied to the output directory:
+    * framewise displacement (FD, Power et al. 2012) from the motion
+      regressors, rotations on a sphere of FD_RADIUS mm;
+    * DVARS (RMS of the frame-to-frame signal change) and the global signal
+      of the final MNI series, inside the fMRI brain mask;
+    * temporal mean and tSNR summaries inside the brain mask;
+    * the correlation ratio (the FLIRT cost) of the T1w brain and the SBRef
+      registered to it, before and after distortion correction: the pair of
+      images of the epi2T1 QC mosaics; null if they are missing.
+The series is read once in chunks of frames, keeping only the brain voxels,
+and the T1w grid in slabs of SLAB_SLICES slices, so memory does not depend
+on the number of frames or the T1w resolution.
+The metrics are a screening aid: a failure of the stage is logged and does
+not fail the run.
+"""
+import csv
+import json
+import logging
+import os.path as op
+from collections import OrderedDict
+
+import numpy as np
+
+from utils import imaging, temporal_stats
+
+log = logging.getLogger(__name__)
+
+# mm, radius of the sphere turning rotations into displacements
+FD_RADIUS = 50.0
+# mm, frames above are counted as high motion
+FD_THRESHOLD = 0.5
+# Intensity bins of the T1w brain for the correlation ratio
+CR_BINS = 256
+# Slices of the T1w grid resampled at once
+SLAB_SLICES = 16
+
+
+def enabled(config):
+    return bool(config.get("qc-metrics", False))
+
+
+def build(context):
+    """
+    Collect the metrics parameters into gear_dict["Metrics-params"].
+    """
+    params = OrderedDict()
+    params["qc-metrics"] = enabled(context.config)
+    params["fd_radius"] = FD_RADIUS
+    params["fd_threshold"] = FD_THRESHOLD
+    params["cr_bins"] = CR_BINS
+    context.gear_dict["Metrics-params"] = params
+
+
+def report_filenames(context, directory=None):
+    """
+    Paths of the JSON summary and the per-frame TSV, by default next to the
+    exported configuration.
+    """
+    config = context.config
+    if directory is None:
+        directory = op.join(context.work_dir, config["Subject"])
+    root = op.join(
+        directory, "{}_{}_hcpfunc_metrics".format(config["Subject"], config["fMRIName"])
+    )
+    return root + ".json", root + ".tsv"
+
+
+def framewise_displacement(regressors):
+    """
+    FD of each frame (0 for the first) from HCP Movement_Regressors: x, y, z
+    translations (mm) and rotations (degrees) in the first six columns.
+    """
+    motion = np.atleast_2d(np.loadtxt(regressors))[:, :6].copy()
+    motion[:, 3:] = np.deg2rad(motion[:, 3:]) * FD_RADIUS
+    fd = np.zeros(motion.shape[0])
+    fd[1:] = np.abs(np.diff(motion, axis=0)).sum(axis=1)
+    return fd
+
+
+def _brain_mask(results_dir, series):
+    try:
+        mask_img = imaging.load_image(op.join(results_dir, "brainmask_fs.*.nii*"))
+        mask = np.asanyarray(mask_img.dataobj).reshape(mask_img.shape[:3]) > 0
+        if mask.shape == series.shape[:3] and mask.any():
+            return mask
+    except Exception as e:
+        log.debug("No fMRI brain mask: %s", e)
+    log.warning("No fMRI brain mask: using the non-zero voxels of the first frame.")
+    return np.asanyarray(series.dataobj[..., 0]).reshape(series.shape[:3]) != 0
+
+
+def series_metrics(series, mask, chunk_bytes=temporal_stats.CHUNK_BYTES):
+    """
+    Global signal, DVARS and temporal moments of the brain voxels of a 4D
+    series, in a single chunked pass.
+    Returns:
+        tuple: (global signal, DVARS (0 for the first frame), moments)
+    """
+    voxels = int(mask.sum())
+    # Chunks of the full grid are reduced to the brain voxels at once
+    moments = temporal_stats.TemporalMoments()
+    global_signal, dvars = [], [np.zeros(1)]
+    previous = None
+    for chunk in temporal_stats.iter_chunks(series, chunk_bytes):
+        brain = chunk[mask]
+        moments.update(brain)
+        global_signal.append(brain.mean(axis=0))
+        if previous is not None:
+            brain = np.hstack([previous, brain])
+        dvars.append(np.sqrt(np.square(np.diff(brain, axis=1)).sum(axis=0) / voxels))
+        previous = brain[:, -1:]
+    return np.concatenate(global_signal), np.concatenate(dvars), moments
+
+
+def correlation_ratio(t1_brain, epi, flirt_mat, bins=CR_BINS):
+    """
+    Correlation ratio of `epi` given the intensity of `t1_brain`, on the
+    non-zero voxels of the T1w brain covered by the EPI: 1 when the EPI is a
+    function of the T1w intensity (the FLIRT corratio cost is 1 - this).
+    Args:
+        t1_brain: reference image (nibabel).
+        epi: image registered to the reference by `flirt_mat`.
+        flirt_mat (np.ndarray): FLIRT epi->t1_brain matrix.
+    """
+    epi_data = np.asanyarray(epi.dataobj, dtype=np.float64).reshape(epi.shape[:3])
+    # Slabs of axial slices: contiguous on disk
+    depth = t1_brain.shape[2]
+    slabs = [
+        (start, min(start + SLAB_SLICES, depth))
+        for start in range(0, depth, SLAB_SLICES)
+    ]
+
+    def read_slab(start, stop):
+        t1 = np.asanyarray(t1_brain.dataobj[:, :, start:stop], dtype=np.float64)
+        return np.moveaxis(t1.reshape(t1_brain.shape[:2] + (-1,)), 2, 0)
+
+    maximum = max(read_slab(start, stop).max() for start, stop in slabs)
+    if maximum <= 0:
+        return None
+    counts, sums, squares = np.zeros((3, bins))
+    for start, stop in slabs:
+        t1 = read_slab(start, stop)
+        sampled = imaging.sample_slices(
+            epi,
+            t1_brain,
+            list(range(start, stop)),
+            axis=2,
+            flirt_mat=flirt_mat,
+            data=epi_data,
+        )
+        inside = (t1 > 0) & (sampled != 0)
+        index = np.minimum((t1[inside] / maximum * bins).astype(np.intp), bins - 1)
+        values = sampled[inside]
+        counts += np.bincount(index, minlength=bins)
+        sums += np.bincount(index, values, minlength=bins)
+        squares += np.bincount(index, np.square(values), minlength=bins)
+
+    total = counts.sum()
+    if total < 2:
+        return None
+    total_variance = squares.sum() / total - np.square(sums.sum() / total)
+    if total_variance <= 0:
+        return None
+    occupied = counts > 0
+    within = (
+        squares[occupied] - np.square(sums[occupied]) / counts[occupied]
+    ).sum() / total
+    return float(1 - within / total_variance)
+
+
+def _summary(values):
+    values = np.asarray(values, dtype=np.float64)
+    return OrderedDict(
+        [
+            ("mean", round(float(values.mean()), 6)),
+            ("median", round(float(np.median(values)), 6)),
+            ("max", round(float(values.max()), 6)),
+        ]
+    )
+
+
+def compute(context):
+    """
+    The metrics of a run.
+    Returns:
+        tuple: (summary OrderedDict, per-frame OrderedDict of columns)
+    """
+    config = context.config
+    subject_dir = op.join(context.work_dir, config["Subject"])
+    fmriname = config["fMRIName"]
+    results_dir = op.join(subject_dir, "MNINonLinear", "Results", fmriname)
+    dc_dir = op.join(
+        subject_dir,
+        fmriname,
+        "DistortionCorrectionAndEPIToT1wReg_FLIRTBBRAndFreeSurferBBRbased",
+    )
+
+    series = temporal_stats.load_series(op.join(results_dir, fmriname))
+    mask = _brain_mask(results_dir, series)
+    global_signal, dvars, moments = series_metrics(series, mask)
+    fd = framewise_displacement(op.join(results_dir, "Movement_Regressors.txt"))
+    frames = len(global_signal)
+    if len(fd) != frames:
+        raise Exception(
+            "{} motion regressors for {} frames.".format(len(fd), frames)
+        )
+    brain_mean = float(moments.mean.mean())
+    dvars_percent = 100 * dvars / brain_mean if brain_mean else np.zeros(frames)
+
+    summary = OrderedDict(
+        [
+            ("Subject", config["Subject"]),
+            ("fMRIName", fmriname),
+            ("frames", frames),
+            ("tr", float(series.header.get_zooms()[3])),
+            ("brain_voxels", int(mask.sum())),
+        ]
+    )
+    summary["fd"] = _summary(fd)
+    summary["fd"]["threshold"] = FD_THRESHOLD
+    summary["fd"]["frames_above"] = int((fd > FD_THRESHOLD).sum())
+    relative_rms = op.join(results_dir, "Movement_RelativeRMS.txt")
+    if op.isfile(relative_rms):
+        summary["relative_rms"] = _summary(np.loadtxt(relative_rms))
+    summary["dvars"] = _summary(dvars[1:] if frames > 1 else dvars)
+    summary["dvars_percent"] = _summary(
+        dvars_percent[1:] if frames > 1 else dvars_percent
+    )
+    summary["global_signal"] = _summary(global_signal)
+    summary["global_signal"]["std"] = round(float(global_signal.std()), 6)
+    summary["tsnr"] = _summary(moments.tsnr())
+    summary["temporal_mean"] = _summary(moments.mean)
+
+    summary["epi_to_t1"] = None
+    try:
+        t1_brain = imaging.load_image(
+            op.join(subject_dir, "T1w", "T1w_acpc_dc_restore_brain")
+        )
+        flirt_mat = np.loadtxt(op.join(dc_dir, "fMRI2str.mat"))
+        registration = OrderedDict([("cost", "correlation_ratio")])
+        for name, sbref in [("uncorrected", "SBRef"), ("corrected", "SBRef_dc")]:
+            epi = imaging.load_image(op.join(dc_dir, "FieldMap", sbref))
+            registration[name] = correlation_ratio(t1_brain, epi, flirt_mat)
+    except Exception as e:
+        log.warning("No EPI to T1w registration metrics: %s", e)
+    else:
+        if None not in (registration["uncorrected"], registration["corrected"]):
+            registration["improvement"] = (
+                registration["corrected"] - registration["uncorrected"]
+            )
+        summary["epi_to_t1"] = registration
+
+    per_frame = OrderedDict(
+        [
+            ("frame", np.arange(frames)),
+            ("fd", fd),
+            ("dvars", dvars),
+            ("dvars_percent", dvars_percent),
+            ("global_signal", global_signal),
+        ]
+    )
+    return summary, per_frame
+
+
+def write_reports(context, summary, per_frame, directory=None):
+    json_filename, tsv_filename = report_filenames(context, directory)
+    with open(json_filename, "w") as fp:
+        json.dump(summary, fp, indent=4)
+    with open(tsv_filename, "w", newline="") as fp:
+        writer = csv.writer(fp, delimiter="\t", lineterminator="\n")
+        writer.writerow(per_frame.keys())
+        for row in zip(*per_frame.values()):
+            writer.writerow(
+                [row[0]] + ["{:.6g}".format(value) for value in row[1:]]
+            )
+    log.info("Wrote %s and %s", json_filename, tsv_filename)
+
+
+def execute(context):
+    """
+    Compute and write the QC metrics of the run.
+    """
+    if context.config["dry-run"]:
+        log.info("Dry run: no QC metrics.")
+        return
+    summary, per_frame = compute(context)
+    write_reports(context, summary, per_frame)
+    registration = summary["epi_to_t1"] or {}
+    log.info(
+        "QC metrics: mean FD %.3f mm (%d frames above %.1f), mean DVARS %.2f%%, "
+        "median tSNR %.1f, EPI to T1w correlation ratio %s -> %s",
+        summary["fd"]["mean"],
+        summary["fd"]["frames_above"],
+        FD_THRESHOLD,
+        summary["dvars_percent"]["mean"],
+        summary["tsnr"]["median"],
+        registration.get("uncorrected"),
+        registration.get("corrected"),
+    )
@@ -0,0 +1,260 @@
+"""
+In-process rendering of the hcp-func QC mosaics.
+Produces the same images as /tmp/scripts/hcpfunc_qc_mosaic.sh without
+spawning fslmaths/applywarp/volmosaic.sh or writing temporary NIfTIs: each
+volume is loaded once, only the displayed slices are resampled, and the
+mosaics are written directly as PNG.
+"""
+import logging
+import math
+import os.path as op
+import struct
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+from utils import imaging, temporal_stats
+
+log = logging.getLogger(__name__)
+
+EDGE_COLOR = (255, 0, 0)
+# Display window of the underlay, in percentiles of non-zero voxels
+DISPLAY_PERCENTILES = (2, 98)
+# Gradient-magnitude percentile above which overlay voxels are edges
+EDGE_PERCENTILE = 90
+
+
+def write_png(filename, rgb):
+    """
+    Write an 8-bit RGB image.
+    Args:
+        filename (str): output PNG.
+        rgb (np.ndarray): (height, width, 3) uint8 array.
+    """
+    height, width = rgb.shape[:2]
+
+    def chunk(tag, data):
+        body = tag + data
+        return (
+            struct.pack(">I", len(data))
+            + body
+            + struct.pack(">I", zlib.crc32(body) & 0xFFFFFFFF)
+        )
+
+    # Each scanline is prefixed with filter type 0 (None)
+    raw = np.hstack(
+        [np.zeros((height, 1), dtype=np.uint8), rgb.reshape(height, width * 3)]
+    )
+    with open(filename, "wb") as png:
+        png.write(b"\x89PNG\r\n\x1a\n")
+        header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+        png.write(chunk(b"IHDR", header))
+        png.write(chunk(b"IDAT", zlib.compress(raw.tobytes(), 6)))
+        png.write(chunk(b"IEND", b""))
+
+
+def _to_display(slices):
+    """
+    Window slices to 0..255 using percentiles of the non-zero voxels.
+    """
+    nonzero = slices[slices != 0]
+    if nonzero.size == 0:
+        return np.zeros(slices.shape, dtype=np.uint8)
+    low, high = np.percentile(nonzero, DISPLAY_PERCENTILES)
+    if high <= low:
+        high = low + 1
+    scaled = (np.clip(slices, low, high) - low) / (high - low) * 255
+    return scaled.astype(np.uint8)
+
+
+def _edges(slices):
+    """
+    Edge masks of each slice from the in-plane gradient magnitude.
+    """
+    gy, gx = np.gradient(slices, axis=(1, 2))
+    magnitude = np.hypot(gx, gy)
+    nonzero = magnitude[magnitude > 0]
+    if nonzero.size == 0:
+        return np.zeros(slices.shape, dtype=bool)
+    return magnitude > np.percentile(nonzero, EDGE_PERCENTILE)
+
+
+def _tile(slices, columns=None):
+    """
+    Tile (n, width, height) slices into a mosaic with superior at the top.
+    """
+    slices = np.flip(np.swapaxes(slices, 1, 2), axis=1)
+    count, height, width = slices.shape[:3]
+    if columns is None:
+        columns = int(math.ceil(math.sqrt(count)))
+    rows = int(math.ceil(count / float(columns)))
+    mosaic = np.zeros(
+        (rows * height, columns * width) + slices.shape[3:], dtype=slices.dtype
+    )
+    for i in range(count):
+        row, column = divmod(i, columns)
+        top, left = row * height, column * width
+        mosaic[top : top + height, left : left + width] = slices[i]
+    return mosaic
+
+
+def render_mosaic(
+    filename,
+    underlay,
+    edges=None,
+    step=10,
+    scale=1,
+    flirt_mat=None,
+    ref=None,
+    data=None,
+):
+    """
+    Render sagittal slices of an underlay with optional edges of a second
+    image, as volmosaic.sh does.
+    Args:
+        filename (str): output PNG.
+        underlay: image (nibabel) shown in grayscale.
+        edges: image (nibabel) whose edges are overlaid in red.
+        step (int): show every `step`-th sagittal slice.
+        scale (int): integer upscaling of the mosaic.
+        flirt_mat (np.ndarray): FLIRT matrix taking the underlay into `ref`.
+        ref: image defining the grid (default: the underlay's).
+        data (np.ndarray): underlay data, if already computed (e.g. a
+            temporal mean).
+    """
+    if ref is None:
+        ref = underlay
+    slices = list(range(step // 2, ref.shape[0], step))
+    background = _to_display(
+        imaging.sample_slices(underlay, ref, slices, flirt_mat=flirt_mat, data=data)
+    )
+    rgb = np.repeat(background[..., None], 3, axis=-1)
+    if edges is not None:
+        edge_mask = _edges(imaging.sample_slices(edges, ref, slices))
+        rgb[edge_mask] = EDGE_COLOR
+
+    mosaic = _tile(rgb)
+    if scale > 1:
+        mosaic = np.repeat(np.repeat(mosaic, scale, axis=0), scale, axis=1)
+    write_png(filename, mosaic)
+    log.info("Wrote %s", filename)
+
+
+def _paths(params):
+    subject_dir = params["qc_scene_root"]
+    fmriname = params["fMRIName"]
+    fmri_dir = op.join(subject_dir, fmriname)
+    return {
+        "subject": subject_dir,
+        "fmri": fmri_dir,
+        "results": op.join(subject_dir, "MNINonLinear", "Results", fmriname),
+        "dc": op.join(
+            fmri_dir, "DistortionCorrectionAndEPIToT1wReg_FLIRTBBRAndFreeSurferBBRbased"
+        ),
+        "t1": op.join(subject_dir, "T1w", "T1w_acpc_dc_restore"),
+        "t1_brain": op.join(subject_dir, "T1w", "T1w_acpc_dc_restore_brain"),
+    }
+
+
+def render_acpc_t1(params):
+    """
+    anat-res, EPI-to-T1acpc volume with high-res T1 edges
+    """
+    paths = _paths(params)
+    render_mosaic(
+        params["qc_image_root"] + "acpc_T1.png",
+        imaging.load_image(op.join(paths["fmri"], "Scout2T1w")),
+        edges=imaging.load_image(paths["t1"]),
+    )
+
+
+def render_mni2mm_t1(params):
+    """
+    EPI-res, final MNI registration with low-res T1 edges
+    """
+    paths = _paths(params)
+    render_mosaic(
+        params["qc_image_root"] + "mni2mm_T1.png",
+        imaging.load_image(
+            op.join(paths["fmri"], params["fMRIName"] + "_SBRef_nonlin")
+        ),
+        edges=imaging.load_image(op.join(paths["fmri"], "T1w_restore.*.nii*")),
+        step=5,
+        scale=2,
+    )
+
+
+def render_mni2mm_stats(params):
+    """
+    EPI-res, final MNI space, temporal mean, std dev and tSNR from a single
+    streaming pass. The tSNR map is kept with the results.
+    """
+    paths = _paths(params)
+    fmriname = params["fMRIName"]
+    series = temporal_stats.load_series(op.join(paths["results"], fmriname))
+    moments = temporal_stats.temporal_moments(series)
+    tsnr = moments.tsnr()
+    temporal_stats.save_map(
+        op.join(paths["results"], fmriname + "_tSNR.nii.gz"), tsnr, series
+    )
+    for name, data in [
+        ("mni2mm_mean", moments.mean),
+        ("mni2mm_stdev", moments.std()),
+        ("mni2mm_tsnr", tsnr),
+    ]:
+        render_mosaic(
+            params["qc_image_root"] + name + ".png", series, step=5, scale=2, data=data
+        )
+
+
+def _render_epi2t1(params, name, sbref):
+    """
+    EPI before or after distortion correction, linearly registered to T1
+    """
+    paths = _paths(params)
+    render_mosaic(
+        params["qc_image_root"] + name + ".png",
+        imaging.load_image(op.join(paths["dc"], "FieldMap", sbref)),
+        edges=imaging.load_image(paths["t1"]),
+        flirt_mat=np.loadtxt(op.join(paths["dc"], "fMRI2str.mat")),
+        ref=imaging.load_image(paths["t1_brain"]),
+    )
+
+
+def render_epi2t1_uncorrected(params):
+    _render_epi2t1(params, "epi2T1_uncorrected", "SBRef")
+
+
+def render_epi2t1_corrected(params):
+    _render_epi2t1(params, "epi2T1_corrected", "SBRef_dc")
+
+
+# Independent QC tasks
+TASKS = OrderedDict(
+    [
+        ("acpc_T1", render_acpc_t1),
+        ("mni2mm_T1", render_mni2mm_t1),
+        ("mni2mm_stats", render_mni2mm_stats),
+        ("epi2T1_uncorrected", render_epi2t1_uncorrected),
+        ("epi2T1_corrected", render_epi2t1_corrected),
+    ]
+)
+
+
+def render_task(name, params):
+    """
+    Render the images of one QC task. Run in a worker process.
+    """
+    TASKS[name](params)
+
+
+def render_all(params):
+    """
+    Render all hcp-func QC images, serially.
+    Args:
+        params (dict): "QC-Params": qc_scene_root (subject directory),
+            fMRIName, and qc_image_root (prefix of the PNG files).
+    """
+    for name in TASKS:
+        render_task(name, params)
@@ -0,0 +1,437 @@
+"""
+Batched one-step resampling of fMRIVolume.
+HCP's OneStepResampling.sh splits the time series into per-volume NIfTIs
+(OneStepResampling/prevols), and for each volume runs two convertwarp, two
+applywarp and a fslmaths process, before merging postvols back. With the
+"resampling-engine" configuration set to 'gear', fMRIVolume runs a copy of
+OneStepResampling.sh (see utils/script_overrides.py) whose per-volume loop is
+replaced by this engine; every other step of the script is unchanged. The
+engine composes, for each volume k, the same transforms as the loop:
+    MNI --OutputTransform--> fMRI --inverse(MAT_k)--> volume k
+        --gradient distortion field--> raw volume k
+once per voxel of the T1w_restore.<fmrires> grid, interpolates the volumes
+with cubic B-splines (applywarp --interp=spline), in batches of BATCH_VOLUMES
+volumes over worker processes, and writes the series and its field of view
+mask (the -Tmin of the nearest neighbour masks) once.
+The HCP loop is the reference. The engine is experimental: it has not yet
+been validated against the FSL loop, which tests/test_resampling.py does
+where FSL is installed, with
+    python3 -m utils.resampling compare <reference> <candidate> [<mask>]
+whose acceptance threshold is TOLERANCE (relative RMS difference inside the
+brain). Expected differences come from FSL storing the per-volume warps as
+float32 and from the spline boundary handling at the edge of the field of
+view.
+"""
+import collections
+import gzip
+import logging
+import os
+import os.path as op
+import sys
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import nibabel as nib
+import numpy as np
+
+from utils import func_utils, imaging, script_overrides, temporal_stats
+
+log = logging.getLogger(__name__)
+
+SCRIPT = "OneStepResampling.sh"
+BATCH_VOLUMES = 8
+# Acceptance threshold of the relative RMS difference to the HCP reference,
+# inside the brain
+TOLERANCE = 0.01
+# Pole of the cubic B-spline prefilter
+SPLINE_POLE = 3 ** 0.5 - 2
+GZIP_LEVEL = 1
+
+# Transforms of the worker processes, set by _init_worker
+_shared = {}
+
+
+def _loop_lines(lines):
+    """
+    First and last lines of the per-volume loop of OneStepResampling.sh:
+    from splitting the series into prevols to merging the postvols masks.
+    """
+    start = end = None
+    for number, line in enumerate(lines):
+        if start is None and "fslsplit" in line and "prevols" in line:
+            start = number
+        if start is not None and "fslmerge" in line and "_mask" in line:
+            end = number
+    if start is None or end is None:
+        return None
+    return start, end
+
+
+def patch_script(text):
+    """
+    OneStepResampling.sh with its per-volume loop replaced by the engine, or
+    None if the loop is not recognized.
+    """
+    lines = text.splitlines(True)
+    loop = _loop_lines(lines)
+    if loop is None:
+        return None
+    start, end = loop
+    engine = [
+        "# Per-volume loop replaced by the hcp-func batched resampling engine\n",
+        '{} "${{HCPFUNC_ARGS[@]}}" || exit 1\n'.format(
+            script_overrides.python_command("utils.resampling")
+        ),
+    ]
+    # Arguments as passed to the script, whatever its option parsing does
+    header = [lines[0], 'HCPFUNC_ARGS=("$@")\n']
+    return "".join(header + lines[1:start] + engine + lines[end + 1 :])
+
+
+def configure(context):
+    """
+    Run fMRIVolume with the batched resampling engine, through a patched
+    OneStepResampling.sh (see utils/script_overrides.py). Keeps the HCP
+    resampling if the script is not recognized.
+    """
+    if script_overrides.override_script(
+        context, "HCPPIPEDIR_fMRIVol", SCRIPT, patch_script
+    ):
+        log.info("One step resampling: batched gear engine.")
+    else:
+        log.warning(
+            "Per-volume loop of %s not recognized: using the HCP resampling.", SCRIPT
+        )
+
+
+def spline_coefficients(data):
+    """
+    Cubic B-spline coefficients of a 3D array (mirror boundaries), so that
+    the spline interpolates the data at the voxel centers.
+    """
+    coefficients = np.array(data, dtype=np.float64)
+    z = SPLINE_POLE
+    for axis in range(3):
+        c = np.moveaxis(coefficients, axis, 0)
+        n = c.shape[0]
+        if n == 1:
+            continue
+        c *= (1 - z) * (1 - 1 / z)
+        horizon = min(n, 30)
+        c[0] = np.tensordot(z ** np.arange(horizon), c[:horizon], axes=1)
+        for i in range(1, n):
+            c[i] += z * c[i - 1]
+        c[n - 1] = (z / (z * z - 1)) * (c[n - 1] + z * c[n - 2])
+        for i in range(n - 2, -1, -1):
+            c[i] = z * (c[i + 1] - c[i])
+    return coefficients
+
+
+def _mirror(index, size):
+    if size == 1:
+        return np.zeros_like(index)
+    period = 2 * (size - 1)
+    index = np.abs(index) % period
+    return np.where(index > size - 1, period - index, index)
+
+
+def spline_interpolate(coefficients, coords):
+    """
+    Cubic B-spline interpolation at (3, N) voxel coordinates, 0 outside of
+    the volume.
+    """
+    shape = coefficients.shape
+    values = np.zeros(coords.shape[1])
+    inside = np.all(
+        (coords >= 0) & (coords <= np.array(shape).reshape(3, 1) - 1), axis=0
+    )
+    coords = coords[:, inside]
+    base = np.floor(coords).astype(np.intp)
+    t = coords - base
+    weights = [
+        (1 - t) ** 3 / 6,
+        (4 - 6 * t ** 2 + 3 * t ** 3) / 6,
+        (1 + 3 * t + 3 * t ** 2 - 3 * t ** 3) / 6,
+        t ** 3 / 6,
+    ]
+    indices = [
+        [_mirror(base[axis] + offset - 1, shape[axis]) for offset in range(4)]
+        for axis in range(3)
+    ]
+    result = np.zeros(coords.shape[1])
+    for a in range(4):
+        for b in range(4):
+            wab = weights[a][0] * weights[b][1]
+            for c in range(4):
+                result += (
+                    wab
+                    * weights[c][2]
+                    * coefficients[indices[0][a], indices[1][b], indices[2][c]]
+                )
+    values[inside] = result
+    return values
+
+
+def _sample_field(field, field_img, points_mm):
+    """
+    Trilinear sample of a displacement field (x, y, z, 3) at FSL mm points.
+    """
+    mm2vox = np.linalg.inv(imaging.fsl_vox2mm(field_img))
+    coords = mm2vox[:3, :3].dot(points_mm) + mm2vox[:3, 3:]
+    return np.array(
+        [imaging.trilinear(field[..., axis], coords) for axis in range(3)]
+    )
+
+
+def _fsl_points(img):
+    """
+    FSL mm coordinates (3, N) of the voxels of an image, in NIfTI order.
+    """
+    # NIfTI (Fortran) order: i fastest
+    grid = np.indices(img.shape[:3][::-1]).reshape(3, -1)[::-1]
+    vox2mm = imaging.fsl_vox2mm(img)
+    return vox2mm[:3, :3].dot(grid) + vox2mm[:3, 3:]
+
+
+def read_matrix(filename):
+    return np.loadtxt(filename).reshape(4, 4)
+
+
+def _init_worker(shared):
+    """
+    Give a worker process the transforms of the series, whatever the start
+    method of the pool (fork, forkserver or spawn).
+    """
+    _shared.clear()
+    _shared.update(shared)
+
+
+def _resample_batch(start, volumes):
+    """
+    Resample a batch of volumes (x, y, z, frames) starting at frame `start`
+    onto the reference grid. Run in a worker process.
+    Returns:
+        tuple: (start, resampled (voxels, frames), field of view mask)
+    """
+    fmri_points = _shared["fmri_points"]
+    mm2vox = _shared["mm2vox"]
+    resampled = np.zeros((fmri_points.shape[1], volumes.shape[3]))
+    mask = np.ones(fmri_points.shape[1], dtype=bool)
+    shape = np.array(volumes.shape[:3]).reshape(3, 1)
+    for frame in range(volumes.shape[3]):
+        # fMRI space -> volume k (inverse motion) -> raw volume k (gdc)
+        inverse = np.linalg.inv(_shared["matrices"][start + frame])
+        points = inverse[:3, :3].dot(fmri_points) + inverse[:3, 3:]
+        if _shared["gdfield"] is not None:
+            points += _sample_field(_shared["gdfield"], _shared["gdimg"], points)
+        coords = mm2vox[:3, :3].dot(points) + mm2vox[:3, 3:]
+        coefficients = spline_coefficients(volumes[..., frame])
+        resampled[:, frame] = spline_interpolate(coefficients, coords)
+        nearest = np.round(coords)
+        mask &= np.all((nearest >= 0) & (nearest <= shape - 1), axis=0)
+    return start, resampled, mask
+
+
+def _image_filename(name):
+    """
+    Image file of an FSL-style name, with the extension of FSLOUTPUTTYPE.
+    """
+    if name.endswith((".nii", ".nii.gz")):
+        return name
+    return name + (".nii" if os.environ.get("FSLOUTPUTTYPE") == "NIFTI" else ".nii.gz")
+
+
+def _output_header(ref_img, dtype, shape, tr):
+    header = nib.Nifti1Header()
+    header.set_data_dtype(dtype)
+    header.set_data_shape(shape)
+    zooms = ref_img.header.get_zooms()[:3]
+    header.set_zooms(zooms + ((tr,) if len(shape) > 3 else ()))
+    header.set_sform(ref_img.affine, int(ref_img.header["sform_code"]) or 1)
+    header.set_qform(ref_img.affine, int(ref_img.header["qform_code"]) or 1)
+    header.set_xyzt_units("mm", "sec")
+    header["vox_offset"] = 352
+    return header
+
+
+def _open_output(filename):
+    if filename.endswith(".gz"):
+        return gzip.open(filename + ".tmp", "wb", compresslevel=GZIP_LEVEL)
+    return open(filename + ".tmp", "wb")
+
+
+def _write_frames(fp, resampled, dtype):
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        resampled = np.clip(np.round(resampled), info.min, info.max)
+    # Frames one after the other, voxels in NIfTI order
+    fp.write(np.ascontiguousarray(resampled.T.astype(dtype)).tobytes())
+
+
+def resample(params, workers=None):
+    """
+    Replace the per-volume loop of OneStepResampling.sh.
+    Args:
+        params (dict): the arguments of OneStepResampling.sh.
+        workers (int): worker processes (default: OMP_NUM_THREADS, else the
+            available CPUs).
+    """
+    if workers is None:
+        workers = int(
+            os.environ.get("OMP_NUM_THREADS") or func_utils.available_cpus()
+        )
+    t1_name = op.basename(params["t1"])
+    for extension in [".nii.gz", ".nii"]:
+        if t1_name.endswith(extension):
+            t1_name = t1_name[: -len(extension)]
+    ref_img = imaging.load_image(
+        op.join(params["workingdir"], "{}.{}".format(t1_name, params["fmriresout"]))
+    )
+    series = temporal_stats.load_series(params["infmri"])
+    frames = series.shape[3] if len(series.shape) > 3 else 1
+    warp_img = imaging.load_image(params["owarp"])
+    gd_name = params.get("gdfield", "NONE")
+    gd_img = None if gd_name in ("", "NONE") else imaging.load_image(gd_name)
+
+    # MNI -> fMRI space, common to all volumes
+    ref_points = _fsl_points(ref_img)
+    warp = np.asanyarray(warp_img.dataobj, dtype=np.float64)
+    if warp_img.shape[:3] == ref_img.shape[:3]:
+        displacement = warp.reshape(-1, 3, order="F").T
+    else:
+        displacement = _sample_field(warp, warp_img, ref_points)
+    shared = {}
+    shared["fmri_points"] = ref_points + displacement
+    shared["mm2vox"] = np.linalg.inv(imaging.fsl_vox2mm(series))
+    shared["matrices"] = [
+        read_matrix(
+            op.join(
+                params["motionmatdir"],
+                "{}{:04d}".format(params["motionmatprefix"], frame),
+            )
+        )
+        for frame in range(frames)
+    ]
+    shared["gdfield"] = shared["gdimg"] = None
+    if gd_img is not None:
+        gdfield = np.asanyarray(gd_img.dataobj, dtype=np.float64)
+        if np.any(gdfield):
+            shared["gdfield"], shared["gdimg"] = gdfield, gd_img
+    del warp, displacement
+
+    dtype = series.get_data_dtype()
+    if series.dataobj.slope not in (0, 1) or series.dataobj.inter != 0:
+        dtype = np.dtype(np.float32)
+    tr = float(series.header.get_zooms()[3]) if frames > 1 else 1.0
+    output = _image_filename(params["ofmri"])
+    mask = np.ones(ref_points.shape[1], dtype=bool)
+    log.info(
+        "Resampling %d volumes onto %s in batches of %d (%d workers).",
+        frames,
+        "x".join(str(n) for n in ref_img.shape[:3]),
+        BATCH_VOLUMES,
+        workers,
+    )
+
+    executor = ProcessPoolExecutor(
+        max_workers=workers, initializer=_init_worker, initargs=(shared,)
+    )
+    with executor, _open_output(output) as fp:
+        header = _output_header(ref_img, dtype, ref_img.shape[:3] + (frames,), tr)
+        fp.write(header.binaryblock + b"\0" * 4)
+        pending = collections.deque()
+        for start in range(0, frames, BATCH_VOLUMES):
+            volumes = np.asanyarray(
+                series.dataobj[..., start : start + BATCH_VOLUMES]
+            ).reshape(series.shape[:3] + (-1,))
+            pending.append(executor.submit(_resample_batch, start, volumes))
+            while len(pending) >= 2 * workers:
+                _, resampled, batch_mask = pending.popleft().result()
+                _write_frames(fp, resampled, dtype)
+                mask &= batch_mask
+        while pending:
+            _, resampled, batch_mask = pending.popleft().result()
+            _write_frames(fp, resampled, dtype)
+            mask &= batch_mask
+    os.replace(output + ".tmp", output)
+
+    # The -Tmin of the per-volume masks
+    mask_output = _image_filename(params["ofmri"] + "_mask")
+    with _open_output(mask_output) as fp:
+        fp.write(_output_header(ref_img, dtype, ref_img.shape[:3], tr).binaryblock)
+        fp.write(b"\0" * 4)
+        _write_frames(fp, mask[:, None].astype(np.float64), dtype)
+    os.replace(mask_output + ".tmp", mask_output)
+    log.info("Wrote %s and %s.", output, mask_output)
+
+
+def compare(reference, candidate, mask=None):
+    """
+    Agreement of a resampled series with the HCP reference, inside `mask`
+    (default: voxels whose reference temporal mean is over 10% of its
+    maximum).
+    Returns:
+        OrderedDict: relative RMS difference, and whether it is within
+            TOLERANCE.
+    """
+    reference = temporal_stats.load_series(reference)
+    candidate = temporal_stats.load_series(candidate)
+    if reference.shape != candidate.shape:
+        raise Exception(
+            "Shapes differ: {} and {}.".format(reference.shape, candidate.shape)
+        )
+    if mask is None:
+        mean = temporal_stats.temporal_moments(reference).mean
+        inside = mean > 0.1 * mean.max()
+    else:
+        inside = np.asanyarray(imaging.load_image(mask).dataobj) > 0
+        inside = inside.reshape(reference.shape[:3])
+    squared_difference = squared_reference = 0.0
+    chunks = zip(
+        temporal_stats.iter_chunks(reference), temporal_stats.iter_chunks(candidate)
+    )
+    for ref_chunk, chunk in chunks:
+        squared_difference += np.square(chunk - ref_chunk)[inside].sum()
+        squared_reference += np.square(ref_chunk)[inside].sum()
+    relative_rms = float(np.sqrt(squared_difference / max(squared_reference, 1e-12)))
+    return OrderedDict(
+        [
+            ("relative_rms", relative_rms),
+            ("tolerance", TOLERANCE),
+            ("within_tolerance", relative_rms <= TOLERANCE),
+            ("voxels", int(inside.sum())),
+        ]
+    )
+
+
+def parse_params(argv):
+    """
+    OneStepResampling.sh "--key=value" arguments to a dict.
+    """
+    params = {}
+    for arg in argv:
+        if arg.startswith("--"):
+            key, _, value = arg[2:].partition("=")
+            params[key] = value
+    return params
+
+
+def main(argv):
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if argv and argv[0] == "compare":
+        result = compare(*argv[1:4])
+        print(
+            "Relative RMS difference {:.5f} ({} voxels), tolerance {}: {}".format(
+                result["relative_rms"],
+                result["voxels"],
+                result["tolerance"],
+                "PASS" if result["within_tolerance"] else "FAIL",
+            )
+        )
+        return 0 if result["within_tolerance"] else 1
+    resample(parse_params(argv))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
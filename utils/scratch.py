@@ -0,0 +1,282 @@
+"""
+Scratch-space management of the hcp-func gear.
+Intermediates are known by the stage producing them and the last stage
+reading them, and are deleted as soon as that stage completes instead of at
+packaging time. A stage is refused before it starts if its estimated growth
+would take the work directory beyond the "scratch-budget-GB" configuration.
+Current and peak (at stage boundaries) usage is logged and reported.
+The INTERMEDIATES are all produced and consumed within fMRIVolume, so
+deleting them at its end does not lower the peak of the stage itself. The
+largest, the per-volume files of OneStepResampling.sh, are also deleted by a
+patched copy of the script (see utils/script_overrides.py) right after they
+are merged: they no longer occupy the disk during the rest of fMRIVolume
+(intensity normalization, the Jacobian and the SBRef resamplings), although
+the peak of the merge itself, with the volumes and the merged series, is
+unchanged.
+"""
+import glob
+import logging
+import os
+import os.path as op
+import re
+import shutil
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from utils import resampling, script_overrides
+
+log = logging.getLogger(__name__)
+
+# Intermediates of a run, relative to <Subject>/<fMRIName>:
+# (pattern, producing stage, last consuming stage, cleanup policy).
+# "standard" intermediates are never packaged; "aggressive" ones are the
+# working copies of the time series, duplicated by the MNINonLinear results.
+INTERMEDIATES = [
+    ("OneStepResampling/prevols", "fMRIVolume", "fMRIVolume", "standard"),
+    ("OneStepResampling/postvols", "fMRIVolume", "fMRIVolume", "standard"),
+    ("MotionMatrices/*.nii*", "fMRIVolume", "fMRIVolume", "standard"),
+    ("{fMRIName}_orig.nii*", "fMRIVolume", "fMRIVolume", "aggressive"),
+    ("{fMRIName}_gdc.nii*", "fMRIVolume", "fMRIVolume", "aggressive"),
+    ("{fMRIName}_mc.nii*", "fMRIVolume", "fMRIVolume", "aggressive"),
+    ("{fMRIName}_nonlin.nii*", "fMRIVolume", "fMRIVolume", "aggressive"),
+    ("{fMRIName}_nonlin_norm.nii*", "fMRIVolume", "fMRIVolume", "aggressive"),
+]
+POLICIES = {"standard": ["standard"], "aggressive": ["standard", "aggressive"]}
+# Per-volume outputs written in the loop of OneStepResampling.sh
+VOLUME_OUTPUT = re.compile(r"(?:--out=|\s-o\s+)(\S*\$\{?vnum\}?\S*\.nii\.gz)")
+
+# Estimated peak growth of the work directory during a stage, as a multiple
+# of the size of the (compressed) fMRITimeSeries input
+STAGE_GROWTH = {"fMRIVolume": 15.0, "fMRISurface": 3.0, "QC": 0.5, "export": 5.0}
+# Growth factor of uncompressed intermediates ("uncompressed-intermediates")
+UNCOMPRESSED_GROWTH = 2.0
+
+
+def patch_script(text):
+    """
+    OneStepResampling.sh deleting its prevols, postvols and per-volume warps
+    once the volumes are merged, or None if its per-volume loop is not
+    recognized (e.g. replaced by the gear resampling engine).
+    """
+    lines = text.splitlines(True)
+    loop = resampling._loop_lines(lines)
+    if loop is None:
+        return None
+    start, end = loop
+    prevols = [token for token in lines[start].split() if "prevols" in token]
+    if not prevols:
+        return None
+    prevols_dir = prevols[0][: prevols[0].index("prevols") + len("prevols")]
+    directories = [prevols_dir, prevols_dir.replace("prevols", "postvols")]
+    warps = []
+    for line in lines[start:end]:
+        for output in VOLUME_OUTPUT.findall(line):
+            if "prevols" not in output and "postvols" not in output:
+                # ".nii" with uncompressed intermediates
+                pattern = re.sub(r"\$\{?vnum\}?", "*", output[: -len(".gz")]) + "*"
+                if pattern not in warps:
+                    warps.append(pattern)
+    cleanup = [
+        "# Per-volume intermediates, dead once merged (hcp-func scratch-cleanup)\n",
+        "rm -rf {}\n".format(" ".join(directories)),
+    ]
+    if warps:
+        cleanup.append("rm -f {}\n".format(" ".join(warps)))
+    return "".join(lines[: end + 1] + cleanup + lines[end + 1 :])
+
+
+def configure(context):
+    """
+    Delete the per-volume intermediates of OneStepResampling.sh within
+    fMRIVolume, through a patched copy of the script. Applied after the
+    resampling engine, whose patch leaves no per-volume loop.
+    """
+    if script_overrides.override_script(
+        context, "HCPPIPEDIR_fMRIVol", resampling.SCRIPT, patch_script
+    ):
+        log.info("OneStepResampling intermediates deleted once merged.")
+
+
+def tree_size(path):
+    """
+    Disk usage in bytes of a directory tree (allocated blocks, each hard
+    linked file counted once).
+    """
+    total = 0
+    seen = set()
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                st = os.lstat(op.join(root, name))
+            except OSError:
+                continue
+            if (st.st_dev, st.st_ino) in seen:
+                continue
+            seen.add((st.st_dev, st.st_ino))
+            total += st.st_blocks * 512
+    return total
+
+
+def _size(path):
+    if op.isdir(path) and not op.islink(path):
+        return tree_size(path)
+    return os.lstat(path).st_blocks * 512
+
+
+def _remove(path):
+    try:
+        if op.isdir(path) and not op.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+        return True
+    except OSError as e:
+        log.warning("Could not remove %s: %s", path, e)
+        return False
+
+
+class ScratchManager(object):
+    """
+    Scratch usage of the work directory, shared by all runs of the gear.
+    Args:
+        work_dir (str): the gear work directory.
+        budget (int): disk budget in bytes, None for no budget.
+        policy (str): cleanup policy, "standard" or "aggressive".
+    """
+
+    def __init__(self, work_dir, budget=None, policy="standard"):
+        self.work_dir = work_dir
+        self.budget = budget
+        self.policy = policy
+        self.reserved = {}
+        self.lock = threading.Lock()
+        self.current = tree_size(work_dir)
+        self.peak = self.current
+        self.reclaimed = 0
+
+    def measure(self):
+        current = tree_size(self.work_dir)
+        with self.lock:
+            self.current = current
+            self.peak = max(self.peak, current)
+        return current
+
+    def estimate(self, context, stage):
+        """
+        Estimated growth of the work directory during `stage`.
+        """
+        series = context.get_input_path("fMRITimeSeries")
+        if not series or not op.exists(series):
+            return 0
+        growth = STAGE_GROWTH.get(stage, 0) * op.getsize(series)
+        if context.config.get("uncompressed-intermediates"):
+            growth *= UNCOMPRESSED_GROWTH
+        return int(growth)
+
+    def reserve(self, key, growth):
+        """
+        Reserve `growth` bytes for a stage, or raise if the budget would be
+        exceeded by the current usage and the stages already running.
+        """
+        current = self.measure()
+        with self.lock:
+            needed = current + sum(self.reserved.values()) + growth
+            if self.budget is not None and needed > self.budget:
+                raise Exception(
+                    "Scratch budget exceeded: {} needs an estimated {:.1f} GB, "
+                    "{:.1f} GB used and {:.1f} GB reserved of {:.1f} GB.".format(
+                        key,
+                        growth / 1e9,
+                        current / 1e9,
+                        sum(self.reserved.values()) / 1e9,
+                        self.budget / 1e9,
+                    )
+                )
+            self.reserved[key] = growth
+        free = shutil.disk_usage(self.work_dir).free
+        if growth > free:
+            log.warning(
+                "%s needs an estimated %.1f GB of scratch, %.1f GB free.",
+                key,
+                growth / 1e9,
+                free / 1e9,
+            )
+
+    def release(self, key):
+        with self.lock:
+            self.reserved.pop(key, None)
+
+    def reclaim(self, context, stage):
+        """
+        Delete the intermediates of `context` whose last consumer is `stage`.
+        """
+        fmri_dir = op.join(
+            self.work_dir, context.config["Subject"], context.config["fMRIName"]
+        )
+        removed = 0
+        for pattern, _, last_consumer, policy in INTERMEDIATES:
+            if last_consumer != stage or policy not in POLICIES[self.policy]:
+                continue
+            pattern = pattern.format(fMRIName=context.config["fMRIName"])
+            for path in glob.glob(op.join(fmri_dir, pattern)):
+                size = _size(path)
+                if _remove(path):
+                    removed += size
+        with self.lock:
+            self.reclaimed += removed
+        if removed:
+            log.info("Reclaimed %.2f GB of %s intermediates.", removed / 1e9, stage)
+
+    def summary(self):
+        return OrderedDict(
+            [
+                ("current_bytes", self.current),
+                ("peak_bytes", self.peak),
+                ("reclaimed_bytes", self.reclaimed),
+                ("budget_bytes", self.budget),
+                ("policy", self.policy),
+            ]
+        )
+
+
+def start(context):
+    """
+    Start scratch management with the "scratch-budget-GB" and
+    "scratch-cleanup" configuration.
+    """
+    config = context.config
+    budget = config.get("scratch-budget-GB")
+    context.gear_dict["scratch-manager"] = ScratchManager(
+        context.work_dir,
+        budget=int(budget * 1e9) if budget else None,
+        policy=config.get("scratch-cleanup", "standard"),
+    )
+
+
+@contextmanager
+def stage(context, name):
+    """
+    Run the enclosed block as stage `name` of `context` within the scratch
+    budget, and reclaim the intermediates it was the last consumer of. Does
+    nothing if scratch management was not started.
+    """
+    manager = context.gear_dict.get("scratch-manager")
+    if manager is None:
+        yield
+        return
+
+    key = "{} ({})".format(name, context.config["fMRIName"])
+    manager.reserve(key, manager.estimate(context, name))
+    try:
+        yield
+    finally:
+        manager.release(key)
+    manager.reclaim(context, name)
+    manager.measure()
+    log.info(
+        "Scratch usage after %s: %.2f GB (peak %.2f GB).",
+        key,
+        manager.current / 1e9,
+        manager.peak / 1e9,
+    )
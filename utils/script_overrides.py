@@ -0,0 +1,68 @@
+"""
+Patched copies of HCP Pipelines scripts.
+The HCP Pipelines call their sub-scripts through the HCPPIPEDIR_* directories
+of the environment (HCPPIPEDIR_fMRIVol, HCPPIPEDIR_fMRISurf, ...). To run a
+patched sub-script, the gear points the variable to a shadow directory
+"<work_dir>/hcp_overrides/<variable>" in which the other scripts are linked
+to the originals. Several patches of one script (batched resampling, derived
+asset cache) are applied one after the other.
+"""
+import logging
+import os
+import os.path as op
+import sys
+
+log = logging.getLogger(__name__)
+
+# Python and root of the gear, for the patched scripts to run its modules
+PYTHON = sys.executable
+GEAR_DIR = op.dirname(op.dirname(op.abspath(__file__)))
+
+
+def python_command(module):
+    """
+    Shell command line running `module` of the gear.
+    """
+    return 'PYTHONPATH="{}" "{}" -m {}'.format(GEAR_DIR, PYTHON, module)
+
+
+def override_script(context, variable, script, patch):
+    """
+    Run a patched `script` of the scripts directory environ[variable].
+    Updates (a copy of) gear_dict["environ"].
+    Args:
+        context: Gear information.
+        variable (str): the HCPPIPEDIR_* variable of the scripts directory.
+        script (str): file name of the script.
+        patch (function): the patched text of the script, or None if the
+            script is not recognized.
+    Returns:
+        bool: whether the script was patched.
+    """
+    environ = context.gear_dict["environ"]
+    scripts_dir = environ.get(variable, "")
+    shadow_dir = op.join(context.work_dir, "hcp_overrides", variable)
+    try:
+        with open(op.join(scripts_dir, script)) as fp:
+            patched = patch(fp.read())
+    except OSError as e:
+        log.debug("Could not read %s: %s", script, e)
+        patched = None
+    if patched is None:
+        return False
+
+    if scripts_dir != shadow_dir:
+        os.makedirs(shadow_dir, exist_ok=True)
+        for name in os.listdir(scripts_dir):
+            if not op.lexists(op.join(shadow_dir, name)):
+                os.symlink(op.join(scripts_dir, name), op.join(shadow_dir, name))
+    filename = op.join(shadow_dir, script)
+    # Replace the link to the original (or the previous patch) atomically
+    with open(filename + ".tmp", "w") as fp:
+        fp.write(patched)
+    os.chmod(filename + ".tmp", 0o755)
+    os.replace(filename + ".tmp", filename)
+    environ = dict(environ)
+    environ[variable] = shadow_dir
+    context.gear_dict["environ"] = environ
+    return True
@@ -0,0 +1,79 @@
+"""
+Execution of the hcp-func pipeline stages (fMRIVolume, fMRISurface, QC) with
+checkpointing, scratch management and resource accounting.
+The HCP Pipelines stages (RETRY_STAGES) are retried, up to "stage-retries"
+times, when their command fails for lack of memory (with half the threads,
+down to one) or because of a transient file system or network error (after
+TRANSIENT_DELAY seconds). A retry runs the stage again from its start, in the
+same work directory and scratch reservation.
+"""
+import logging
+import time
+
+from utils import checkpoints, instrumentation, local_scheduler, scratch
+from utils.args import streaming
+
+log = logging.getLogger(__name__)
+
+RETRY_STAGES = ("fMRIVolume", "fMRISurface")
+TRANSIENT_DELAY = 60
+
+
+def _retry(context, stage, error):
+    """
+    Prepare to run `stage` again after `error`.
+    Returns:
+        bool: whether the stage should be retried.
+    """
+    if error.failure == "memory":
+        threads = local_scheduler.reduce_threads(context)
+        if threads is None:
+            log.error("%s ran out of memory with a single thread.", stage)
+            return False
+        log.warning("%s ran out of memory: retrying with %d threads.", stage, threads)
+        return True
+    if error.failure == "transient":
+        log.warning(
+            "%s failed with a transient error: retrying in %d s.",
+            stage,
+            TRANSIENT_DELAY,
+        )
+        time.sleep(TRANSIENT_DELAY)
+        return True
+    return False
+
+
+def run_stage(context, stage, function):
+    """
+    Run `function(context)` as `stage`: skipped if completed in a partial
+    output zip, otherwise started within the scratch budget, measured (each
+    attempt), retried if possible, and checkpointed on success.
+    Args:
+        context: Gear information (or the RunContext of a run).
+        stage (str): "fMRIVolume", "fMRISurface", "QC", "metrics" or "export".
+        function: the stage's execute function.
+    """
+    if checkpoints.is_complete(context, stage):
+        return
+    if stage not in RETRY_STAGES:
+        with scratch.stage(context, stage):
+            with instrumentation.stage(context, stage):
+                function(context)
+        checkpoints.mark_complete(context, stage)
+        return
+    retries = context.config.get("stage-retries", 2)
+    with scratch.stage(context, stage):
+        attempt = 1
+        while True:
+            try:
+                with instrumentation.stage(context, stage):
+                    function(context)
+            except streaming.CommandFailed as e:
+                instrumentation.record_attempt(context, stage, attempt, e)
+                if attempt > retries or not _retry(context, stage, e):
+                    raise
+                attempt += 1
+                continue
+            instrumentation.record_attempt(context, stage, attempt)
+            break
+    checkpoints.mark_complete(context, stage)
@@ -0,0 +1,92 @@
+"""
+Staging of the gear inputs under shell-safe file names.
+The HCP Pipelines pass file names through the shell unquoted, so an input
+whose name has spaces or special characters is staged under a sanitized name,
+next to the input (or in "<work_dir>/inputs/<input>" if the input directory
+is not writable), without copying its data when possible: hard link, reflink,
+then symbolic link, copying only when the file system supports none of them.
+Inputs with safe names are used where they are. The staged inputs, the
+method used and the bytes actually copied are in gear_dict["input-staging"]
+and the resource report.
+"""
+import logging
+import os
+import os.path as op
+import re
+from collections import OrderedDict
+
+from utils import func_utils
+
+log = logging.getLogger(__name__)
+
+# Methods tried in order by func_utils.link_or_copy
+STAGING_METHODS = ("hardlink", "reflink", "symlink", "copy")
+UNSAFE_CHARACTERS = re.compile(r"[^A-Za-z0-9._+-]")
+
+
+def sanitized_name(filename):
+    return UNSAFE_CHARACTERS.sub("_", op.basename(filename))
+
+
+def _stage(src, directories):
+    """
+    Create the sanitized `src` in the first of `directories` it can be
+    created in.
+    Returns:
+        tuple: (staged path, method)
+    """
+    for directory in directories:
+        dst = op.join(directory, sanitized_name(src))
+        try:
+            os.makedirs(directory, exist_ok=True)
+            return dst, func_utils.link_or_copy(src, dst, methods=STAGING_METHODS)
+        except OSError as e:
+            log.debug("Could not stage %s in %s: %s", src, directory, e)
+    raise Exception("Could not stage {} under a sanitized file name.".format(src))
+
+
+def stage_input(context, name):
+    """
+    Shell-safe path of the input `name`, staging it if needed. Inputs are
+    used where they are if gear_dict["stage-inputs"] is False (offline
+    screening).
+    Args:
+        context: Gear information (or the RunContext of a run).
+        name (str): the input name in the manifest.
+    Returns:
+        str: path of the input, or of its staged copy or link.
+    """
+    src = context.get_input_path(name)
+    if not context.gear_dict.get("stage-inputs", True):
+        return src
+    record = OrderedDict(
+        [("input", name), ("source", src), ("path", src), ("method", None)]
+    )
+    if sanitized_name(src) != op.basename(src):
+        record["path"], record["method"] = _stage(
+            src, [op.dirname(src), op.join(context.work_dir, "inputs", name)]
+        )
+    record["bytes_copied"] = op.getsize(src) if record["method"] == "copy" else 0
+    context.gear_dict.setdefault("input-staging", []).append(record)
+    if record["method"] is not None:
+        log.info(
+            "Staged input %s as %s (%s, %d bytes copied).",
+            name,
+            record["path"],
+            record["method"],
+            record["bytes_copied"],
+        )
+    return record["path"]
+
+
+def summary(context):
+    """
+    The staged inputs of `context` and the total of bytes copied.
+    """
+    records = context.gear_dict.get("input-staging", [])
+    return OrderedDict(
+        [
+            ("inputs", records),
+            ("bytes_copied", sum(record["bytes_copied"] for record in records)),
+        ]
+    )
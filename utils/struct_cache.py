@@ -0,0 +1,228 @@
+"""
+On-node cache of unpacked hcp-struct trees for the hcp-func gear.
+Every fMRI run of a subject unzips the identical StructZip. With a cache
+directory configured ("struct-cache-dir"), one read-only copy is unpacked per
+StructZip content hash and materialized into the work directory with
+reflinks, or copies: never hardlinks, through which a pipeline writing a file
+in place would corrupt the entry for every later job. Entries are evicted
+least-recently-used once the cache exceeds "struct-cache-max-GB". Concurrent
+jobs on a host coordinate through flock(2) locks: populating an entry takes
+an exclusive lock on it, materializing takes a shared lock, and eviction
+skips entries in use.
+"""
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import os.path as op
+import shutil
+import time
+from contextlib import contextmanager
+
+from utils import func_utils, struct_zip
+
+log = logging.getLogger(__name__)
+
+# Materialized files are independent of the cache: the pipelines may modify
+# them in place
+MATERIALIZE_METHODS = ("reflink", "copy")
+
+
+@contextmanager
+def _flock(lock_filename, mode, blocking=True):
+    """
+    Hold a flock(2) lock on `lock_filename` for the duration of the context.
+    Yields False instead of blocking when `blocking` is False and the lock is
+    taken.
+    """
+    with open(lock_filename, "a") as lock_file:
+        try:
+            fcntl.flock(lock_file, mode | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def hash_file(filename, chunk_size=4 * 1024 * 1024):
+    """
+    SHA-256 of the contents of `filename`.
+    """
+    sha = hashlib.sha256()
+    with open(filename, "rb") as fl:
+        for chunk in iter(lambda: fl.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def struct_zip_hash(context):
+    """
+    SHA-256 of the StructZip input, computed once per gear run.
+    """
+    if "StructZip-sha256" not in context.gear_dict:
+        context.gear_dict["StructZip-sha256"] = hash_file(
+            context.get_input_path("StructZip")
+        )
+    return context.gear_dict["StructZip-sha256"]
+
+
+def _tree_size(root):
+    size = 0
+    for dirpath, _, files in os.walk(root):
+        for fl in files:
+            size += op.getsize(op.join(dirpath, fl))
+    return size
+
+
+class StructCache(object):
+    """
+    A size-bounded directory of unpacked hcp-struct trees:
+        <cache_dir>/entries/<key>/tree/     unpacked, read-only tree
+        <cache_dir>/entries/<key>/meta.json size and provenance
+        <cache_dir>/entries/<key>/last_used mtime gives LRU order
+        <cache_dir>/locks/<key>.lock        per-entry lock
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.entries_dir = op.join(cache_dir, "entries")
+        self.locks_dir = op.join(cache_dir, "locks")
+        self.tmp_dir = op.join(cache_dir, "tmp")
+        for dirname in [self.entries_dir, self.locks_dir, self.tmp_dir]:
+            os.makedirs(dirname, exist_ok=True)
+
+    def _lock_path(self, key):
+        return op.join(self.locks_dir, key + ".lock")
+
+    def _entry_path(self, key):
+        return op.join(self.entries_dir, key)
+
+    def _populate(self, key, extract):
+        """
+        Unpack an entry with `extract(dest_dir)` into a temporary directory
+        and move it into place. The caller holds the exclusive entry lock.
+        """
+        tmp_entry = op.join(self.tmp_dir, "{}.{}".format(key, os.getpid()))
+        shutil.rmtree(tmp_entry, ignore_errors=True)
+        tree = op.join(tmp_entry, "tree")
+        try:
+            os.makedirs(tree)
+            extract(tree)
+
+            # Cached files are shared between jobs and must never be written to
+            for dirpath, _, files in os.walk(tree):
+                for fl in files:
+                    os.chmod(op.join(dirpath, fl), 0o444)
+
+            meta = {"size": _tree_size(tree), "created": time.time()}
+            with open(op.join(tmp_entry, "meta.json"), "w") as meta_file:
+                json.dump(meta, meta_file)
+            open(op.join(tmp_entry, "last_used"), "w").close()
+            os.rename(tmp_entry, self._entry_path(key))
+        except Exception:
+            # A partial tree would otherwise stay in tmp/ until the next
+            # population of the same key by the same pid
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+            raise
+        log.info("Cached hcp-struct tree %s (%.1f GB).", key, meta["size"] / 1e9)
+
+    def _materialize(self, key, dest_dir):
+        """
+        Reflink (or copy) every file of a cached tree into `dest_dir`.
+        The caller holds at least a shared entry lock.
+        """
+        tree = op.join(self._entry_path(key), "tree")
+        counts = {}
+        for dirpath, _, files in os.walk(tree):
+            target_dir = op.join(dest_dir, op.relpath(dirpath, tree))
+            os.makedirs(target_dir, exist_ok=True)
+            for fl in files:
+                target = op.join(target_dir, fl)
+                method = func_utils.link_or_copy(
+                    op.join(dirpath, fl), target, methods=MATERIALIZE_METHODS
+                )
+                os.chmod(target, 0o644)
+                counts[method] = counts.get(method, 0) + 1
+        os.utime(op.join(self._entry_path(key), "last_used"))
+        log.info("Materialized cached hcp-struct tree %s: %s", key, counts)
+
+    def fetch(self, key, extract, dest_dir):
+        """
+        Materialize entry `key` into `dest_dir`, populating it first with
+        `extract(dest_dir)` if it is not cached.
+        """
+        lock_path = self._lock_path(key)
+        if not op.isdir(self._entry_path(key)):
+            with _flock(lock_path, fcntl.LOCK_EX):
+                # Another job may have populated the entry while we waited
+                if not op.isdir(self._entry_path(key)):
+                    self._populate(key, extract)
+        with _flock(lock_path, fcntl.LOCK_SH):
+            self._materialize(key, dest_dir)
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        """
+        Remove least-recently-used entries until the cache fits in max_bytes.
+        Entries locked by other jobs and `keep` are never removed.
+        """
+        with _flock(op.join(self.locks_dir, "evict.lock"), fcntl.LOCK_EX):
+            entries = []
+            for key in os.listdir(self.entries_dir):
+                entry = self._entry_path(key)
+                try:
+                    with open(op.join(entry, "meta.json")) as meta_file:
+                        size = json.load(meta_file)["size"]
+                    last_used = op.getmtime(op.join(entry, "last_used"))
+                except (OSError, ValueError, KeyError):
+                    continue
+                entries.append((last_used, key, size))
+
+            total = sum(size for _, _, size in entries)
+            for _, key, size in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if key == keep:
+                    continue
+                with _flock(self._lock_path(key), fcntl.LOCK_EX, False) as locked:
+                    if not locked:
+                        continue
+                    trash = op.join(self.tmp_dir, "{}.evict".format(key))
+                    os.rename(self._entry_path(key), trash)
+                    shutil.rmtree(trash, ignore_errors=True)
+                total -= size
+                log.info("Evicted cached hcp-struct tree %s.", key)
+
+
+def unzip_cached(context, zip_filename):
+    """
+    Unzip the hcp-struct zip into the work directory through the on-node cache
+    at config["struct-cache-dir"]. Falls back to `struct_zip.unzip_struct` if
+    the cache cannot be used.
+    Args:
+        context: Gear information, with the hcp-struct member list in
+            context.gear_dict["exclude_from_output"].
+        zip_filename (str): path to the hcp-struct zip.
+    """
+    config = context.config
+    try:
+        cache = StructCache(
+            config["struct-cache-dir"], config["struct-cache-max-GB"] * 1e9
+        )
+        # Selective and full extraction produce different trees: key on the
+        # extraction actually used, full if the selection failed
+        mode, members = struct_zip.extraction_members(context)
+        key = "{}-{}".format(struct_zip_hash(context), mode)
+
+        def extract(dest_dir):
+            struct_zip.extract_members(zip_filename, members, dest_dir)
+
+        cache.fetch(key, extract, context.work_dir)
+    except Exception as e:
+        log.warning("The hcp-struct cache could not be used: %s", e)
+        struct_zip.unzip_struct(context, zip_filename)
@@ -0,0 +1,168 @@
+"""
+Selective extraction of the hcp-struct zip (StructZip) for the hcp-func gear.
+fMRIVolume, fMRISurface, and the functional QC only read a known subset of the
+structural tree. Rather than inflating the entire archive, only the members
+matching STRUCT_MEMBER_RULES are extracted, concurrently across processes.
+NOTE: the `utils.gear_preliminaries` module is in the `hcp-base` code
+"""
+import logging
+import os
+import os.path as op
+import re
+from concurrent.futures import ProcessPoolExecutor
+from zipfile import ZipFile
+
+from utils import func_utils, gear_preliminaries
+
+log = logging.getLogger(__name__)
+
+# Members of the structural tree consumed by fMRIVolume, fMRISurface and
+# hcpfunc_qc_mosaic.sh. Paths are relative to the "<Subject>/" directory.
+STRUCT_MEMBER_RULES = [
+    # hcp-struct configuration
+    r"[^/]+\.json$",
+    # ACPC-aligned anatomy, masks, bias field, wmparc, ribbon
+    r"T1w/[^/]+$",
+    r"T1w/xfms/",
+    # FreeSurfer subject directory used by bbregister
+    r"T1w/[^/]+/(mri|surf|label|scripts)/",
+    # Atlas space volumes, warps, ROIs and surfaces
+    r"MNINonLinear/",
+]
+
+# If any of these are not selected, the zip does not have the expected layout
+# and selective extraction is not trusted.
+STRUCT_REQUIRED_MEMBERS = [
+    "T1w/T1w_acpc_dc_restore.nii.gz",
+    "T1w/T1w_acpc_dc_restore_brain.nii.gz",
+    "MNINonLinear/xfms/acpc_dc2standard.nii.gz",
+]
+
+
+def select_members(member_list):
+    """
+    Select the members of the hcp-struct zip needed by the functional pipelines.
+    Args:
+        member_list (list): member names from `preprocess_hcp_zip`.
+    Returns:
+        list: selected (file) members, in archive order.
+    """
+    rules = [re.compile(rule) for rule in STRUCT_MEMBER_RULES]
+    selected = []
+    found = set()
+    for member in member_list:
+        # Directory entries are created implicitly on extraction
+        if member.endswith("/") or "/" not in member:
+            continue
+        relative = member.split("/", 1)[1]
+        if any(rule.match(relative) for rule in rules):
+            selected.append(member)
+            found.add(relative)
+
+    missing = [fl for fl in STRUCT_REQUIRED_MEMBERS if fl not in found]
+    if missing:
+        raise Exception(
+            "Selective extraction did not find required members: "
+            + ", ".join(missing)
+        )
+
+    return selected
+
+
+def _extract_chunk(zip_filename, members, dest_dir):
+    """
+    Extract a list of members from zip_filename. Run in a worker process.
+    """
+    with ZipFile(zip_filename, "r") as hcp_zip:
+        for member in members:
+            hcp_zip.extract(member, dest_dir)
+    return len(members)
+
+
+def extract_members(zip_filename, members, dest_dir, workers=None):
+    """
+    Inflate `members` of `zip_filename` into `dest_dir` across worker processes.
+    Members are balanced between workers by uncompressed size.
+    Args:
+        zip_filename (str): path to the zip file.
+        members (list): member names to extract.
+        dest_dir (str): directory to extract into.
+        workers (int): number of worker processes (default: available cpus).
+    """
+    if workers is None:
+        workers = func_utils.available_cpus()
+
+    with ZipFile(zip_filename, "r") as hcp_zip:
+        sizes = {info.filename: info.file_size for info in hcp_zip.infolist()}
+
+    # Creating directories up front avoids races between workers
+    for dirname in {op.dirname(member) for member in members}:
+        os.makedirs(op.join(dest_dir, dirname), exist_ok=True)
+
+    # Greedy largest-first assignment to the least-loaded worker
+    chunks = [[] for _ in range(max(1, min(workers, len(members))))]
+    loads = [0] * len(chunks)
+    for member in sorted(members, key=lambda m: sizes.get(m, 0), reverse=True):
+        idx = loads.index(min(loads))
+        chunks[idx].append(member)
+        loads[idx] += sizes.get(member, 0)
+
+    with ProcessPoolExecutor(max_workers=len(chunks)) as executor:
+        futures = [
+            executor.submit(_extract_chunk, zip_filename, chunk, dest_dir)
+            for chunk in chunks
+        ]
+        for future in futures:
+            future.result()
+
+    log.info(
+        "Extracted %d members (%.1f MB) with %d workers.",
+        len(members),
+        sum(loads) / 1e6,
+        len(chunks),
+    )
+
+
+def extraction_members(context):
+    """
+    The hcp-struct members to extract according to the "struct-extraction"
+    configuration. Unlike `unzip_struct`, a failed selection falls back to
+    every member, extracted in parallel.
+    Args:
+        context: Gear information, with the hcp-struct member list in
+            context.gear_dict["exclude_from_output"].
+    Returns:
+        tuple: (extraction actually used, "selective" or "full"; members)
+    """
+    member_list = context.gear_dict["exclude_from_output"]
+    if context.config["struct-extraction"] == "selective":
+        try:
+            return "selective", select_members(member_list)
+        except Exception as e:
+            log.warning("Selective extraction failed: %s", e)
+            log.warning("Falling back to full extraction.")
+    return "full", [member for member in member_list if not member.endswith("/")]
+
+
+def unzip_struct(context, zip_filename):
+    """
+    Unzip the hcp-struct zip into the work directory according to the
+    "struct-extraction" configuration. "selective" extracts only the members
+    used by the functional pipelines and falls back to a full extraction
+    (`gear_preliminaries.unzip_hcp`) if that is not possible.
+    Args:
+        context: Gear information, with the hcp-struct member list in
+            context.gear_dict["exclude_from_output"].
+        zip_filename (str): path to the hcp-struct zip.
+    """
+    if context.config["struct-extraction"] == "selective":
+        try:
+            members = select_members(context.gear_dict["exclude_from_output"])
+            log.info("Selectively unzipping hcp-struct zip file, %s", zip_filename)
+            extract_members(zip_filename, members, context.work_dir)
+            return
+        except Exception as e:
+            log.warning("Selective extraction failed: %s", e)
+            log.warning("Falling back to full extraction.")
+
+    gear_preliminaries.unzip_hcp(context, zip_filename)
@@ -0,0 +1,128 @@
+"""
+Single-pass, bounded-memory temporal statistics of 4D fMRI series.
+Frames are read in chunks and merged into running moments (Welford/Chan), so
+the temporal mean, standard deviation and tSNR of a long multiband series are
+computed with one decompression pass and a memory footprint independent of
+the number of frames. The QC script (scripts/hcpfunc_qc_mosaic.sh) writes
+the three maps with
+    python3 -m utils.temporal_stats <series> <mean> <std> <tsnr>
+"""
+import logging
+import sys
+
+import nibabel as nib
+import numpy as np
+
+from utils import imaging
+
+log = logging.getLogger(__name__)
+
+# Upper bound on the size of one chunk of frames (float64) held in memory
+CHUNK_BYTES = 256 * 1024 * 1024
+
+
+class TemporalMoments(object):
+    """
+    Running per-voxel count, mean and sum of squared deviations (M2).
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+    def update(self, chunk):
+        """
+        Merge a chunk of frames (time on the last axis) into the moments.
+        """
+        frames = chunk.shape[-1]
+        chunk_mean = chunk.mean(axis=-1)
+        chunk_m2 = np.square(chunk - chunk_mean[..., None]).sum(axis=-1)
+        if self.count == 0:
+            self.count, self.mean, self.m2 = frames, chunk_mean, chunk_m2
+            return
+        total = self.count + frames
+        delta = chunk_mean - self.mean
+        self.mean += delta * (frames / float(total))
+        self.m2 += chunk_m2 + np.square(delta) * (self.count * frames / float(total))
+        self.count = total
+
+    def std(self, ddof=1):
+        """
+        Temporal standard deviation (sample, like fslmaths -Tstd, by default).
+        """
+        if self.count <= ddof:
+            return np.zeros_like(self.mean)
+        return np.sqrt(self.m2 / (self.count - ddof))
+
+    def tsnr(self):
+        """
+        Temporal signal-to-noise ratio, mean / std, 0 where std is 0.
+        """
+        std = self.std()
+        tsnr = np.zeros_like(self.mean)
+        np.divide(self.mean, std, out=tsnr, where=std > 0)
+        return tsnr
+
+
+def iter_chunks(img, chunk_bytes=CHUNK_BYTES):
+    """
+    Yield consecutive chunks of frames of a 4D image as float64 arrays.
+    Frames are contiguous on disk, so chunks are read sequentially.
+    """
+    frames = img.shape[3] if len(img.shape) > 3 else 1
+    frame_bytes = int(np.prod(img.shape[:3])) * 8
+    chunk_frames = max(1, chunk_bytes // frame_bytes)
+    for start in range(0, frames, chunk_frames):
+        chunk = img.dataobj[..., start : start + chunk_frames]
+        yield np.asarray(chunk, dtype=np.float64).reshape(img.shape[:3] + (-1,))
+
+
+def load_series(path):
+    """
+    Load a 4D series keeping the (gzip) file open between chunk reads.
+    """
+    return nib.load(imaging.find_image(path), keep_file_open=True)
+
+
+def temporal_moments(img, chunk_bytes=CHUNK_BYTES):
+    """
+    Temporal moments of a 4D image in a single chunked pass.
+    Returns:
+        TemporalMoments: the accumulated moments.
+    """
+    moments = TemporalMoments()
+    for chunk in iter_chunks(img, chunk_bytes):
+        moments.update(chunk)
+    log.info("Computed temporal statistics over %d frames.", moments.count)
+    return moments
+
+
+def save_map(filename, data, like):
+    """
+    Save a 3D float32 map on the grid of the image `like`.
+    """
+    header = like.header.copy()
+    header.set_data_dtype(np.float32)
+    nib.save(nib.Nifti1Image(data.astype(np.float32), like.affine, header), filename)
+    log.info("Wrote %s", filename)
+
+
+def main(argv):
+    """
+    temporal_stats <series> <mean> <std> <tsnr>
+    """
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if len(argv) != 4:
+        raise Exception("Usage: temporal_stats <series> <mean> <std> <tsnr>")
+    series_path, mean_filename, std_filename, tsnr_filename = argv
+    series = load_series(series_path)
+    moments = temporal_moments(series)
+    save_map(mean_filename, moments.mean, series)
+    save_map(std_filename, moments.std(), series)
+    save_map(tsnr_filename, moments.tsnr(), series)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))